@@ -10,4 +10,12 @@ except PackageNotFoundError:  # pragma: no cover
     __version__ = "unknown"
 DATASET_CFG = files(__package_name__).joinpath("dataset.yaml")
 MAIN_CFG = files(__package_name__).joinpath("configs/main.yaml")
-dataset_info = OmegaConf.load(DATASET_CFG)
+
+
+def __getattr__(name):
+    # dataset_info is only needed for downloading, so it is loaded on first access
+    if name == "dataset_info":
+        value = OmegaConf.load(DATASET_CFG)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
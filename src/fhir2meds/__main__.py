@@ -1,23 +1,34 @@
+import logging
 import os
+import shutil
 from pathlib import Path
 
-from omegaconf import DictConfig
-
-from .event_conversion import build_patient_id_map, build_event
-from .fhir_parser import load_fhir_resources_by_type, filter_subject_resources_by_type, load_event_config
-from .meds_writer import write_meds_sharded_parquet
-from .metadata_writer import write_dataset_metadata, write_codes_metadata, write_subject_splits
-import shutil
-import logging
-from . import MAIN_CFG, dataset_info
 import hydra
-from .download import download_data
-import polars as pl
+from omegaconf import DictConfig, OmegaConf
+
+from . import MAIN_CFG, profiling
+from .code_metadata import DEFAULT_MAX_CODES, CodeMetadata
+from .cohort import filter_cohort, load_cohort, make_time_window
+from .event_conversion import build_patient_id_map, patient_id_map_from_resources
+from .fhir_parser import (
+    PAYLOAD_MIN_BYTES,
+    combine_event_configs,
+    filter_subject_resources_by_type,
+    get_subject_reference,
+    iter_resources,
+    list_fhir_files,
+    load_event_config,
+    load_event_configs,
+    load_fhir_resources_by_type,
+)
+from .storage import PART_SIZE, file_size, is_remote, upload_directory
+
 # Fix MAIN_CFG for hydra.main
 MAIN_CFG_PATH = str(MAIN_CFG)
 MAIN_CFG_PARENT = os.path.dirname(MAIN_CFG_PATH)
 MAIN_CFG_STEM = os.path.splitext(os.path.basename(MAIN_CFG_PATH))[0]
 
+
 @hydra.main(version_base=None, config_path=MAIN_CFG_PARENT, config_name=MAIN_CFG_STEM)
 def main(cfg: DictConfig) -> None:
     # parser = argparse.ArgumentParser(description="Convert all subject-associated FHIR resources to MEDS Parquet format.")
@@ -28,6 +39,13 @@ def main(cfg: DictConfig) -> None:
     # parser.add_argument("--verbose", action="store_true", help="Enable verbose logging.")
     # parser.add_argument("--overwrite", action="store_true", help="Overwrite existing output directory.")
     # args = parser.parse_args()
+    # polars/pyarrow and the modules using them are imported by the stages, not on CLI startup
+    from .sharding import (
+        DEFAULT_SPLIT_FRACTIONS,
+        validate_split_fractions,
+        validate_worker_args,
+    )
+
     shard_size = cfg.get("shard_size", 10000)
     max_events = cfg.get("max_events", None)
     verbose = cfg.get("verbose", False)
@@ -36,76 +54,580 @@ def main(cfg: DictConfig) -> None:
     raw_input_dir = Path(cfg.raw_input_dir)
     root_output_dir = Path(cfg.root_output_dir)
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
-    raw_input_dir = Path(cfg.raw_input_dir)
+    # URLs (s3://, memory://, ...) are read through fsspec and must not be normalized as paths
+    raw_input_dir = cfg.raw_input_dir if is_remote(cfg.raw_input_dir) else Path(cfg.raw_input_dir)
+    output_uri = cfg.get("output_uri", None)
     # pre_MEDS_dir = Path(cfg.pre_MEDS_dir)
     # MEDS_cohort_dir = Path(cfg.MEDS_cohort_dir)
     # stage_runner_fp = cfg.get("stage_runner_fp", None)
     root_output_dir = Path(cfg.root_output_dir)
 
-    if cfg.do_overwrite and root_output_dir.exists():
+    # Sharded execution: each worker converts a deterministic slice of the input
+    stage = cfg.get("stage", "convert")
+    worker_index = cfg.get("worker_index", 0)
+    num_workers = cfg.get("num_workers", 1)
+    partition_by = cfg.get("partition_by", "files")
+    validate_worker_args(worker_index, num_workers)
+    # Subjects are assigned to splits by a stable hash of their subject_id, independently per shard
+    split_fractions = cfg.get("split_fractions", None)
+    split_fractions = (
+        OmegaConf.to_container(split_fractions) if split_fractions is not None else DEFAULT_SPLIT_FRACTIONS
+    )
+    split_seed = cfg.get("split_seed", 0)
+    validate_split_fractions(split_fractions)
+    sharded = num_workers > 1
+    # Named event configs are converted in one pass, each into root_output_dir/{name}
+    variant_paths = cfg.get("event_configs", None)
+    variant_paths = OmegaConf.to_container(variant_paths) if variant_paths is not None else None
+    output_dirs = [root_output_dir / name for name in variant_paths] if variant_paths else [root_output_dir]
+
+    if stage == "merge":
+        from .manifest import write_manifest
+        from .sharding import merge_worker_partials
+
+        for output_dir in output_dirs:
+            lost_values = merge_worker_partials(str(output_dir), num_workers)
+            write_run_dataset_metadata(output_dir)
+            if cfg.get("write_manifest", True):
+                write_manifest(str(output_dir), lost_values=lost_values)
+            print(f"Merged metadata of {num_workers} workers into {output_dir / 'metadata'}.")
+        if output_uri:
+            # The workers wrote their data shards to output_uri directly
+            upload_directory(
+                str(root_output_dir),
+                output_uri,
+                part_size=cfg.get("upload_part_size", PART_SIZE),
+                exclude=data_dirs(root_output_dir, output_dirs),
+            )
+        return
+    elif stage == "watch":
+        watch(cfg, split_fractions, split_seed)
+        return
+    elif stage == "verify":
+        verify(output_dirs, full=cfg.get("verify_values", False))
+        return
+    elif stage == "equivalence":
+        equivalence(cfg)
+        return
+    elif stage != "convert":
+        raise ValueError(
+            f"Unknown stage {stage}, expected 'convert', 'merge', 'watch', 'verify' or 'equivalence'"
+        )
+
+    import polars as pl
+
+    from .dedup import deduplicate_resources
+    from .manifest import write_manifest
+    from .mapping import map_events, release_events
+    from .meds_writer import (
+        drain_lost_values,
+        events_to_dataframe,
+        set_strict_casts,
+        write_meds_sharded_parquet,
+    )
+    from .memory import MemoryGovernor, parse_memory_limit
+    from .metadata_writer import write_codes_metadata
+    from .sharding import (
+        assemble_subject_splits,
+        clear_worker_outputs,
+        partition_files,
+        subject_in_partition,
+        worker_shard_prefix,
+        write_worker_partials,
+    )
+    from .subject_index import assemble_subject_index
+    from .units import make_normalizer, with_unit_expression
+
+    # Values lost in the MEDS casts are counted in the manifest unless strict_casts is set
+    set_strict_casts(cfg.get("strict_casts", False))
+    if sharded and (cfg.do_overwrite or overwrite):
+        # Other workers write into the same directory, only remove what this worker owns
+        logging.info(f"Removing existing outputs of worker {worker_index}.")
+        for output_dir in output_dirs:
+            clear_worker_outputs(str(output_dir), worker_index, num_workers)
+        overwrite = False
+    elif cfg.do_overwrite and root_output_dir.exists():
         logging.info("Removing existing MEDS cohort directory.")
         shutil.rmtree(root_output_dir)
 
+    # Optional cost attribution per stage and per (resource type, config key, expression)
+    profiler = profiling.enable(cfg.get("profile_allocations", False)) if cfg.get("profile", False) else None
+
     # Step 0: Data downloading
     if cfg.do_download:  # pragma: no cover
+        profiling.stage("download")
+        # requests/bs4 are only imported when downloading is enabled
+        from . import dataset_info
+        from .download import download_data
+
+        verify_download = cfg.get("verify_download", True)
         if cfg.get("do_demo", False):
             logging.info("Downloading demo data.")
             if isinstance(dataset_info, DictConfig):
-                download_data(raw_input_dir, dataset_info, do_demo=True)
+                download_data(raw_input_dir, dataset_info, do_demo=True, verify=verify_download)
         else:
             logging.info("Downloading data.")
             if isinstance(dataset_info, DictConfig):
-                download_data(raw_input_dir, dataset_info)
+                download_data(raw_input_dir, dataset_info, verify=verify_download)
     else:  # pragma: no cover
         logging.info("Skipping data download.")
+    profiling.stage("setup")
+
+    # Optional memory budget: mapping and writing adapt their batch sizes and spill, loading fails early
+    governor = None
+    if cfg.get("memory_limit", None) is not None:
+        governor = MemoryGovernor(
+            parse_memory_limit(cfg.memory_limit), spill_dir=cfg.get("memory_spill_dir", None)
+        )
 
-    # Load event config for the selected FHIR version
+    # Load the event config(s) for the selected FHIR version; resources are parsed once for all of them
     fhir_version = cfg.get("fhir_version", "R4")
-    event_config = load_event_config(fhir_version=fhir_version)
+    event_configs = load_event_configs(variant_paths, fhir_version=fhir_version)
+    event_config = combine_event_configs(event_configs)
+    if len(event_configs) > 1 and cfg.get("use_resource_cache", False):
+        raise ValueError("use_resource_cache supports a single event config")
 
     if verbose:
         print(f"Loading FHIR resources from {raw_input_dir}...")
     # Fix Path to str for function arguments
-    all_resources = load_fhir_resources_by_type(str(raw_input_dir), event_config, fhir_version)
+    # Optional pre-scan of the input: skip files of unconfigured types, balance workers, report ETA
+    catalog = None
+    progress = None
+    files = None
+    if is_remote(raw_input_dir) and (
+        cfg.get("dry_run", False) or cfg.get("use_catalog", False) or cfg.get("use_resource_cache", False)
+    ):
+        raise ValueError("use_catalog, dry_run and use_resource_cache need a local raw_input_dir")
+    if cfg.get("dry_run", False) or cfg.get("use_catalog", False):
+        from .catalog import (
+            CatalogProgress,
+            build_catalog,
+            file_weights,
+            format_plan,
+            plan,
+            select_files,
+        )
+
+        catalog = build_catalog(str(raw_input_dir), manifest_path=cfg.get("catalog_path", None))
+        if cfg.get("dry_run", False):
+            print(format_plan(plan(catalog, event_config)))
+            return
+        files = select_files(catalog, event_config["resources"])
+    use_bulk_export = bool(cfg.get("bulk_export_url", None) or cfg.get("bulk_export_status_url", None))
+    if sharded and partition_by == "files" and not use_bulk_export:
+        input_files = files if files is not None else list_fhir_files(str(raw_input_dir))
+        weights = file_weights(catalog) if catalog is not None else None
+        if is_remote(raw_input_dir):
+            weights = {fpath: file_size(fpath) for fpath in input_files}
+        files = partition_files(input_files, worker_index, num_workers, sizes=weights)
+        logging.info(f"Worker {worker_index}/{num_workers} processes {len(files)} files: {files}")
+    elif partition_by not in ("files", "subject"):
+        raise ValueError(f"Unknown partition_by {partition_by}, expected 'files' or 'subject'")
+    if catalog is not None:
+        progress = CatalogProgress(catalog, files=files)
+
+    # Optional FHIR Bulk Data $export source, streamed into the parser instead of reading raw_input_dir
+    profiling.stage("load")
+    bulk_resources = None
+    if use_bulk_export:
+        from .bulk_export import (
+            BulkExportClient,
+            export_patient_map,
+            load_bulk_export_by_type,
+            with_patients,
+        )
+
+        if catalog is not None or cfg.get("use_resource_cache", False):
+            raise ValueError(
+                "bulk_export_url cannot be combined with use_catalog, dry_run or use_resource_cache"
+            )
+        headers = cfg.get("bulk_export_headers", None)
+        client = BulkExportClient(
+            cfg.get("bulk_export_url", None) or "",
+            headers=OmegaConf.to_container(headers) if headers is not None else None,
+            concurrency=cfg.get("bulk_export_concurrency", 4),
+            poll_interval=cfg.get("bulk_export_poll_interval", 1.0),
+            timeout=cfg.get("bulk_export_timeout", None),
+        )
+        bulk_types = cfg.get("bulk_export_types", None)
+        bulk_types = list(bulk_types) if bulk_types is not None else None
+        if cfg.get("bulk_export_status_url", None):
+            # Sharded workers share one export job instead of each starting their own
+            manifest = client.wait(cfg.bulk_export_status_url)
+        else:
+            manifest = client.export(
+                types=with_patients(bulk_types), since=cfg.get("bulk_export_since", None)
+            )
+        export_manifest = manifest
+        if sharded and partition_by == "files":
+            urls = [entry["url"] for entry in manifest.get("output", [])]
+            counts = {entry["url"]: entry.get("count", 1) for entry in manifest.get("output", [])}
+            worker_urls = set(partition_files(urls, worker_index, num_workers, sizes=counts))
+            manifest = {
+                **manifest,
+                "output": [e for e in manifest.get("output", []) if e["url"] in worker_urls],
+            }
+            logging.info(f"Worker {worker_index}/{num_workers} downloads {len(worker_urls)} export files")
+        bulk_resources = load_bulk_export_by_type(
+            client, event_config, manifest, types=bulk_types, governor=governor
+        )
+
+    # Build patient UUID to int map
+    profiling.stage("patients")
+    patient_ndjson_path = os.path.join(raw_input_dir, "Patient.ndjson")
+    if bulk_resources is not None:
+        # Workers sharing an export need the Patient files of all workers; they are downloaded again
+        # unless this run loaded every one of them
+        loaded_all = manifest is export_manifest and (bulk_types is None or "Patient" in bulk_types)
+        patients = bulk_resources.get("Patient", []) if loaded_all else None
+        uuid_to_int = export_patient_map(client, export_manifest, patients)
+        client.close()
+    elif os.path.exists(patient_ndjson_path):
+        uuid_to_int = build_patient_id_map(patient_ndjson_path)
+    else:
+        # Patients delivered in Bundles or differently named files
+        uuid_to_int = patient_id_map_from_resources(iter_resources(str(raw_input_dir), types=["Patient"]))
+    if verbose:
+        print(f"Loaded {len(uuid_to_int)} patient UUID to integer ID mappings.")
+
+    # Optional study cohort, pushed down into loading
+    cohort = load_cohort(cfg.cohort_path, uuid_to_int) if cfg.get("cohort_path", None) else None
+    time_window = make_time_window(cfg.get("time_window_start", None), cfg.get("time_window_end", None))
+
+    deduplicate = cfg.get("deduplicate", True)
+    resource_cache = None
+    profiling.stage("load")
+    if bulk_resources is not None:
+        all_resources = filter_cohort(bulk_resources, cohort)
+    elif cfg.get("use_resource_cache", False):
+        # Only types whose config or input changed since the last run are loaded (from the cache)
+        from .resource_cache import ResourceCache, config_fingerprint
+
+        resource_cache = ResourceCache(
+            cfg.resource_cache_dir, payload_min_bytes=cfg.get("payload_min_bytes", PAYLOAD_MIN_BYTES)
+        )
+        resource_cache.update(files if files is not None else list_fhir_files(str(raw_input_dir)))
+        cache_scope = worker_shard_prefix(worker_index, num_workers)
+        all_resources = {}
+        cached_events = {}
+        event_keys = {}
+        # Cached events are normalized, so they depend on the conversion table and options
+        normalizer = make_normalizer(
+            cfg.get("normalize_units", False),
+            cfg.get("unit_conversions", None),
+            cfg.get("promote_numeric_text", False),
+        )
+        for rtype in resource_cache.resource_types():
+            if rtype not in event_config["resources"]:
+                continue
+            # Hashed as mapped, i.e. with the unit expression when converting units
+            event_keys[rtype] = config_fingerprint(
+                with_unit_expression(event_config, cfg.get("normalize_units", False)),
+                rtype,
+                fhir_version=fhir_version,
+                inputs=resource_cache.input_fingerprint(rtype),
+                patients=sorted(uuid_to_int.items()),
+                max_events=max_events,
+                partition=[partition_by, worker_index, num_workers],
+                deduplicate=deduplicate,
+                cohort=cohort.fingerprint() if cohort is not None else None,
+                time_window=time_window,
+                normalizer=normalizer.fingerprint() if normalizer is not None else None,
+            )
+            cached_events[rtype] = resource_cache.load_events(rtype, event_keys[rtype], scope=cache_scope)
+            if cached_events[rtype] is None:
+                resources = {rtype: resource_cache.load_resources(rtype)}
+                all_resources[rtype] = filter_cohort(resources, cohort)[rtype]
+        n_cached = len(cached_events) - len(all_resources)
+        logging.info(f"Re-mapping {list(all_resources)}, reusing cached events of {n_cached} types")
+    else:
+        all_resources = load_fhir_resources_by_type(
+            str(raw_input_dir),
+            event_config,
+            fhir_version,
+            files=files,
+            progress=progress,
+            payload_min_bytes=cfg.get("payload_min_bytes", PAYLOAD_MIN_BYTES),
+            cohort=cohort,
+            governor=governor,
+        )
+    if deduplicate:
+        # Keep the latest version of every (resourceType, id)
+        profiling.stage("deduplicate")
+        all_resources = deduplicate_resources(all_resources)
+    report = None
+    if cfg.get("validate_with_fhir_resources", False):
+        from .validation import validate_resources
+
+        profiling.stage("validate")
+
+        report = validate_resources(
+            all_resources,
+            fhir_version=fhir_version,
+            every_n=cfg.get("validate_every_n", 1),
+            first_k=cfg.get("validate_first_k", None),
+            max_workers=cfg.get("validate_workers", None),
+        )
+        report.log()
     subject_resources = filter_subject_resources_by_type(all_resources)
+    if sharded and partition_by == "subject":
+        subject_resources = {
+            rtype: [
+                res
+                for res in resources
+                if subject_in_partition(get_subject_reference(res), worker_index, num_workers)
+            ]
+            for rtype, resources in subject_resources.items()
+        }
     if verbose:
         print(f"Loaded subject-associated resources for types: {list(subject_resources.keys())}")
 
     if overwrite:
         print("Overwriting existing output directory...")
-        shutil.rmtree(root_output_dir)
-        os.makedirs(root_output_dir)
+        shutil.rmtree(root_output_dir, ignore_errors=True)
+    os.makedirs(root_output_dir, exist_ok=True)
+    if report is not None:
+        # Written once the output directory was prepared, which overwrite=true clears
+        report_name = f"validation_report_{worker_index}.json" if sharded else "validation_report.json"
+        report.write(str(root_output_dir / report_name))
+
+    for variant_idx, ((name, variant_config), output_dir) in enumerate(
+        zip(event_configs.items(), output_dirs)
+    ):
+        if name:
+            print(f"Converting with event config {name} into {output_dir}...")
+        os.makedirs(output_dir, exist_ok=True)
+        profiling.stage("map")
+        # Descriptions and parents of the emitted codes are collected while mapping
+        code_metadata = CodeMetadata(cfg.get("max_code_metadata", DEFAULT_MAX_CODES))
+        for rtype in ("CodeSystem", "ConceptMap"):
+            if resource_cache is not None and rtype not in all_resources:
+                code_metadata.index_terminology(resource_cache.load_resources(rtype))
+            else:
+                code_metadata.index_terminology(all_resources.get(rtype, []))
+
+        if worker_index == 0:
+            pl.DataFrame(uuid_to_int).unpivot().write_csv(output_dir / "uuid_to_int.csv")
+        if resource_cache is not None:
+            # Re-map only the types whose config or input changed, reuse the cached events of the others
+            frames = []
+            for rtype, events in cached_events.items():
+                if events is None:
+                    type_codes = CodeMetadata()
+                    events = map_events(
+                        {rtype: subject_resources.get(rtype, [])},
+                        variant_config,
+                        uuid_to_int,
+                        cfg,
+                        type_codes,
+                    )
+                    if not isinstance(events, pl.DataFrame):
+                        events = events_to_dataframe(events)
+                    resource_cache.store_events(
+                        rtype, event_keys[rtype], events, scope=cache_scope, codes=type_codes.to_records()
+                    )
+                    code_metadata.update(type_codes)
+                else:
+                    code_metadata.update_from_records(
+                        resource_cache.load_codes(rtype, event_keys[rtype], scope=cache_scope)
+                    )
+                    if verbose:
+                        print(f"Reusing {events.height} cached {rtype} events.")
+                frames.append(events)
+            all_events = pl.concat(frames, how="vertical_relaxed") if frames else events_to_dataframe([])
+        else:
+            variant_resources = {
+                rtype: res for rtype, res in subject_resources.items() if rtype in variant_config["resources"]
+            }
+            all_events = map_events(
+                variant_resources, variant_config, uuid_to_int, cfg, code_metadata, governor=governor
+            )
+            if governor is not None and variant_idx == len(event_configs) - 1:
+                # The resources are not needed for writing, release them before the shards are built
+                variant_resources = None
+                all_resources.clear()
+                subject_resources.clear()
+        code_metadata.log()
+
+        print(f"Writing {len(all_events)} MEDS events to {output_dir}...")
+        profiling.stage("write")
+        write_meds_sharded_parquet(
+            all_events,
+            str(output_dir),
+            shard_size=shard_size,
+            verbose=verbose,
+            shard_prefix=worker_shard_prefix(worker_index, num_workers),
+            split_fractions=split_fractions,
+            split_seed=split_seed,
+            subject_index=cfg.get("write_subject_index", True),
+            row_group_size=cfg.get("row_group_size", None),
+            governor=governor,
+            output_uri=output_url(output_uri, root_output_dir, output_dir) if output_uri else None,
+            part_size=cfg.get("upload_part_size", PART_SIZE),
+        )
+        print("Done writing MEDS event data.")
+        lost_values = drain_lost_values()
+
+        profiling.stage("metadata")
+        if sharded:
+            # Codes and subject splits are combined by a final `stage=merge` run
+            write_worker_partials(
+                str(output_dir), worker_index, num_workers, all_events, code_metadata, lost_values=lost_values
+            )
+            release_events(all_events, governor)
+            print(
+                f"Worker {worker_index}/{num_workers} done, run with stage=merge once all workers finished."
+            )
+            continue
+
+        # Write MEDS metadata files
+        print("Writing MEDS metadata files...")
+        write_run_dataset_metadata(output_dir)
+        write_codes_metadata(str(output_dir), all_events, code_metadata)
+        release_events(all_events, governor)
+        assemble_subject_splits(str(output_dir))
+        if cfg.get("write_subject_index", True):
+            assemble_subject_index(str(output_dir))
+        if cfg.get("write_manifest", True):
+            write_manifest(str(output_dir), lost_values=lost_values)
+        print("Done writing MEDS metadata.")
+    if profiler is not None:
+        profiling.disable()
+        profile_dir = Path(cfg.get("profile_dir", None) or root_output_dir / "profile")
+        if sharded:
+            profile_dir = profile_dir / f"worker_{worker_index}"
+        profiler.write(str(profile_dir))
+        print(f"Wrote profile to {profile_dir}:\n{profiler.report(limit=10)}")
+    if output_uri and not sharded:
+        # Sharded runs are uploaded by the stage=merge run; the data shards are already there
+        upload_directory(
+            str(root_output_dir),
+            output_uri,
+            part_size=cfg.get("upload_part_size", PART_SIZE),
+            exclude=data_dirs(root_output_dir, output_dirs),
+        )
+        print(f"Uploaded {root_output_dir} to {output_uri}.")
+
+
+def output_url(output_uri: str, root_output_dir: Path, output_dir: Path) -> str:
+    """
+    URL below output_uri that output_dir (root_output_dir or one of its event config variants) is
+    written to.
+    """
+    rel_path = output_dir.relative_to(root_output_dir).as_posix()
+    return output_uri.rstrip("/") if rel_path == "." else f"{output_uri.rstrip('/')}/{rel_path}"
+
+
+def data_dirs(root_output_dir: Path, output_dirs) -> tuple:
+    # Data shards are written to output_uri directly, only the metadata files are uploaded
+    return tuple(os.path.relpath(output_dir / "data", root_output_dir) for output_dir in output_dirs)
+
+
+def watch(cfg: DictConfig, split_fractions, split_seed) -> None:
+    """
+    Convert new files of raw_input_dir in micro-batches until interrupted, see watch.MicroBatchConverter.
+    """
+    from .mapping import map_events
+    from .watch import MAX_PENDING, PENDING_BATCHES, MicroBatchConverter
+
+    if cfg.get("num_workers", 1) > 1:
+        raise ValueError("stage=watch runs as a single worker")
+    if cfg.get("cohort_path", None) or cfg.get("event_configs", None):
+        raise ValueError("cohort_path and event_configs are not supported with stage=watch")
+    root_output_dir = Path(cfg.root_output_dir)
+    event_config = load_event_config(fhir_version=cfg.get("fhir_version", "R4"))
+    converter = MicroBatchConverter(
+        cfg.raw_input_dir,
+        str(root_output_dir),
+        event_config,
+        shard_size=cfg.get("shard_size", 10000),
+        compact_every=cfg.get("watch_compact_every", 10),
+        settle_seconds=cfg.get("watch_settle_seconds", 5.0),
+        split_fractions=split_fractions,
+        split_seed=split_seed,
+        subject_index=cfg.get("write_subject_index", True),
+        row_group_size=cfg.get("row_group_size", None),
+        deduplicate=cfg.get("deduplicate", True),
+        payload_min_bytes=cfg.get("payload_min_bytes", PAYLOAD_MIN_BYTES),
+        max_code_metadata=cfg.get("max_code_metadata", DEFAULT_MAX_CODES),
+        pending_batches=cfg.get("watch_pending_batches", PENDING_BATCHES),
+        max_pending=cfg.get("watch_max_pending", MAX_PENDING),
+        manifest=cfg.get("write_manifest", True),
+        mapper=lambda resources, uuid_to_int, codes: map_events(
+            resources, event_config, uuid_to_int, cfg, codes
+        ),
+    )
+    write_run_dataset_metadata(root_output_dir)
+    print(f"Watching {cfg.raw_input_dir} for new files...")
+    converter.run(interval=cfg.get("watch_interval", 60.0), max_batches=cfg.get("watch_max_batches", None))
+
+
+def verify(output_dirs, full: bool = False) -> None:
+    """
+    Verify output directories against their manifests (see manifest.verify_output).
+
+    Raises:
+        ValueError: If any problems were found.
+    """
+    from .manifest import load_manifest, verify_output
+
+    n_problems = 0
+    for output_dir in output_dirs:
+        problems = verify_output(str(output_dir), full=full)
+        for problem in problems:
+            print(f"{output_dir}: {problem}")
+        if not problems:
+            manifest = load_manifest(str(output_dir))
+            print(f"{output_dir}: OK, {manifest['n_shards']} shards, {manifest['n_rows']} rows")
+            for kind, n in manifest.get("lost_values", {}).items():
+                # Reported, not a problem: the shards hold what the conversion wrote
+                print(f"{output_dir}: {n} {kind} were lost in the MEDS casts")
+        n_problems += len(problems)
+    if n_problems:
+        raise ValueError(f"Verification found {n_problems} problems")
+
+
+def equivalence(cfg: DictConfig) -> None:
+    """
+    Diff the rows of the mapping engines against the reference on raw_input_dir (if it exists) and
+    on equivalence_synthetic_subjects synthetic subjects, and print their throughput
+    (see equivalence.run_harness).
+
+    Raises:
+        ValueError: If any engine wrote different rows than the reference.
+    """
+    from .equivalence import (
+        format_report,
+        load_input,
+        run_harness,
+        select_engines,
+        synthetic_input,
+    )
+
+    engines = cfg.get("equivalence_engines", None)
+    engines = select_engines(list(engines) if engines is not None else None)
+    inputs = []
+    if not is_remote(cfg.raw_input_dir) and os.path.isdir(cfg.raw_input_dir):
+        fhir_input = load_input(str(cfg.raw_input_dir), cfg.get("fhir_version", "R4"))
+        inputs.append((str(cfg.raw_input_dir), fhir_input))
+    n_synthetic = cfg.get("equivalence_synthetic_subjects", 100)
+    if n_synthetic:
+        synthetic = synthetic_input(n_synthetic, seed=cfg.get("equivalence_seed", 0))
+        inputs.append((f"{n_synthetic} synthetic subjects", synthetic))
+    n_failed = 0
+    for name, (subject_resources, event_config, uuid_to_int) in inputs:
+        runs = run_harness(
+            subject_resources, event_config, uuid_to_int, engines, repeat=cfg.get("equivalence_repeat", 1)
+        )
+        print(f"{name}:\n{format_report(runs)}")
+        n_failed += sum(not run.ok for run in runs)
+    if n_failed:
+        raise ValueError(f"{n_failed} engine runs differ from the reference")
+
+
+def write_run_dataset_metadata(root_output_dir: Path) -> None:
+    from .metadata_writer import write_dataset_metadata
 
-    # Build patient UUID to int map
-    patient_ndjson_path = os.path.join(raw_input_dir, "Patient.ndjson")
-    uuid_to_int = build_patient_id_map(patient_ndjson_path)
-    if verbose:
-        print(f"Loaded {len(uuid_to_int)} patient UUID to integer ID mappings.")
-    pl.DataFrame(uuid_to_int).unpivot().write_csv(root_output_dir / "uuid_to_int.csv")
-    all_events = []
-    for rtype, resources in subject_resources.items():
-        if verbose:
-            print(f"\nProcessing {len(resources)} {rtype} resources...")
-        if max_events is not None and len(resources) > max_events:
-            if verbose:
-                print(f"Limiting to first {max_events} {rtype} resources for debugging.")
-            resources = resources[:max_events]
-        mapped_events = [build_event(res, event_config.get(rtype, event_config['default']), uuid_to_int, event_config["default"]) for res in resources]
-        # Filter out events with missing subject_id
-        events = [e for e in mapped_events if e.get("subject_id") not in (None, "", "null")]
-        filtered_out = len(mapped_events) - len(events)
-        if verbose:
-            print(f"Mapped {len(events)} events from {rtype}. Filtered out {filtered_out} events due to missing subject_id or other issues.")
-            if filtered_out > 0:
-                print(f"Example filtered event: {mapped_events[0] if mapped_events else 'None'}")
-        all_events.extend(events)
-
-    print(f"Writing {len(all_events)} MEDS events to {root_output_dir}...")
-    write_meds_sharded_parquet(all_events, str(root_output_dir), shard_size=shard_size, verbose=verbose)
-    print("Done writing MEDS event data.")
-
-    # Write MEDS metadata files
-    print("Writing MEDS metadata files...")
     write_dataset_metadata(
         output_dir=str(root_output_dir),
         dataset_name="MIMIC-IV FHIR Demo",
@@ -117,9 +639,7 @@ def main(cfg: DictConfig) -> None:
         location_uri=root_output_dir,
         description_uri=None,
     )
-    write_codes_metadata(str(root_output_dir), all_events)
-    write_subject_splits(str(root_output_dir), all_events)
-    print("Done writing MEDS metadata.")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
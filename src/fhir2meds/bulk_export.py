@@ -0,0 +1,319 @@
+"""
+bulk_export.py
+--------------
+Input source for servers speaking the FHIR Bulk Data Access `$export` operation
+(https://hl7.org/fhir/uv/bulkdata/export.html): kick-off, polling of the status endpoint until the
+manifest is ready, then download of the NDJSON output files. Files are fetched concurrently by an
+asyncio event loop (one blocking requests stream per file, run in threads and bounded by
+concurrency) and their lines are handed to the parser as they arrive through a bounded queue, so
+the export is never staged on disk or held in memory as a whole.
+"""
+
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import requests
+
+from .event_conversion import patient_id_map_from_resources
+from .fhir_parser import MEMORY_CHECK_EVERY
+from .streaming_json import expand_bundle
+
+logger = logging.getLogger(__name__)
+
+FHIR_JSON = "application/fhir+json"
+NDJSON = "application/fhir+ndjson"
+CHUNK_SIZE = 1 << 20
+# Batches of lines buffered between the downloads and the parser
+QUEUE_BATCHES = 16
+PATIENT = "Patient"
+_DONE = object()
+
+
+def retry_after_seconds(value: Optional[str], default: float) -> float:
+    """
+    Seconds to wait according to a Retry-After header (delay-seconds or HTTP date).
+
+    Examples:
+        >>> retry_after_seconds("5", 1.0)
+        5.0
+        >>> retry_after_seconds(None, 1.0)
+        1.0
+        >>> retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT", 2.0)
+        0.0
+    """
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+def split_lines(buffer: bytes, chunk: bytes) -> Tuple[List[bytes], bytes]:
+    """
+    Append a downloaded chunk to the incomplete line left over from the previous chunk and return
+    the complete lines plus the new remainder.
+
+    Examples:
+        >>> split_lines(b'{"a"', b': 1}\\n{"b": 2}\\n{"c"')
+        ([b'{"a": 1}', b'{"b": 2}'], b'{"c"')
+    """
+    lines = (buffer + chunk).split(b"\n")
+    return lines[:-1], lines[-1]
+
+
+class BulkExportClient:
+    """
+    Client for one `$export` job against base_url, which is a FHIR server base or a Patient or
+    Group endpoint (e.g. https://ehr.example.com/fhir/Group/1). headers (e.g. an Authorization
+    bearer token) are sent with every request. session_factory returns a requests.Session; each
+    concurrent download uses its own session, closed with the download. The session of the
+    kick-off and status requests is closed by close() (or when the client is used as a context manager).
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        headers: Optional[Dict[str, str]] = None,
+        concurrency: int = 4,
+        poll_interval: float = 1.0,
+        max_poll_interval: float = 60.0,
+        timeout: Optional[float] = None,
+        session_factory: Callable[[], requests.Session] = requests.Session,
+    ):
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+        self.base_url = base_url.rstrip("/")
+        self.headers = dict(headers or {})
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.session_factory = session_factory
+        self.session = session_factory()
+        self.n_bytes = 0
+        self._n_bytes_lock = threading.Lock()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "BulkExportClient":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def kick_off(self, types: Optional[List[str]] = None, since: Optional[str] = None) -> str:
+        """
+        Start an export and return the URL of its status endpoint.
+        """
+        params = {}
+        if types:
+            params["_type"] = ",".join(types)
+        if since:
+            params["_since"] = since
+        url = f"{self.base_url}/$export"
+        if params:
+            url = f"{url}?{urlencode(params, safe=',')}"
+        headers = {**self.headers, "Accept": FHIR_JSON, "Prefer": "respond-async"}
+        response = self.session.get(url, headers=headers)
+        if response.status_code != 202 or "Content-Location" not in response.headers:
+            raise ValueError(f"Export kick-off at {url} failed: {response.status_code} {response.text[:500]}")
+        status_url = response.headers["Content-Location"]
+        logger.info(f"Started bulk export, status at {status_url}")
+        return status_url
+
+    def wait(self, status_url: str) -> Dict[str, Any]:
+        """
+        Poll the status endpoint until the export completed and return its manifest. The server's
+        Retry-After is honoured; without it the interval doubles up to max_poll_interval.
+        """
+        interval = self.poll_interval
+        started = time.monotonic()
+        while True:
+            response = self.session.get(status_url, headers={**self.headers, "Accept": "application/json"})
+            if response.status_code == 200:
+                manifest = response.json()
+                n_files = len(manifest.get("output", []))
+                logger.info(
+                    f"Bulk export complete: {n_files} files, {len(manifest.get('error', []))} error files"
+                )
+                return manifest
+            if response.status_code != 202:
+                raise ValueError(f"Bulk export failed: {response.status_code} {response.text[:500]}")
+            if self.timeout is not None and time.monotonic() - started > self.timeout:
+                raise TimeoutError(f"Bulk export at {status_url} not complete after {self.timeout}s")
+            delay = retry_after_seconds(response.headers.get("Retry-After"), interval)
+            progress = response.headers.get("X-Progress", "no progress")
+            logger.info(f"Bulk export in progress ({progress}), polling in {delay:.1f}s")
+            time.sleep(delay)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def export(self, types: Optional[List[str]] = None, since: Optional[str] = None) -> Dict[str, Any]:
+        return self.wait(self.kick_off(types=types, since=since))
+
+    def _file_headers(self, manifest: Dict[str, Any]) -> Dict[str, str]:
+        headers = {"Accept": NDJSON}
+        # Output files may live on a separate storage server that must not receive the token
+        if manifest.get("requiresAccessToken", True):
+            headers = {**self.headers, **headers}
+        return headers
+
+    @staticmethod
+    def _put(lines: queue.Queue, item: Any, stop: threading.Event) -> None:
+        while not stop.is_set():
+            try:
+                lines.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError("Bulk export download cancelled")
+
+    def _download(self, url: str, headers: Dict[str, str], lines: queue.Queue, stop: threading.Event) -> None:
+        # Runs in a worker thread; the session and connection are released once the file is read,
+        # fails or the consumer stops (_put raises)
+        with self.session_factory() as session, session.get(url, headers=headers, stream=True) as response:
+            if response.status_code != 200:
+                raise ValueError(f"Failed to download {url}: {response.status_code}")
+            buffer = b""
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                with self._n_bytes_lock:
+                    self.n_bytes += len(chunk)
+                complete, buffer = split_lines(buffer, chunk)
+                if complete:
+                    # Blocks while the parser is QUEUE_BATCHES batches behind
+                    self._put(lines, (url, complete), stop)
+            if buffer.strip():
+                self._put(lines, (url, [buffer]), stop)
+
+    async def _fetch(
+        self, entry, headers, lines: queue.Queue, semaphore: asyncio.Semaphore, stop: threading.Event
+    ) -> None:
+        async with semaphore:
+            await asyncio.to_thread(self._download, entry["url"], headers, lines, stop)
+            logger.info(f"Downloaded {entry['url']}")
+
+    async def _fetch_all(self, entries, headers, lines: queue.Queue, stop: threading.Event) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self._fetch(entry, headers, lines, semaphore, stop) for entry in entries])
+
+    def iter_resources(
+        self, manifest: Dict[str, Any], types: Optional[List[str]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Download the output files of a manifest (only those of types, if given) concurrently and
+        yield their resources as their lines arrive. Files of different types interleave, but the
+        resources of one file keep their order.
+        """
+        entries = [e for e in manifest.get("output", []) if types is None or e.get("type") in types]
+        for entry in manifest.get("error", []):
+            logger.warning(f"Bulk export reported errors in {entry.get('url')}")
+        headers = self._file_headers(manifest)
+        lines: queue.Queue = queue.Queue(maxsize=QUEUE_BATCHES)
+        # Set when the consumer stops early, so the downloads do not block on a full queue forever
+        stop = threading.Event()
+
+        def run():
+            try:
+                asyncio.run(self._fetch_all(entries, headers, lines, stop))
+                item = _DONE
+            except BaseException as e:
+                item = e
+            try:
+                self._put(lines, item, stop)
+            except RuntimeError:
+                pass
+
+        downloader = threading.Thread(target=run, name="bulk-export-download", daemon=True)
+        downloader.start()
+        try:
+            while True:
+                item = lines.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise ValueError("Bulk export download failed") from item
+                url, batch = item
+                for line in batch:
+                    if not line.strip():
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except ValueError as e:
+                        logger.warning(f"Failed to parse line in {url}: {e}")
+                        continue
+                    yield from expand_bundle(data)
+        finally:
+            stop.set()
+            downloader.join()
+
+
+def load_bulk_export_by_type(
+    client: BulkExportClient,
+    event_config: Dict[str, Any],
+    manifest: Dict[str, Any],
+    types: Optional[List[str]] = None,
+    governor: Optional[Any] = None,
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Group the resources of an export by type, keeping the types of the event config (like
+    fhir_parser.load_fhir_resources_by_type does for files, including its memory checks).
+    """
+    resource_types = set(event_config["resources"])
+    resources: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for n_read, data in enumerate(client.iter_resources(manifest, types=types), 1):
+        if governor is not None and n_read % MEMORY_CHECK_EVERY == 0:
+            governor.check("Loading the bulk export")
+        if isinstance(data, dict) and data.get("resourceType") in resource_types:
+            resources[data["resourceType"]].append(data)
+    logger.info(
+        f"Loaded {sum(map(len, resources.values()))} resources ({client.n_bytes} bytes) from the bulk export"
+    )
+    return resources
+
+
+def with_patients(types: Optional[List[str]]) -> Optional[List[str]]:
+    """
+    _type of an export of types: the patient map needs the Patient resources even if they are not
+    converted themselves.
+
+    Examples:
+        >>> with_patients(["Observation"]), with_patients(["Patient", "Condition"]), with_patients(None)
+        (['Observation', 'Patient'], ['Patient', 'Condition'], None)
+    """
+    if types is None or PATIENT in types:
+        return types
+    return [*types, PATIENT]
+
+
+def export_patient_map(
+    client: BulkExportClient, manifest: Dict[str, Any], patients: Optional[List[Dict[str, Any]]] = None
+) -> Dict[str, int]:
+    """
+    Patient UUID to integer id map of all Patient files of an export manifest, built from patients
+    if they were loaded already. Sharded workers download every Patient file, not only their share,
+    since their resources may reference any patient.
+
+    Raises:
+        ValueError: If the export holds no Patient with an integer identifier, which would leave the
+            subject_id of every event unresolved (and the events dropped when writing).
+    """
+    if patients is None:
+        patients = client.iter_resources(manifest, types=[PATIENT])
+    uuid_to_int = patient_id_map_from_resources(patients)
+    if not uuid_to_int:
+        raise ValueError("The bulk export holds no Patient resources with an integer identifier/patient")
+    return uuid_to_int
@@ -0,0 +1,261 @@
+"""
+catalog.py
+----------
+Pre-scan index of the FHIR input: for every file its resource type, line count and line-aligned
+chunk offsets, plus parse timings sampled from its first lines. Lines are counted with bytes.count
+over large binary blocks (memchr speed) without decoding any JSON, and the catalog is cached as a
+JSON manifest keyed by file size and mtime so unchanged files are never scanned twice.
+The catalog drives type skipping, work balancing across workers, progress/ETA reporting and the
+dry-run planner.
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from .event_conversion import build_event
+from .fhir_parser import is_subject_associated, iter_file_resources, list_fhir_files
+
+CATALOG_VERSION = 2
+DEFAULT_CHUNK_BYTES = 64 << 20
+BLOCK_SIZE = 8 << 20
+# Rough size of one MEDS event in a compressed Parquet shard, used by the dry-run planner
+BYTES_PER_EVENT = 20
+
+
+def count_lines_and_offsets(fpath: str, chunk_bytes: int = DEFAULT_CHUNK_BYTES, block_size: int = BLOCK_SIZE):
+    """
+    Count the lines of a file and find the offsets of line-aligned chunks of about chunk_bytes.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile("w", suffix=".ndjson", delete=False) as f:
+        ...     _ = f.write("aaaa\\nbb\\ncccccc\\nd")
+        >>> count_lines_and_offsets(f.name, chunk_bytes=4, block_size=3)
+        (4, [0, 5, 15])
+        >>> os.remove(f.name)
+    """
+    n_lines = 0
+    offsets = [0]
+    next_boundary = chunk_bytes
+    pos = 0
+    last = b"\n"
+    with open(fpath, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            n_lines += block.count(b"\n")
+            while next_boundary < pos + len(block):
+                i = block.find(b"\n", max(next_boundary - pos, 0))
+                if i == -1:
+                    # The chunk boundary falls at the first newline of a later block
+                    next_boundary = pos + len(block)
+                    break
+                offsets.append(pos + i + 1)
+                next_boundary = pos + i + 1 + chunk_bytes
+            pos += len(block)
+            last = block[-1:]
+    if last != b"\n":
+        n_lines += 1
+    if offsets[-1] >= pos and len(offsets) > 1:
+        offsets.pop()
+    return n_lines, offsets
+
+
+def scan_file(fpath: str, chunk_bytes: int = DEFAULT_CHUNK_BYTES, sample_lines: int = 100) -> Dict[str, Any]:
+    """
+    Build the catalog entry of one file.
+    The first sample_lines resources are decoded to determine the resource type(s), the share of
+    subject-associated resources and the average parse time and size per resource. NDJSON files hold
+    a single resource type; other JSON files (Bundles) only get a resource_type if the sample covered
+    the whole file, since later entries may be of any type.
+    """
+    stat = os.stat(fpath)
+    n_lines, offsets = count_lines_and_offsets(fpath, chunk_bytes=chunk_bytes)
+    types: Dict[str, int] = {}
+    n_sampled = 0
+    n_subject = 0
+    sample_bytes = 0
+    fully_sampled = True
+    start = time.perf_counter()
+    for resource in iter_file_resources(fpath):
+        if not isinstance(resource, dict):
+            continue
+        rtype = resource.get("resourceType")
+        types[rtype] = types.get(rtype, 0) + 1
+        n_subject += is_subject_associated(resource)
+        sample_bytes += len(json.dumps(resource))
+        n_sampled += 1
+        if n_sampled >= sample_lines:
+            fully_sampled = False
+            break
+    elapsed = time.perf_counter() - start
+    single_type = fpath.endswith(".ndjson")
+    if fpath.endswith(".ndjson"):
+        n_resources = n_lines
+    elif fully_sampled:
+        n_resources = n_sampled
+    else:
+        # Bundles and pretty-printed JSON: estimate from the average resource size
+        n_resources = round(stat.st_size / (sample_bytes / n_sampled)) if n_sampled else 0
+    return {
+        "path": fpath,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "resource_type": next(iter(types)) if len(types) == 1 and (single_type or fully_sampled) else None,
+        "sampled_types": types,
+        "n_lines": n_lines,
+        "n_resources": n_resources,
+        "chunk_offsets": offsets,
+        "subject_fraction": n_subject / n_sampled if n_sampled else 0.0,
+        "parse_seconds_per_resource": elapsed / n_sampled if n_sampled else 0.0,
+    }
+
+
+def load_manifest(manifest_path: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    if not manifest_path or not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable catalog manifest {manifest_path}: {e}")
+        return {}
+    if manifest.get("version") != CATALOG_VERSION:
+        return {}
+    return {entry["path"]: entry for entry in manifest.get("files", [])}
+
+
+def build_catalog(
+    fhir_dir: str,
+    manifest_path: Optional[str] = None,
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+    sample_lines: int = 100,
+) -> List[Dict[str, Any]]:
+    """
+    Catalog all input files of fhir_dir. Entries cached in manifest_path are reused when the
+    file's size and mtime did not change; the manifest is rewritten with the current catalog.
+    """
+    cached = load_manifest(manifest_path)
+    catalog = []
+    n_scanned = 0
+    for fpath in list_fhir_files(fhir_dir):
+        stat = os.stat(fpath)
+        entry = cached.get(fpath)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = scan_file(fpath, chunk_bytes=chunk_bytes, sample_lines=sample_lines)
+            n_scanned += 1
+        catalog.append(entry)
+    logging.info(f"Catalogued {len(catalog)} files ({n_scanned} scanned, {len(catalog) - n_scanned} cached)")
+    if manifest_path:
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+        with open(manifest_path, "w") as f:
+            json.dump({"version": CATALOG_VERSION, "files": catalog}, f)
+    return catalog
+
+
+def select_files(catalog: List[Dict[str, Any]], resource_types) -> List[str]:
+    """
+    Files that may hold any of resource_types; files of a single other type are skipped.
+    """
+    resource_types = set(resource_types)
+    return [e["path"] for e in catalog if e["resource_type"] is None or e["resource_type"] in resource_types]
+
+
+def file_weights(catalog: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Work estimate per file (resources, or bytes when unknown), e.g. for sharding.partition_files.
+    """
+    return {e["path"]: e["n_resources"] or e["size"] for e in catalog}
+
+
+def plan(
+    catalog: List[Dict[str, Any]], event_config: Dict[str, Any], sample_lines: int = 20
+) -> Dict[str, Any]:
+    """
+    Dry-run estimate of the number of events, output size and runtime of a conversion.
+    Mapping cost is measured with build_event on the first sample_lines resources of each file.
+    """
+    resource_types = set(event_config["resources"])
+    per_type: Dict[str, Dict[str, float]] = {}
+    total_seconds = 0.0
+    for entry in catalog:
+        rtype = entry["resource_type"]
+        if rtype is not None and rtype not in resource_types:
+            continue
+        map_seconds = _sample_map_seconds(entry["path"], event_config, sample_lines)
+        events = entry["n_resources"] * entry["subject_fraction"]
+        seconds = entry["n_resources"] * entry["parse_seconds_per_resource"] + events * map_seconds
+        stats = per_type.setdefault(
+            rtype or "mixed", {"files": 0, "resources": 0, "events": 0.0, "seconds": 0.0}
+        )
+        stats["files"] += 1
+        stats["resources"] += entry["n_resources"]
+        stats["events"] += events
+        stats["seconds"] += seconds
+        total_seconds += seconds
+    n_events = sum(s["events"] for s in per_type.values())
+    return {
+        "files": sum(s["files"] for s in per_type.values()),
+        "skipped_files": len(catalog) - sum(s["files"] for s in per_type.values()),
+        "input_bytes": sum(e["size"] for e in catalog),
+        "estimated_events": int(n_events),
+        "estimated_output_bytes": int(n_events * BYTES_PER_EVENT),
+        "estimated_seconds": total_seconds,
+        "by_type": per_type,
+    }
+
+
+def _sample_map_seconds(fpath, event_config, sample_lines):
+    resources = []
+    for resource in iter_file_resources(fpath):
+        if isinstance(resource, dict) and is_subject_associated(resource):
+            resources.append(resource)
+        if len(resources) >= sample_lines:
+            break
+    if not resources:
+        return 0.0
+    start = time.perf_counter()
+    for res in resources:
+        config = dict(event_config.get(res["resourceType"], event_config["default"]))
+        build_event(res, config, {}, event_config["default"])
+    return (time.perf_counter() - start) / len(resources)
+
+
+def format_plan(estimate: Dict[str, Any]) -> str:
+    lines = [
+        f"Input: {estimate['files']} files to convert ({estimate['skipped_files']} skipped), "
+        f"{estimate['input_bytes'] / 1e6:.1f} MB",
+        f"Estimated events: {estimate['estimated_events']}",
+        f"Estimated output size: {estimate['estimated_output_bytes'] / 1e6:.1f} MB",
+        f"Estimated runtime: {estimate['estimated_seconds']:.1f} s (single process)",
+    ]
+    for rtype, stats in sorted(estimate["by_type"].items(), key=lambda kv: -kv[1]["seconds"]):
+        lines.append(
+            f"  {rtype}: {stats['files']} files, {stats['resources']} resources, "
+            f"~{int(stats['events'])} events, ~{stats['seconds']:.1f} s"
+        )
+    return "\n".join(lines)
+
+
+class CatalogProgress:
+    """
+    Progress callback for load_fhir_resources_by_type that logs resources done and an ETA.
+    """
+
+    def __init__(self, catalog: List[Dict[str, Any]], files: Optional[List[str]] = None):
+        self.sizes = {e["path"]: e["n_resources"] for e in catalog}
+        if files is not None:
+            self.sizes = {f: self.sizes.get(f, 0) for f in files}
+        self.total = sum(self.sizes.values())
+        self.done = 0
+        self.start = time.perf_counter()
+
+    def __call__(self, fpath: str) -> None:
+        self.done += self.sizes.get(fpath, 0)
+        elapsed = time.perf_counter() - self.start
+        eta = elapsed / self.done * (self.total - self.done) if self.done else float("nan")
+        logging.info(f"Parsed {self.done}/{self.total} resources ({elapsed:.1f}s elapsed, ETA {eta:.1f}s)")
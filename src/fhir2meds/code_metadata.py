@@ -0,0 +1,225 @@
+"""
+code_metadata.py
+----------------
+Descriptions and parent codes for metadata/codes.parquet, gathered while mapping instead of by
+another scan of the raw FHIR data. For every emitted code the coding's system, code and display are
+recorded (the display path is derived from the code expression of the event config, e.g.
+code[coding][0][code] -> code[coding][0][display]), in a dictionary bounded to max_codes entries.
+CodeSystem and ConceptMap resources in the input are indexed for authoritative displays, the
+concept hierarchy and mapped codes, which become parent codes.
+"""
+
+import logging
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .event_conversion import extract_path, extract_vocab
+
+DEFAULT_MAX_CODES = 1_000_000
+CODE_SEGMENT = re.compile(r"^(.*[.\[])code(\]?)$")
+
+
+def coding_paths(config: Dict[str, Any]) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Paths of the system, code and display of the coding a code expression reads from.
+
+    Examples:
+        >>> code = ["const(resourceType)", "vocab(code[coding][0][system])", "col(code[coding][0][code])"]
+        >>> coding_paths({"code": code})
+        ('code[coding][0][system]', 'code[coding][0][code]', 'code[coding][0][display]')
+        >>> coding_paths({"code": ["const(MEDS_BIRTH)"]})
+        (None, None, None)
+    """
+    system_path = code_path = display_path = None
+    exprs = config.get("code")
+    for expr in exprs if isinstance(exprs, list) else []:
+        if expr.startswith("vocab("):
+            system_path = expr[6:-1]
+        elif expr.startswith("col("):
+            code_path = expr[4:-1]
+    match = CODE_SEGMENT.match(code_path) if code_path else None
+    if match:
+        display_path = f"{match.group(1)}display{match.group(2)}"
+    return system_path, code_path, display_path
+
+
+class CodeMetadata:
+    """
+    Bounded collection of (system, code, display) per emitted MEDS code, plus terminology indexed
+    from CodeSystem and ConceptMap resources.
+    """
+
+    def __init__(self, max_codes: int = DEFAULT_MAX_CODES):
+        self.max_codes = max_codes
+        # MEDS code -> (system url, source code, display)
+        self.codes: Dict[str, Tuple[Optional[str], Optional[str], Optional[str]]] = {}
+        self.n_overflow = 0
+        # (system url, source code) -> display / parent source codes / mapped (system url, code) targets
+        self.displays: Dict[Tuple[str, str], str] = {}
+        self.parents: Dict[Tuple[str, str], List[str]] = {}
+        self.mappings: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+        self._paths: Dict[Tuple[str, Any], Tuple[Optional[str], Optional[str], Optional[str]]] = {}
+
+    def observe(self, resource: Dict[str, Any], config: Dict[str, Any], event: Dict[str, Any]) -> None:
+        """
+        Record the coding behind an event's code, unless that code already has a display.
+        The coding paths are derived from config once per resource type.
+        """
+        code = event.get("code")
+        if not self._wants(code):
+            return
+        # Fan-out elements of a type read their codings from different paths (component[0], ...)
+        exprs = config.get("code")
+        key = (resource.get("resourceType"), tuple(exprs) if isinstance(exprs, list) else exprs)
+        paths = self._paths.get(key)
+        if paths is None:
+            paths = self._paths[key] = coding_paths(config)
+        system_path, code_path, display_path = paths
+        system = extract_path(resource, system_path) if system_path else None
+        value = extract_path(resource, code_path) if code_path else None
+        display = extract_path(resource, display_path) if display_path else None
+        self.observe_coding(code, system, value, display)
+
+    def observe_coding(self, code: Optional[str], system: Any, value: Any, display: Any) -> None:
+        """
+        Record the (system, code, display) of a coding extracted elsewhere, e.g. columnar.
+        """
+        if not self._wants(code):
+            return
+        self.codes[code] = (
+            system if isinstance(system, str) else None,
+            str(value) if value is not None else None,
+            display if isinstance(display, str) else None,
+        )
+
+    def _wants(self, code: Optional[str]) -> bool:
+        if not code or (code in self.codes and self.codes[code][2] is not None):
+            return False
+        if code not in self.codes and len(self.codes) >= self.max_codes:
+            self.n_overflow += 1
+            return False
+        return True
+
+    def index_terminology(self, resources: Iterable[Dict[str, Any]]) -> None:
+        """
+        Index concept displays and hierarchy of CodeSystems and the element mappings of ConceptMaps.
+        """
+        for res in resources:
+            if res.get("resourceType") == "CodeSystem" and res.get("url"):
+                self._index_concepts(res["url"], res.get("concept") or [], None)
+            elif res.get("resourceType") == "ConceptMap":
+                for group in res.get("group") or []:
+                    source, target = group.get("source"), group.get("target")
+                    for element in group.get("element") or []:
+                        if not source or not element.get("code"):
+                            continue
+                        key = (source, str(element["code"]))
+                        if element.get("display"):
+                            self.displays.setdefault(key, element["display"])
+                        for t in element.get("target") or []:
+                            if t.get("code") and t.get("equivalence", t.get("relationship")) != "unmatched":
+                                self.mappings.setdefault(key, []).append((target or "", str(t["code"])))
+
+    def _index_concepts(self, system: str, concepts: List[Dict[str, Any]], parent: Optional[str]) -> None:
+        for concept in concepts:
+            if not concept.get("code"):
+                continue
+            key = (system, str(concept["code"]))
+            if concept.get("display"):
+                self.displays[key] = concept["display"]
+            parents = [parent] if parent else []
+            for prop in concept.get("property") or []:
+                if prop.get("code") in ("parent", "subsumedBy") and prop.get("valueCode"):
+                    parents.append(prop["valueCode"])
+            if parents:
+                known = self.parents.setdefault(key, [])
+                known.extend(p for p in parents if p not in known)
+            self._index_concepts(system, concept.get("concept") or [], concept["code"])
+
+    def update(self, other: "CodeMetadata") -> None:
+        """
+        Merge the observations of another collection (e.g. from a worker process).
+        """
+        for code, entry in other.codes.items():
+            if code not in self.codes and len(self.codes) >= self.max_codes:
+                self.n_overflow += 1
+            elif code not in self.codes or (self.codes[code][2] is None and entry[2] is not None):
+                self.codes[code] = entry
+        self.n_overflow += other.n_overflow
+        for attr in ("displays", "parents", "mappings"):
+            for key, value in getattr(other, attr).items():
+                getattr(self, attr).setdefault(key, value)
+
+    def to_records(self) -> List[Dict[str, Optional[str]]]:
+        return [
+            {"code": code, "system": system, "source_code": value, "display": display}
+            for code, (system, value, display) in self.codes.items()
+        ]
+
+    def update_from_records(self, records: Iterable[Dict[str, Optional[str]]]) -> None:
+        other = CodeMetadata(self.max_codes)
+        other.codes = {r["code"]: (r["system"], r["source_code"], r["display"]) for r in records}
+        self.update(other)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        JSON-serializable form of the observations and indexed terminology (see from_dict).
+        """
+        return {
+            "codes": self.to_records(),
+            "n_overflow": self.n_overflow,
+            "displays": [[*key, display] for key, display in self.displays.items()],
+            "parents": [[*key, parents] for key, parents in self.parents.items()],
+            "mappings": [[*key, [list(t) for t in targets]] for key, targets in self.mappings.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], max_codes: int = DEFAULT_MAX_CODES) -> "CodeMetadata":
+        """
+        Examples:
+            >>> metadata = CodeMetadata()
+            >>> metadata.index_terminology([{"resourceType": "CodeSystem", "url": "s", "concept": [
+            ...     {"code": "1", "display": "one", "concept": [{"code": "11"}]}]}])
+            >>> metadata.observe_coding("X//11", "s", "11", None)
+            >>> CodeMetadata.from_dict(metadata.to_dict()).describe("X//11")
+            (None, ['X//1'])
+            >>> CodeMetadata.from_dict(metadata.to_dict()).displays[("s", "1")]
+            'one'
+        """
+        metadata = cls(max_codes)
+        metadata.update_from_records(data["codes"])
+        metadata.n_overflow += data["n_overflow"]
+        metadata.displays = {(system, code): display for system, code, display in data["displays"]}
+        metadata.parents = {(system, code): parents for system, code, parents in data["parents"]}
+        metadata.mappings = {
+            (system, code): [tuple(t) for t in targets] for system, code, targets in data["mappings"]
+        }
+        return metadata
+
+    def describe(self, code: str) -> Tuple[Optional[str], List[str]]:
+        """
+        Description and parent codes of a MEDS code. Parents from the CodeSystem hierarchy keep the
+        code's prefix (e.g. Condition//ICD9//), mapped codes are named {VOCAB}//{code}.
+        """
+        system, value, display = self.codes.get(code, (None, None, None))
+        if system is None or value is None:
+            return display, []
+        key = (system, value)
+        description = self.displays.get(key, display)
+        prefix = code[: -len(value)] if code.endswith(value) else f"{extract_vocab(system)}//"
+        parents = [f"{prefix}{parent}" for parent in self.parents.get(key, [])]
+        parents += [
+            f"{extract_vocab(target)}//{target_code}" for target, target_code in self.mappings.get(key, [])
+        ]
+        return description, parents
+
+    def log(self) -> None:
+        described = sum(1 for entry in self.codes.values() if entry[2] is not None)
+        logging.info(
+            f"Code metadata: {len(self.codes)} codes ({described} with display), "
+            f"{len(self.displays)} indexed concepts, {len(self.mappings)} mapped concepts"
+        )
+        if self.n_overflow:
+            logging.warning(
+                f"Code metadata limit of {self.max_codes} codes reached for {self.n_overflow} events"
+            )
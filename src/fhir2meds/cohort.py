@@ -0,0 +1,153 @@
+"""
+cohort.py
+---------
+Pushdown filters for converting a study cohort: a subject allowlist and a time window.
+The allowlist is checked twice while loading: a byte-level prefilter drops NDJSON lines whose
+Patient references all point outside the cohort before they are decoded, and the exact check runs
+on the subject reference of every decoded resource. The time window is checked in build_event
+right after the time of an event is extracted, before the rest of the event is built.
+"""
+
+import hashlib
+import logging
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .fhir_parser import get_subject_reference
+
+PATIENT_REF_PATTERN = re.compile(rb'"Patient/([^"/]+)')
+TIME_OFFSET_PATTERN = re.compile(r"(Z|[+-][0-9]{2}:[0-9]{2})$")
+
+TimeWindow = Tuple[Optional[str], Optional[str]]
+
+
+class Cohort:
+    """
+    Allowlist of Patient UUIDs.
+    """
+
+    def __init__(self, uuids: Iterable[str]):
+        self.uuids = set(uuids)
+        self._uuid_bytes = {uuid.encode() for uuid in self.uuids}
+
+    def __len__(self) -> int:
+        return len(self.uuids)
+
+    def may_contain(self, line: bytes) -> bool:
+        """
+        Byte-level prefilter of a raw NDJSON line: False only if the line references Patients and
+        none of them is in the cohort. Lines without Patient references (Patient resources
+        themselves, terminology) are left to the exact check.
+
+        Examples:
+            >>> cohort = Cohort(["a"])
+            >>> cohort.may_contain(b'{"subject": {"reference": "Patient/a"}}')
+            True
+            >>> cohort.may_contain(b'{"subject": {"reference": "Patient/b"}}')
+            False
+            >>> cohort.may_contain(b'{"resourceType": "Patient", "id": "b"}')
+            True
+        """
+        refs = PATIENT_REF_PATTERN.findall(line)
+        return not refs or any(ref in self._uuid_bytes for ref in refs)
+
+    def keep(self, resource: Any) -> bool:
+        """
+        Exact check on the subject reference of a decoded resource; resources without one are kept.
+        """
+        uuid = get_subject_reference(resource)
+        return uuid is None or uuid in self.uuids
+
+    def fingerprint(self) -> str:
+        return hashlib.blake2b("\n".join(sorted(self.uuids)).encode(), digest_size=16).hexdigest()
+
+
+def read_cohort_ids(path: str) -> List[str]:
+    """
+    Read the ids of a cohort file: one Patient UUID or integer subject id per line, or the first
+    column of a CSV file. Empty lines and # comments are ignored.
+    """
+    ids = []
+    with open(path) as f:
+        for line in f:
+            value = line.split("#", 1)[0].split(",", 1)[0].strip().strip('"')
+            if value:
+                ids.append(value)
+    return ids
+
+
+def load_cohort(path: str, uuid_to_int: Dict[str, int]) -> Cohort:
+    """
+    Load a cohort file, resolving integer subject ids to Patient UUIDs through uuid_to_int.
+    """
+    subject_to_uuid = {str(subject_id): uuid for uuid, subject_id in uuid_to_int.items()}
+    uuids = []
+    unresolved = 0
+    for value in read_cohort_ids(path):
+        if value in uuid_to_int:
+            uuids.append(value)
+        elif value in subject_to_uuid:
+            uuids.append(subject_to_uuid[value])
+        else:
+            # Possibly a UUID of a Patient that is not in the input
+            unresolved += 1
+            uuids.append(value)
+    cohort = Cohort(uuids)
+    logging.info(f"Cohort of {len(cohort)} subjects from {path}, {unresolved} not found among the patients")
+    return cohort
+
+
+def filter_cohort(resources_by_type: Dict[str, List[Any]], cohort: Optional[Cohort]) -> Dict[str, List[Any]]:
+    if cohort is None:
+        return resources_by_type
+    return {
+        rtype: [res for res in resources if cohort.keep(res)]
+        for rtype, resources in resources_by_type.items()
+    }
+
+
+def normalize_time(value: Any) -> str:
+    """
+    Time value as the naive ISO string the MEDS time column is parsed from (the UTC offset is
+    dropped like meds_writer.robust_cast_time_column does), so windows compare like the output.
+
+    Examples:
+        >>> normalize_time("2180-07-23T12:35:00-04:00")
+        '2180-07-23T12:35:00'
+        >>> normalize_time("2180-07-23")
+        '2180-07-23'
+    """
+    return TIME_OFFSET_PATTERN.sub("", str(value).strip())
+
+
+def make_time_window(start: Any = None, end: Any = None) -> Optional[TimeWindow]:
+    """
+    Window [start, end) of ISO dates or datetimes, None if neither bound is set.
+    """
+    if start is None and end is None:
+        return None
+    start = normalize_time(start) if start is not None else None
+    end = normalize_time(end) if end is not None else None
+    if start is not None and end is not None and start >= end:
+        raise ValueError(f"time_window_start {start} must be before time_window_end {end}")
+    return start, end
+
+
+def in_time_window(value: Any, window: Optional[TimeWindow]) -> bool:
+    """
+    Whether an event time is within window. ISO strings of the same calendar order compare
+    lexicographically, a date counts as its midnight. Events without a time are always kept.
+
+    Examples:
+        >>> window = make_time_window("2180-01-01", "2181-01-01")
+        >>> times = ["2179-12-31T23:59:59", "2180-01-01", "2180-12-31T23:00:00Z", "2181-01-01T00:00:00", None]
+        >>> [in_time_window(t, window) for t in times]
+        [False, True, True, False, True]
+    """
+    if window is None or value is None or value == "":
+        return True
+    if hasattr(value, "isoformat"):
+        value = value.isoformat()
+    value = normalize_time(value)
+    start, end = window
+    return (start is None or value >= start) and (end is None or value < end)
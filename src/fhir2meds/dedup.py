@@ -0,0 +1,105 @@
+"""
+dedup.py
+--------
+Removal of duplicate resources, e.g. from overlapping incremental exports or several versions of a
+resource. Resources are identified by (resourceType, id) and the latest version is kept, by
+meta.lastUpdated, then meta.versionId, then position in the input.
+Duplicates are found without holding every id in a Python set: keys are hashed to 64 bits in
+vectorized chunks (8 bytes per resource in one Arrow buffer) and only resources whose hash occurs
+more than once become candidates, which are then confirmed exactly on their full keys.
+"""
+
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import polars as pl
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def resource_key(resource: Any) -> Optional[str]:
+    """
+    Identity of a resource as "resourceType/id", or None for resources without an id.
+    """
+    if not isinstance(resource, dict) or not resource.get("id"):
+        return None
+    return f"{resource.get('resourceType')}/{resource['id']}"
+
+
+def _parse_instant(value: Any) -> float:
+    if not isinstance(value, str):
+        return float("-inf")
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return float("-inf")
+    if parsed.tzinfo is None:
+        return (parsed - datetime(1970, 1, 1)).total_seconds()
+    return parsed.timestamp()
+
+
+def version_order(resource: Dict[str, Any]) -> Tuple[float, int, str]:
+    """
+    Sort key of a resource's version: meta.lastUpdated first, then a numeric or textual meta.versionId.
+
+    Examples:
+        >>> old = {"meta": {"versionId": "2", "lastUpdated": "2024-01-01T00:00:00Z"}}
+        >>> new = {"meta": {"versionId": "10", "lastUpdated": "2024-01-01T00:00:00Z"}}
+        >>> version_order(new) > version_order(old)
+        True
+    """
+    meta = resource.get("meta") or {}
+    version = str(meta.get("versionId") or "")
+    return _parse_instant(meta.get("lastUpdated")), int(version) if version.isdigit() else -1, version
+
+
+def duplicate_candidates(resources: List[Any], chunk_size: int = HASH_CHUNK_SIZE) -> List[int]:
+    """
+    Positions of resources whose key hash occurs more than once: all true duplicates plus the rare
+    64-bit hash collisions. Keys are materialized chunk by chunk, only their hashes are kept.
+
+    Examples:
+        >>> resources = [{"resourceType": "Patient", "id": i} for i in ["a", "b", "a", None]]
+        >>> duplicate_candidates(resources, chunk_size=2)
+        [0, 2]
+    """
+    hashes = []
+    for start in range(0, len(resources), chunk_size):
+        keys = pl.Series(
+            [resource_key(res) for res in resources[start : start + chunk_size]], dtype=pl.String
+        )
+        # Resources without an id get a null hash and are never candidates
+        frame = pl.DataFrame({"key": keys})
+        hashes.append(
+            frame.select(pl.when(pl.col("key").is_not_null()).then(pl.col("key").hash())).to_series()
+        )
+    if not hashes:
+        return []
+    hashes = pl.concat(hashes)
+    return (hashes.is_duplicated() & hashes.is_not_null()).arg_true().to_list()
+
+
+def deduplicate_resources(resources_by_type: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+    """
+    Keep only the latest version of every (resourceType, id), preserving the order of the input.
+    Later occurrences win ties, so an incremental export loaded after the initial one overrides it.
+    """
+    deduplicated = {}
+    for rtype, resources in resources_by_type.items():
+        candidates = duplicate_candidates(resources)
+        if not candidates:
+            deduplicated[rtype] = resources
+            continue
+        # Exact confirmation on the full keys of the candidates: position of the latest version
+        latest: Dict[str, Tuple[Tuple[float, int, str], int]] = {}
+        for i in candidates:
+            order = (version_order(resources[i]), i)
+            key = resource_key(resources[i])
+            if key not in latest or order >= latest[key]:
+                latest[key] = order
+        keep = {order[1] for order in latest.values()}
+        drop = {i for i in candidates if i not in keep}
+        deduplicated[rtype] = [res for i, res in enumerate(resources) if i not in drop]
+        logging.info(f"Removed {len(drop)} duplicate {rtype} resources ({len(candidates)} candidates)")
+    return deduplicated
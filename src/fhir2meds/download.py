@@ -1,14 +1,29 @@
+import json
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, Optional
 from urllib.parse import urljoin, urlparse
 
 import requests
 from bs4 import BeautifulSoup
 from omegaconf import DictConfig
 
+from .manifest import file_sha256
+
 logger = logging.getLogger(__name__)
 
+# Checksum list published next to the dataset files (e.g. on PhysioNet)
+CHECKSUM_FILE = "SHA256SUMS.txt"
+# Files already verified against it, so later runs neither download nor hash them again
+# (not .json, which the parser would read as FHIR)
+VERIFIED_FILE = "SHA256SUMS.verified"
+CHECKSUM_LINE = re.compile(r"^([0-9a-fA-F]{64})\s+\*?(.+)$")
+VERIFY_WORKERS = 4
+MAX_RETRIES = 2
+
 
 class MockResponse:  # pragma: no cover
     """A mock requests.Response objects for tests."""
@@ -58,12 +73,146 @@ class MockSession:  # pragma: no cover
             if url in self.return_contents:
                 contents = self.return_contents[url]
             else:
-                status = 404
+                status, contents = 404, ""
         else:
             contents = self.return_contents
         return MockResponse(status_code=status, contents=contents)
 
 
+def download_path(url: str, output_dir: Path) -> Path:
+    """Local path download_file writes url to.
+
+    Examples:
+        >>> download_path("http://example.com/data/foo.csv", Path("out")).as_posix()
+        'out/foo.csv'
+        >>> download_path("http://example.com", Path("out")).as_posix()
+        'out/index.html'
+    """
+    return Path(output_dir) / (os.path.basename(urlparse(url).path) or "index.html")
+
+
+def parse_checksums(text: str, base_url: str) -> Dict[str, str]:
+    """Parse a sha256sum listing into {file URL: hex digest}, resolving paths against base_url.
+
+    Examples:
+        >>> text = "ab" * 32 + "  mimic-fhir/Patient.ndjson.gz\\n" + "CD" * 32 + " *LICENSE.txt\\n"
+        >>> text += "not a checksum\\n"
+        >>> for url, digest in parse_checksums(text, "http://example.com/files/").items():
+        ...     print(url, digest[:4])
+        http://example.com/files/mimic-fhir/Patient.ndjson.gz abab
+        http://example.com/files/LICENSE.txt cdcd
+    """
+    checksums = {}
+    for line in text.splitlines():
+        match = CHECKSUM_LINE.match(line.strip())
+        if match:
+            checksums[urljoin(base_url, match.group(2).strip())] = match.group(1).lower()
+    return checksums
+
+
+def fetch_checksums(url: str, session: requests.Session) -> Dict[str, str]:
+    """Checksums of the files below url from the CHECKSUM_FILE of its directory and the parent
+    directory (PhysioNet lists the files of a project at its root, above e.g. mimic-fhir/).
+
+    Examples:
+        >>> sums = "ab" * 32 + "  data/foo.csv\\n"
+        >>> session = MockSession(return_contents={"http://example.com/SHA256SUMS.txt": sums})
+        >>> {url: digest[:4] for url, digest in fetch_checksums("http://example.com/data/", session).items()}
+        {'http://example.com/data/foo.csv': 'abab'}
+    """
+    checksums = {}
+    for checksum_url in (urljoin(url, f"../{CHECKSUM_FILE}"), urljoin(url, CHECKSUM_FILE)):
+        try:
+            response = session.get(checksum_url)
+        except requests.exceptions.RequestException:
+            continue
+        if response.status_code == 200:
+            checksums.update(parse_checksums(response.text, checksum_url))
+    return checksums
+
+
+class ChecksumVerifier:
+    """Verifies downloaded files against their published checksums in a thread pool, so hashing
+    overlaps with the downloads that follow. finish() re-fetches files that mismatch (corrupted or
+    truncated) up to max_retries times and records the verified files in VERIFIED_FILE.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        checksums: Dict[str, str],
+        session: requests.Session,
+        max_workers: int = VERIFY_WORKERS,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.output_dir = Path(output_dir)
+        self.checksums = checksums
+        self.session = session
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.n_unlisted = 0
+        self.records = {}
+        record_path = self.output_dir / VERIFIED_FILE
+        if record_path.exists():
+            self.records = json.loads(record_path.read_text())
+
+    def _key(self, path: Path) -> str:
+        return Path(path).relative_to(self.output_dir).as_posix()
+
+    def is_verified(self, url: str, path: Path) -> bool:
+        """Whether path was verified against the checksum of url and has not changed since."""
+        record = self.records.get(self._key(path))
+        if record is None or record["sha256"] != self.checksums.get(url) or not Path(path).exists():
+            return False
+        stat = Path(path).stat()
+        return record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns
+
+    def submit(self, url: str, path: Path) -> None:
+        """Hash a downloaded file in the background (files without a published checksum are counted)."""
+        if url not in self.checksums:
+            self.n_unlisted += 1
+            return
+        self.futures.append((url, Path(path), self.executor.submit(file_sha256, str(path))))
+
+    def _record(self, url: str, path: Path) -> None:
+        stat = path.stat()
+        self.records[self._key(path)] = {
+            "sha256": self.checksums[url],
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    def finish(self) -> None:
+        """Wait for the pending hashes, re-fetch mismatching files and save the verified files.
+
+        Raises:
+            ValueError: If a file still mismatches after max_retries downloads.
+        """
+        failed = []
+        try:
+            for url, path, future in self.futures:
+                digest = future.result()
+                for attempt in range(self.max_retries + 1):
+                    if digest == self.checksums[url]:
+                        self._record(url, path)
+                        break
+                    if attempt == self.max_retries:
+                        failed.append(url)
+                        break
+                    logger.warning(f"Checksum mismatch of {path} (attempt {attempt + 1}), downloading again")
+                    download_file(url, path.parent, self.session)
+                    digest = file_sha256(str(path))
+        finally:
+            self.executor.shutdown()
+            self.futures = []
+            (self.output_dir / VERIFIED_FILE).write_text(json.dumps(self.records, indent=2, sort_keys=True))
+        if self.n_unlisted:
+            logger.info(f"{self.n_unlisted} downloaded files have no published checksum")
+        if failed:
+            raise ValueError(f"Checksum mismatch after {self.max_retries + 1} downloads: {', '.join(failed)}")
+
+
 def download_file(url: str, output_dir: Path, session: requests.Session):
     """Download a single file.
 
@@ -107,9 +256,7 @@ def download_file(url: str, output_dir: Path, session: requests.Session):
     except Exception as e:
         raise ValueError(f"Failed to download {url}") from e
 
-    parsed_url = urlparse(url)
-    filename = os.path.basename(parsed_url.path) or "index.html"
-    file_path = Path(output_dir) / filename
+    file_path = download_path(url, output_dir)
 
     with open(file_path, "wb") as file:
         for chunk in response.iter_content(chunk_size=8192):
@@ -117,13 +264,17 @@ def download_file(url: str, output_dir: Path, session: requests.Session):
     logger.info(f"Downloaded: {file_path}")
 
 
-def crawl_and_download(base_url: str, output_dir: Path, session: requests.Session):
+def crawl_and_download(
+    base_url: str, output_dir: Path, session: requests.Session, verifier: Optional[ChecksumVerifier] = None
+):
     """Recursively crawl and download files.
 
     Args:
         base_url: The base URL to crawl.
         output_dir: The directory to download the files to.
         session: The requests session to use for downloading.
+        verifier: If given, every downloaded file is handed to it for checksum verification, and
+            files it verified in an earlier run are not downloaded again.
 
     Raises:
         Various requests exceptions if downloads fail.
@@ -161,7 +312,7 @@ def crawl_and_download(base_url: str, output_dir: Path, session: requests.Sessio
     """
 
     if not base_url.endswith("/"):
-        download_file(base_url, output_dir, session)
+        fetch(base_url, output_dir, session, verifier)
 
     try:
         response = session.get(base_url)
@@ -181,12 +332,23 @@ def crawl_and_download(base_url: str, output_dir: Path, session: requests.Sessio
         if full_url.endswith("/"):  # It's a directory
             subdir = Path(output_dir) / href.strip("/")
             subdir.mkdir(parents=True, exist_ok=True)
-            crawl_and_download(full_url, subdir, session)
+            crawl_and_download(full_url, subdir, session, verifier)
         else:
             filepath = output_dir / full_url.replace(base_url, "")
             subdir = filepath.parent
             subdir.mkdir(parents=True, exist_ok=True)
-            download_file(full_url, subdir, session)
+            fetch(full_url, subdir, session, verifier)
+
+
+def fetch(url: str, output_dir: Path, session: requests.Session, verifier: Optional[ChecksumVerifier] = None):
+    """Download a file unless the verifier already verified it, and queue it for verification."""
+    path = download_path(url, output_dir)
+    if verifier is not None and verifier.is_verified(url, path):
+        logger.info(f"Already downloaded and verified: {path}")
+        return
+    download_file(url, output_dir, session)
+    if verifier is not None:
+        verifier.submit(url, path)
 
 
 def download_data(
@@ -194,6 +356,8 @@ def download_data(
     dataset_info: DictConfig,
     do_demo: bool = False,
     session_factory: callable = requests.Session,
+    verify: bool = True,
+    max_workers: int = VERIFY_WORKERS,
 ):
     """Downloads the data specified in dataset_info.dataset_urls to the output_dir.
 
@@ -202,6 +366,9 @@ def download_data(
         dataset_info: The dataset information containing the URLs to download.
         do_demo: If True, download the demo URLs instead of the main URLs.
         session_factory: A callable that returns a requests.Session object (for testing).
+        verify: If True, check the downloads against the CHECKSUM_FILE published with them (if any),
+            re-fetching mismatching files.
+        max_workers: Threads hashing downloaded files.
 
     Raises:
         ValueError: If the command fails
@@ -295,7 +462,17 @@ def download_data(
 
             url = url.url
 
+        verifier = None
+        checksums = fetch_checksums(url, session) if verify else {}
+        if checksums:
+            logger.info(f"Verifying downloads from {url} against {len(checksums)} published checksums")
+            verifier = ChecksumVerifier(Path(output_dir), checksums, session, max_workers=max_workers)
+        elif verify:
+            logger.warning(f"No {CHECKSUM_FILE} found for {url}, downloads are not verified")
+
         try:
-            crawl_and_download(url, output_dir, session)
+            crawl_and_download(url, output_dir, session, verifier)
+            if verifier is not None:
+                verifier.finish()
         except ValueError as e:
             raise ValueError(f"Failed to download data from {url}") from e
@@ -0,0 +1,429 @@
+"""
+equivalence.py
+--------------
+Differential equivalence harness of the mapping engines. Every engine maps the same resources and
+writes MEDS shards; the shards are read back and diffed row by row against the reference, which is
+event_conversion.build_event (build_events for configs with wildcard paths) per resource written by
+meds_writer.write_single_shard. A faster mapping path can only be adopted if it writes exactly the
+reference rows, so every run reports correctness and throughput together:
+
+    engine        seconds  resources/s     rows/s  speedup  result
+    reference       0.412        24271      48542     1.00  OK
+    sequential      0.201        49751      99502     2.05  OK
+    parallel        1.093         9149      18298     0.38  2 problems
+
+Rows are compared as multisets (shard order and row order are not part of the MEDS contract).
+A missing row with an unexpected row of the same (subject_id, time, code) is reported as the
+columns in which they differ. New engines are added to ENGINES as functions of
+(subject_resources, event_config, uuid_to_int, output_dir) writing output_dir/data/*.parquet.
+"""
+
+import copy
+import math
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import polars as pl
+from omegaconf import OmegaConf
+
+from .event_conversion import (
+    build_events,
+    build_patient_id_map,
+    patient_id_map_from_resources,
+)
+from .fhir_parser import (
+    filter_subject_resources_by_type,
+    iter_resources,
+    load_event_config,
+    load_fhir_resources_by_type,
+)
+from .mapping import map_events, release_events
+from .meds_writer import (
+    meds_required_columns,
+    write_meds_sharded_parquet,
+    write_single_shard,
+)
+from .memory import MemoryGovernor
+
+Engine = Callable[[Dict[str, List[Any]], Dict[str, Any], Dict[str, int], str], None]
+Input = Tuple[Dict[str, List[Any]], Dict[str, Any], Dict[str, int]]
+
+REFERENCE = "reference"
+# Rows of the key a missing and an unexpected row are paired on to report the differing columns
+ROW_KEY = ("subject_id", "time", "code")
+# Every engine writes a single shard, so the written rows do not depend on the shard size
+SHARD_SIZE = 1 << 62
+LOINC = "http://loinc.org"
+ICD9_SYSTEM = "http://mimic.mit.edu/fhir/mimic/CodeSystem/mimic-diagnosis-icd9"
+PATIENT_SYSTEM = "http://example.org/identifier/patient"
+SYNTHETIC_ROUTES = ("PO", "IV", "SC", None)
+# Nested fan-out of the synthetic MedicationRequests: one event per dose of every dosage instruction
+SYNTHETIC_DOSAGE_CONFIG = {
+    "code": ["const(resourceType)", "const(//)", "col(dosageInstruction[*][route][coding][0][code])"],
+    "time": "col(authoredOn)",
+    "numeric_value": "col(dosageInstruction[*][doseAndRate][*][doseQuantity][value])",
+    "text_value": "col(dosageInstruction[*][text])",
+}
+
+
+def reference_engine(subject_resources, event_config, uuid_to_int, output_dir) -> None:
+    """
+    Map resource by resource with build_events and write one shard with write_single_shard.
+    """
+    events = []
+    for rtype, resources in subject_resources.items():
+        config = event_config.get(rtype, event_config["default"])
+        for res in resources:
+            for event, _ in build_events(res, config, uuid_to_int, event_config["default"]):
+                if event.get("subject_id") not in (None, "", "null"):
+                    events.append(event)
+    write_single_shard(events, list(meds_required_columns()), output_dir, 0)
+
+
+def _map_events_engine(
+    mapping_workers: int = 1, batch_size: int = 5000, memory_limit: Optional[int] = None
+) -> Engine:
+    """
+    Engine of the mapping of a conversion (mapping.map_events), written like a conversion.
+    """
+
+    def engine(subject_resources, event_config, uuid_to_int, output_dir) -> None:
+        cfg = OmegaConf.create({"mapping_workers": mapping_workers, "mapping_batch_size": batch_size})
+        governor = MemoryGovernor(memory_limit) if memory_limit is not None else None
+        events = map_events(subject_resources, event_config, uuid_to_int, cfg, governor=governor)
+        try:
+            write_meds_sharded_parquet(events, output_dir, shard_size=SHARD_SIZE, governor=governor)
+        finally:
+            release_events(events, governor)
+
+    return engine
+
+
+ENGINES: Dict[str, Engine] = {
+    REFERENCE: reference_engine,
+    # In-process mapping: event dicts, and columnar fan-out for configs with wildcard paths
+    "sequential": _map_events_engine(),
+    # Process pool of parallel_mapping, in small batches so that every worker maps some
+    "parallel": _map_events_engine(mapping_workers=2, batch_size=500),
+    # A budget of one byte is always under pressure: every resource is mapped as a frame and spilled,
+    # so its throughput is a lower bound
+    "governed": _map_events_engine(batch_size=500, memory_limit=1),
+}
+
+
+class EngineRun:
+    """
+    Throughput and problems (differences to the reference) of one engine.
+    """
+
+    def __init__(self, name: str, seconds: float, n_resources: int, n_rows: int, problems: List[str]):
+        self.name = name
+        self.seconds = seconds
+        self.n_resources = n_resources
+        self.n_rows = n_rows
+        self.problems = problems
+
+    @property
+    def ok(self) -> bool:
+        return not self.problems
+
+    @property
+    def resources_per_second(self) -> float:
+        return self.n_resources / self.seconds if self.seconds > 0 else math.inf
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.n_rows / self.seconds if self.seconds > 0 else math.inf
+
+
+def read_output(output_dir: str) -> pl.DataFrame:
+    paths = (
+        sorted(
+            os.path.join(output_dir, "data", name)
+            for name in os.listdir(os.path.join(output_dir, "data"))
+            if name.endswith(".parquet")
+        )
+        if os.path.isdir(os.path.join(output_dir, "data"))
+        else []
+    )
+    if not paths:
+        return pl.DataFrame(schema={col: pl.Null for col in meds_required_columns()})
+    return pl.concat([pl.read_parquet(path) for path in paths], how="vertical")
+
+
+def _comparable(value: Any) -> Any:
+    # NaN is not equal to itself, so it would never match in a Counter
+    return "NaN" if isinstance(value, float) and math.isnan(value) else value
+
+
+def _row_counts(frame: pl.DataFrame, columns: List[str]) -> Counter:
+    return Counter(tuple(_comparable(v) for v in row) for row in frame.select(columns).iter_rows())
+
+
+def _format_row(columns: List[str], row: Tuple[Any, ...]) -> str:
+    return "{" + ", ".join(f"{col}={value!r}" for col, value in zip(columns, row)) + "}"
+
+
+def diff_tables(expected: pl.DataFrame, actual: pl.DataFrame, limit: int = 5) -> List[str]:
+    """
+    Differences of actual to expected MEDS rows: columns and types, missing and unexpected rows
+    (at most limit examples of each) and their counts. Empty if both hold the same rows.
+
+    Examples:
+        >>> expected = pl.DataFrame({"subject_id": [1, 1], "time": [None, None], "code": ["a", "b"],
+        ...                          "numeric_value": [1.0, 2.0]})
+        >>> diff_tables(expected, expected.reverse())
+        []
+        >>> for problem in diff_tables(expected, expected.with_columns(numeric_value=pl.Series([1.0, 2.5]))):
+        ...     print(problem)
+        {subject_id=1, time=None, code='b'}: numeric_value 2.5, reference 2.0
+        1 rows missing, 1 unexpected rows (of 2 reference rows, 2 rows)
+    """
+    problems = []
+    for col, dtype in expected.schema.items():
+        if col not in actual.columns:
+            problems.append(f"missing column {col}")
+        elif actual.schema[col] != dtype:
+            problems.append(f"column {col} is {actual.schema[col]}, reference has {dtype}")
+    problems += [f"unexpected column {col}" for col in actual.columns if col not in expected.columns]
+    if problems:
+        return problems
+    columns = list(expected.columns)
+    expected_counts = _row_counts(expected, columns)
+    actual_counts = _row_counts(actual, columns)
+    missing = expected_counts - actual_counts
+    unexpected = actual_counts - expected_counts
+    if not missing and not unexpected:
+        return []
+    key_columns = [columns.index(col) for col in ROW_KEY if col in columns]
+    by_key: Dict[Tuple[Any, ...], List[Tuple[Any, ...]]] = {}
+    for row in unexpected:
+        by_key.setdefault(tuple(row[i] for i in key_columns), []).append(row)
+    n_examples = 0
+    paired = set()
+    for row in missing:
+        if n_examples >= limit:
+            break
+        key = tuple(row[i] for i in key_columns)
+        candidates = [other for other in by_key.get(key, []) if other not in paired]
+        if candidates:
+            # The same event with different values
+            other = candidates[0]
+            paired.add(other)
+            differences = ", ".join(
+                f"{col} {other[i]!r}, reference {row[i]!r}"
+                for i, col in enumerate(columns)
+                if row[i] != other[i]
+            )
+            problems.append(f"{_format_row([columns[i] for i in key_columns], key)}: {differences}")
+        else:
+            problems.append(f"missing row {_format_row(columns, row)} (x{missing[row]})")
+        n_examples += 1
+    for row in unexpected:
+        if n_examples >= limit:
+            break
+        if row not in paired:
+            problems.append(f"unexpected row {_format_row(columns, row)} (x{unexpected[row]})")
+            n_examples += 1
+    problems.append(
+        f"{sum(missing.values())} rows missing, {sum(unexpected.values())} unexpected rows "
+        f"(of {expected.height} reference rows, {actual.height} rows)"
+    )
+    return problems
+
+
+def run_engine(engine: Engine, subject_resources, event_config, uuid_to_int, output_dir: str) -> float:
+    """
+    Run an engine on a copy of the event config (mapping fills in the defaults of the configs) and
+    return its wall time in seconds.
+    """
+    config = copy.deepcopy(event_config)
+    start = time.perf_counter()
+    engine(subject_resources, config, uuid_to_int, output_dir)
+    return time.perf_counter() - start
+
+
+def run_harness(
+    subject_resources: Dict[str, List[Any]],
+    event_config: Dict[str, Any],
+    uuid_to_int: Dict[str, int],
+    engines: Optional[Dict[str, Engine]] = None,
+    repeat: int = 1,
+    limit: int = 5,
+) -> List[EngineRun]:
+    """
+    Run the engines (ENGINES by default) on the same input and diff their rows against those of
+    the reference engine, which always runs first. The time of an engine is its best of repeat runs
+    and the rows of every run are diffed. An engine that raises is reported as failed.
+    """
+    engines = dict(engines if engines is not None else ENGINES)
+    reference = engines.pop(REFERENCE, reference_engine)
+    n_resources = sum(len(resources) for resources in subject_resources.values())
+    # meds is imported on first use, which must not count as the time of the reference
+    meds_required_columns()
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="fhir2meds_equivalence_") as tmp_dir:
+        timings = []
+        for i in range(repeat):
+            output_dir = os.path.join(tmp_dir, f"{REFERENCE}_{i}")
+            timings.append(run_engine(reference, subject_resources, event_config, uuid_to_int, output_dir))
+        expected = read_output(os.path.join(tmp_dir, f"{REFERENCE}_0"))
+        runs.append(EngineRun(REFERENCE, min(timings), n_resources, expected.height, []))
+        for name, engine in engines.items():
+            timings, problems, n_rows = [], [], 0
+            for i in range(repeat):
+                output_dir = os.path.join(tmp_dir, f"{name}_{i}")
+                try:
+                    seconds = run_engine(engine, subject_resources, event_config, uuid_to_int, output_dir)
+                    timings.append(seconds)
+                except Exception as e:
+                    problems = [f"failed: {type(e).__name__}: {e}"]
+                    break
+                actual = read_output(output_dir)
+                n_rows = actual.height
+                problems = diff_tables(expected, actual, limit=limit)
+                if problems:
+                    break
+            runs.append(EngineRun(name, min(timings) if timings else math.nan, n_resources, n_rows, problems))
+    return runs
+
+
+def format_report(runs: List[EngineRun]) -> str:
+    """
+    Table of the throughput and result of every engine, followed by the problems found.
+    """
+    baseline = runs[0].seconds if runs else math.nan
+    lines = [f"{'engine':<12} {'seconds':>8} {'resources/s':>12} {'rows/s':>10} {'speedup':>8}  result"]
+    for run in runs:
+        result = "OK" if run.ok else f"{len(run.problems)} problems"
+        lines.append(
+            f"{run.name:<12} {run.seconds:>8.3f} {run.resources_per_second:>12.0f} "
+            f"{run.rows_per_second:>10.0f} "
+            f"{baseline / run.seconds if run.seconds > 0 else math.inf:>8.2f}  {result}"
+        )
+    for run in runs:
+        lines += [f"{run.name}: {problem}" for problem in run.problems]
+    return "\n".join(lines) + "\n"
+
+
+def load_input(fhir_dir: str, fhir_version: str = "R4", types: Optional[Iterable[str]] = None) -> Input:
+    """
+    The subject-associated resources (of types, if given), the event config and the patient map of
+    a FHIR directory, loaded like a conversion does.
+    """
+    event_config = load_event_config(fhir_version=fhir_version)
+    resources = load_fhir_resources_by_type(fhir_dir, event_config, fhir_version)
+    resources = filter_subject_resources_by_type(resources)
+    if types is not None:
+        resources = {rtype: resources[rtype] for rtype in types if rtype in resources}
+    patient_path = os.path.join(fhir_dir, "Patient.ndjson")
+    if os.path.exists(patient_path):
+        uuid_to_int = build_patient_id_map(patient_path)
+    else:
+        uuid_to_int = patient_id_map_from_resources(iter_resources(fhir_dir, types=["Patient"]))
+    return resources, event_config, uuid_to_int
+
+
+def synthetic_input(n_subjects: int = 100, seed: int = 0, fhir_version: str = "R4") -> Input:
+    """
+    Seeded synthetic resources covering the edge cases of the mapping: integer, float, extreme, text
+    and numeric text values, units, missing times and subjects, time zones, and MedicationRequests
+    fanned out into one event per dose (SYNTHETIC_DOSAGE_CONFIG), including empty fan-out lists.
+
+    Examples:
+        >>> resources, event_config, uuid_to_int = synthetic_input(3)
+        >>> sorted(resources), len(uuid_to_int)
+        (['Condition', 'MedicationRequest', 'Observation', 'Patient'], 3)
+    """
+    rng = random.Random(seed)
+    event_config = load_event_config(fhir_version=fhir_version)
+    event_config["MedicationRequest"] = copy.deepcopy(SYNTHETIC_DOSAGE_CONFIG)
+    resources: Dict[str, List[Any]] = {
+        rtype: [] for rtype in ("Patient", "Observation", "Condition", "MedicationRequest")
+    }
+    for subject in range(n_subjects):
+        uuid = f"synthetic-{seed}-{subject}"
+        reference = {"reference": f"Patient/{uuid}"}
+        resources["Patient"].append(
+            {
+                "resourceType": "Patient",
+                "id": uuid,
+                "identifier": [{"system": PATIENT_SYSTEM, "value": str(10000000 + subject)}],
+                "birthDate": f"{rng.randint(2100, 2150)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+            }
+        )
+        for i in range(rng.randint(0, 20)):
+            observation = {
+                "resourceType": "Observation",
+                "id": f"{uuid}-obs-{i}",
+                "subject": reference if rng.random() > 0.02 else None,
+                "effectiveDateTime": f"2180-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}T{rng.randint(10, 23)}:"
+                f"{rng.randint(10, 59)}:00{rng.choice(['', 'Z', '-04:00', '+01:00'])}",
+                "code": {
+                    "coding": [
+                        {
+                            "system": rng.choice([LOINC, "http://snomed.info/sct"]),
+                            "code": str(rng.randint(1000, 1020)),
+                        }
+                    ]
+                },
+            }
+            kind = rng.random()
+            if kind < 0.6:
+                value = rng.choice([rng.randint(0, 200), round(rng.uniform(0, 200), 3)])
+                observation["valueQuantity"] = {"value": value, "unit": rng.choice(["kg", "mg/dL", "[degF]"])}
+            elif kind < 0.8:
+                observation["valueString"] = rng.choice(["positive", "7.4", "<5", "négatif"])
+            elif kind < 0.9:
+                observation["valueQuantity"] = {"value": rng.choice([0, -1.5, 1e-9, 1e12])}
+            else:
+                del observation["effectiveDateTime"]
+            resources["Observation"].append(observation)
+        for i in range(rng.randint(0, 5)):
+            resources["Condition"].append(
+                {
+                    "resourceType": "Condition",
+                    "id": f"{uuid}-cond-{i}",
+                    "subject": reference,
+                    "onsetDateTime": f"218{rng.randint(0, 9)}-07-20T00:00:00-04:00",
+                    "code": {"coding": [{"system": ICD9_SYSTEM, "code": str(rng.randint(4000, 4100))}]},
+                }
+            )
+        for i in range(rng.randint(0, 5)):
+            dosages = []
+            for _ in range(rng.randint(0, 3)):
+                route = rng.choice(SYNTHETIC_ROUTES)
+                dosages.append(
+                    {
+                        "text": rng.choice(["once daily", "twice daily", None]),
+                        "route": {"coding": [{"code": route}]} if route is not None else {},
+                        "doseAndRate": [
+                            {"doseQuantity": {"value": rng.choice([1, 2.5, 10])}}
+                            for _ in range(rng.randint(0, 2))
+                        ],
+                    }
+                )
+            resources["MedicationRequest"].append(
+                {
+                    "resourceType": "MedicationRequest",
+                    "id": f"{uuid}-med-{i}",
+                    "subject": reference,
+                    "authoredOn": f"2189-06-0{rng.randint(1, 9)}T16:45:19-04:00",
+                    "dosageInstruction": dosages,
+                }
+            )
+    uuid_to_int = patient_id_map_from_resources(resources["Patient"])
+    return resources, event_config, uuid_to_int
+
+
+def select_engines(names: Optional[Iterable[str]] = None) -> Dict[str, Engine]:
+    if names is None:
+        return dict(ENGINES)
+    unknown = [name for name in names if name not in ENGINES]
+    if unknown:
+        raise ValueError(f"Unknown engines {unknown}, expected some of {list(ENGINES)}")
+    return {name: ENGINES[name] for name in names}
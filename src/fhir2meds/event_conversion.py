@@ -1,22 +1,35 @@
 import json
 import re
 
+from . import profiling
+from .cohort import in_time_window
+from .fhir_parser import iter_resources, load_event_config
+
+# Path segment fanning a resource out into one event per list element, e.g. component[*]
+WILDCARD = "[*]"
+WILDCARD_PATTERN = re.compile(r"\[\*\]")
+
 
 def build_patient_id_map(patient_ndjson_path):
-    uuid_to_int = {}
     with open(patient_ndjson_path) as f:
-        for line in f:
-            if not line.strip():
-                continue
-            data = json.loads(line)
-            if data.get("resourceType") == "Patient":
-                uuid = data["id"]
-                for ident in data.get("identifier", []):
-                    if ident.get("system", "").endswith("/identifier/patient"):
-                        try:
-                            uuid_to_int[uuid] = int(ident["value"])
-                        except Exception:
-                            pass
+        return patient_id_map_from_resources(json.loads(line) for line in f if line.strip())
+
+
+def patient_id_map_from_resources(resources):
+    """
+    Map Patient UUIDs to the integer patient identifier, for Patient resources from any source
+    (e.g. entries of a Bundle rather than a Patient.ndjson file).
+    """
+    uuid_to_int = {}
+    for data in resources:
+        if data.get("resourceType") == "Patient":
+            uuid = data["id"]
+            for ident in data.get("identifier", []):
+                if ident.get("system", "").endswith("/identifier/patient"):
+                    try:
+                        uuid_to_int[uuid] = int(ident["value"])
+                    except Exception:
+                        pass
     return uuid_to_int
 
 
@@ -34,7 +47,7 @@ def extract_path(resource, path, column_name=None):
     """
     Resolve a dotted path like 'code.coding[0].code' on a FHIR resource object or dict.
     """
-    parts = re.split(r'\.|\[|\]', path)
+    parts = re.split(r"\.|\[|\]", path)
     obj = resource
     for part in parts:
         if not part:
@@ -51,88 +64,281 @@ def extract_path(resource, path, column_name=None):
             obj = getattr(obj, part, None)
         if obj is None:
             if column_name == "code":
-                print(f"Warning: Unable to resolve path '{path}' in resource {resource.get('resourceType', 'unknown')}")
+                print(
+                    f"Warning: Unable to resolve path '{path}' in resource {resource.get('resourceType', 'unknown')}"
+                )
                 print(f"Resource content: {json.dumps(resource, indent=2)}")
             return None
     return obj
 
+
 def extract_vocab(system_url):
     if not system_url:
-        return ''
-    if 'loinc' in system_url.lower():
-        return 'LOINC'
-    if 'snomed' in system_url.lower():
-        return 'SNOMED'
-    if 'icd' in system_url.lower():
-        return system_url.split('-')[-1].upper()
-    return system_url.split('/')[-1].upper()
-
-def build_event(resource, config, uuid_to_int=None, default_config=None):
+        return ""
+    if "loinc" in system_url.lower():
+        return "LOINC"
+    if "snomed" in system_url.lower():
+        return "SNOMED"
+    if "icd" in system_url.lower():
+        return system_url.split("-")[-1].upper()
+    return system_url.split("/")[-1].upper()
+
+
+def extract_time(resource, exprs):
+    """
+    Value of a time expression: col(path), or a list of col(path) fallbacks.
+    """
+    if isinstance(exprs, list):
+        for expr in exprs:
+            if expr.startswith("col("):
+                val = extract_path(resource, expr[4:-1])
+                if val is not None:
+                    return val
+        return None
+    if isinstance(exprs, str) and exprs.startswith("col("):
+        return extract_path(resource, exprs[4:-1])
+    return exprs
+
+
+def build_event(resource, config, uuid_to_int=None, default_config=None, time_window=None):
+    """
+    Build the MEDS event of a resource. If time_window (see cohort.make_time_window) is given, the
+    time is extracted first and None is returned for events outside of the window.
+    """
     event = {}
     rtype = resource["resourceType"]
+    # (resource type, key, expression) frames of the active profiler, see profiling.py
+    profiler = profiling.ACTIVE
     if default_config:
         for key, value in default_config.items():
             if key not in config:
                 config[key] = value
+    if time_window is not None and "time" in config:
+        if profiler is not None:
+            started = profiler.start()
+        event_time = extract_time(resource, config["time"])
+        if profiler is not None:
+            profiler.stop((rtype, "time", profiling.expression_label(config["time"])), started)
+        if not in_time_window(event_time, time_window):
+            return None
+        if event_time is not None:
+            event["time"] = event_time
     if rtype == "Medication":
-         print(resource)
+        print(resource)
     for key, exprs in config.items():
-        if key == 'subject_id':
-            rtype = resource.get('resourceType') if isinstance(resource, dict) else getattr(resource, 'resource_type', None)
+        if key == "time" and "time" in event:
+            continue
+        if profiler is not None:
+            started = profiler.start()
+        if key == "subject_id":
+            rtype = (
+                resource.get("resourceType")
+                if isinstance(resource, dict)
+                else getattr(resource, "resource_type", None)
+            )
             if rtype == "Patient":
-                identifiers = resource.get('identifier', []) if isinstance(resource, dict) else getattr(resource, 'identifier', [])
+                identifiers = (
+                    resource.get("identifier", [])
+                    if isinstance(resource, dict)
+                    else getattr(resource, "identifier", [])
+                )
                 found = False
                 for ident in identifiers:
-                    system = ident.get('system') if isinstance(ident, dict) else getattr(ident, 'system', None)
-                    value = ident.get('value') if isinstance(ident, dict) else getattr(ident, 'value', None)
+                    system = (
+                        ident.get("system") if isinstance(ident, dict) else getattr(ident, "system", None)
+                    )
+                    value = ident.get("value") if isinstance(ident, dict) else getattr(ident, "value", None)
                     if system and "identifier/patient" in system and value is not None:
                         try:
-                            event['subject_id'] = int(value)
+                            event["subject_id"] = int(value)
                         except Exception:
-                            event['subject_id'] = value
+                            event["subject_id"] = value
                         found = True
                         break
                 if not found:
-                    event['subject_id'] = resource.get('id') if isinstance(resource, dict) else getattr(resource, 'id', None)
+                    event["subject_id"] = (
+                        resource.get("id") if isinstance(resource, dict) else getattr(resource, "id", None)
+                    )
             else:
-                for field in ['subject', 'patient']:
-                    obj = resource.get(field) if isinstance(resource, dict) else getattr(resource, field, None)
+                for field in ["subject", "patient"]:
+                    obj = (
+                        resource.get(field) if isinstance(resource, dict) else getattr(resource, field, None)
+                    )
                     if obj:
-                        ref = obj.get('reference') if isinstance(obj, dict) else getattr(obj, 'reference', None)
+                        ref = (
+                            obj.get("reference") if isinstance(obj, dict) else getattr(obj, "reference", None)
+                        )
                         if ref and ref.startswith("Patient/"):
                             patient_uuid = ref.split("/")[-1]
                             if uuid_to_int and patient_uuid in uuid_to_int:
-                                event['subject_id'] = uuid_to_int[patient_uuid]
+                                event["subject_id"] = uuid_to_int[patient_uuid]
                             else:
-                                event['subject_id'] = patient_uuid
+                                event["subject_id"] = patient_uuid
                             break
                     else:
-                        event['subject_id'] = None
-        elif key == 'code' and isinstance(exprs, list):
+                        event["subject_id"] = None
+        elif key == "code" and isinstance(exprs, list):
             parts = []
             for expr in exprs:
-                if expr.startswith('const('):
+                if profiler is not None:
+                    expr_started = profiler.start()
+                if expr.startswith("const("):
                     val = expr[6:-1]
-                    if val == 'resourceType':
-                        val = resource.get('resourceType') if isinstance(resource, dict) else getattr(resource, 'resource_type', None)
+                    if val == "resourceType":
+                        val = (
+                            resource.get("resourceType")
+                            if isinstance(resource, dict)
+                            else getattr(resource, "resource_type", None)
+                        )
                     parts.append(str(val))
-                elif expr.startswith('col('):
-                    val = extract_path(resource, expr[4:-1], column_name='code')
+                elif expr.startswith("col("):
+                    val = extract_path(resource, expr[4:-1], column_name="code")
                     if val is not None:
                         parts.append(str(val))
-                elif expr.startswith('vocab('):
-                    system_url = extract_path(resource, expr[6:-1], column_name='code')
+                elif expr.startswith("vocab("):
+                    system_url = extract_path(resource, expr[6:-1], column_name="code")
                     parts.append(extract_vocab(system_url))
-            event[key] = ''.join([str(x) for x in parts if x not in (None, '', 'null')])
+                if profiler is not None:
+                    profiler.stop((rtype, key, expr), expr_started)
+            event[key] = "".join([str(x) for x in parts if x not in (None, "", "null")])
         elif isinstance(exprs, list):
             for expr in exprs:
-                if expr.startswith('col('):
+                if expr.startswith("col("):
                     val = extract_path(resource, expr[4:-1])
                     if val is not None:
                         event[key] = val
                         break
-        elif isinstance(exprs, str) and exprs.startswith('col('):
+        elif isinstance(exprs, str) and exprs.startswith("col("):
             event[key] = extract_path(resource, exprs[4:-1])
         else:
             event[key] = exprs
+        if profiler is not None:
+            # The code expressions were recorded one by one, below the code frame
+            if key == "code" and isinstance(exprs, list):
+                profiler.stop((rtype, key), started)
+            else:
+                profiler.stop((rtype, key, profiling.expression_label(exprs)), started)
     return event
+
+
+def config_paths(config):
+    """
+    Paths read by the col() and vocab() expressions of a resource config.
+    """
+    paths = []
+    for exprs in config.values():
+        for expr in exprs if isinstance(exprs, list) else [exprs]:
+            if isinstance(expr, str) and expr.startswith(("col(", "vocab(")):
+                paths.append(expr[expr.index("(") + 1 : -1])
+    return paths
+
+
+def fanout_levels(config):
+    """
+    Lists a config fans out over: the path segments before every [*] of its deepest wildcard path,
+    or [] for configs without wildcards. Shallower wildcard paths must refer to enclosing lists.
+
+    Examples:
+        >>> config = {"code": ["col(code[coding][0][code])"]}
+        >>> config["numeric_value"] = "col(component[*][valueQuantity][value])"
+        >>> fanout_levels(config)
+        ['component']
+        >>> config = {"text_value": "col(dosageInstruction[*][text])"}
+        >>> config["numeric_value"] = "col(dosageInstruction[*][doseAndRate][*][doseQuantity][value])"
+        >>> fanout_levels(config)
+        ['dosageInstruction', '[doseAndRate]']
+    """
+    levels = []
+    wildcard_paths = [path for path in config_paths(config) if WILDCARD in path]
+    for path in sorted(wildcard_paths, key=lambda p: -p.count(WILDCARD)):
+        segments = path.split(WILDCARD)[:-1]
+        if not levels:
+            levels = segments
+        elif levels[: len(segments)] != segments:
+            raise ValueError(f"Wildcard path {path} does not fan out over {WILDCARD.join(levels)}{WILDCARD}")
+    return levels
+
+
+def iter_element_indices(resource, levels, prefix=()):
+    """
+    Yield the index tuple of every (innermost) element of the fan-out lists of a resource.
+    """
+    obj = resource
+    for level, index in zip(levels, prefix):
+        obj = extract_path(obj, level)[index]
+    elements = extract_path(obj, levels[len(prefix)])
+    if not isinstance(elements, list):
+        return
+    for index in range(len(elements)):
+        if len(prefix) + 1 == len(levels):
+            yield prefix + (index,)
+        else:
+            yield from iter_element_indices(resource, levels, prefix + (index,))
+
+
+def element_config(config, indices):
+    """
+    Config of one fan-out element: the [*] of every path replaced by the element's indices.
+
+    Examples:
+        >>> config = {"numeric_value": "col(component[*][valueQuantity][value])", "time": "col(issued)"}
+        >>> element_config(config, (1,))
+        {'numeric_value': 'col(component[1][valueQuantity][value])', 'time': 'col(issued)'}
+    """
+
+    def instantiate(expr):
+        if not isinstance(expr, str) or WILDCARD not in expr:
+            return expr
+        remaining = iter(indices)
+        return WILDCARD_PATTERN.sub(lambda _: f"[{next(remaining)}]", expr)
+
+    return {
+        key: [instantiate(e) for e in exprs] if isinstance(exprs, list) else instantiate(exprs)
+        for key, exprs in config.items()
+    }
+
+
+def build_events(resource, config, uuid_to_int=None, default_config=None, time_window=None):
+    """
+    Build the MEDS events of a resource as (event, element config) pairs: one per element of the
+    wildcard lists of the config (see fanout_levels), or the single build_event of configs without
+    wildcards. Resources with empty fan-out lists emit no events. This is the row-at-a-time
+    reference of fanout.map_fanout_batch.
+    """
+    if default_config:
+        for key, value in default_config.items():
+            if key not in config:
+                config[key] = value
+    levels = fanout_levels(config)
+    if not levels:
+        event = build_event(resource, config, uuid_to_int, time_window=time_window)
+        return [(event, config)] if event is not None else []
+    events = []
+    for indices in iter_element_indices(resource, levels):
+        element = element_config(config, indices)
+        event = build_event(resource, element, uuid_to_int, time_window=time_window)
+        if event is not None:
+            events.append((event, element))
+    return events
+
+
+def iter_events(fhir_dir, event_config=None, fhir_version="R4", types=None, limit=None, uuid_to_int=None):
+    """
+    Lazily yield MEDS events for the subject-associated resources in fhir_dir, at most limit per type.
+
+    Only the files holding the requested types are read and reading stops early once every type
+    reached the limit (see fhir_parser.iter_resources). If uuid_to_int is not given it is built
+    from the Patient resources of fhir_dir.
+    """
+    if event_config is None:
+        event_config = load_event_config(fhir_version=fhir_version)
+    if types is None:
+        types = event_config["resources"]
+    if uuid_to_int is None:
+        uuid_to_int = patient_id_map_from_resources(iter_resources(fhir_dir, types=["Patient"]))
+    for resource in iter_resources(fhir_dir, types=types, limit=limit, subject_only=True):
+        rtype = resource["resourceType"]
+        config = event_config.get(rtype, event_config["default"])
+        for event, _ in build_events(resource, config, uuid_to_int, event_config["default"]):
+            if event.get("subject_id") not in (None, "", "null"):
+                yield event
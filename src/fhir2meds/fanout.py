@@ -0,0 +1,214 @@
+"""
+fanout.py
+---------
+Columnar mapping of configs with wildcard paths, which fan one resource out into an event per list
+element (event_conversion.fanout_levels), e.g. one event per component of a blood pressure panel:
+
+    Observation:
+      code: [const(resourceType), const(//), vocab(component[*][code][coding][0][system]),
+             const(//), col(component[*][code][coding][0][code])]
+      numeric_value: col(component[*][valueQuantity][value])
+
+Instead of building a dict per element, every resource becomes one row: the paths without
+wildcards are read once (build_event on the wildcard-free part of the config), and every wildcard
+path becomes a column of the nested lists of its element values. The batch is then exploded with
+polars, one wildcard level at a time, and the codes (including vocab()) are assembled with
+vectorized string expressions. event_conversion.build_events is the row-at-a-time reference.
+"""
+
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import polars as pl
+
+from . import profiling
+from .code_metadata import CodeMetadata, coding_paths
+from .cohort import TimeWindow, in_time_window
+from .event_conversion import WILDCARD, build_event, extract_path, fanout_levels
+from .meds_writer import cast_to_meds_schema, meds_required_columns
+from .units import UNIT_COLUMN, ValueNormalizer
+
+# Nested lists of the fan-out elements, and the index of the resource of every row
+MARKER = "__element"
+RESOURCE = "__resource"
+
+
+def has_wildcards(config: Dict[str, Any]) -> bool:
+    return bool(fanout_levels(config))
+
+
+def extract_nested(obj: Any, segments: List[str], rest: str, leaf=None) -> Any:
+    """
+    Nested lists (one level per wildcard) of the values of a wildcard path, split into the
+    segments before every [*] and the rest after the last one. Missing lists are empty.
+
+    Examples:
+        >>> resource = {"component": [{"value": 1}, {"value": 2}, {}]}
+        >>> extract_nested(resource, ["component"], "[value]")
+        [1, 2, None]
+        >>> resource = {"dose": [{"rate": [{"v": 1}, {"v": 2}]}, {"rate": []}]}
+        >>> extract_nested(resource, ["dose", "[rate]"], "[v]")
+        [[1, 2], []]
+    """
+    elements = extract_path(obj, segments[0])
+    if not isinstance(elements, list):
+        return []
+    if len(segments) > 1:
+        return [extract_nested(element, segments[1:], rest, leaf) for element in elements]
+    if leaf is not None:
+        return [leaf(element) for element in elements]
+    return [extract_path(element, rest) if rest else element for element in elements]
+
+
+def vocab_expr(system: pl.Expr) -> pl.Expr:
+    """
+    Vectorized event_conversion.extract_vocab.
+    """
+    lower = system.str.to_lowercase()
+    return (
+        pl.when(system.is_null() | (system == ""))
+        .then(pl.lit(""))
+        .when(lower.str.contains("loinc", literal=True))
+        .then(pl.lit("LOINC"))
+        .when(lower.str.contains("snomed", literal=True))
+        .then(pl.lit("SNOMED"))
+        .when(lower.str.contains("icd", literal=True))
+        .then(system.str.split("-").list.last().str.to_uppercase())
+        .otherwise(system.str.split("/").list.last().str.to_uppercase())
+    )
+
+
+class FanoutPlan:
+    """
+    Columns of a fan-out config: the wildcard-free config read per resource, one column per
+    wildcard path and the expressions assembling the event fields from them after the explode.
+    """
+
+    def __init__(self, config: Dict[str, Any], rtype: str, with_codings: bool = False):
+        self.levels = fanout_levels(config)
+        self.base_config: Dict[str, Any] = {}
+        # column -> (wildcard segments, rest of the path, stringify like the code expression does)
+        self.columns: Dict[str, Tuple[List[str], str, bool]] = {}
+        self.fields: Dict[str, pl.Expr] = {}
+        for key, exprs in config.items():
+            expr_list = exprs if isinstance(exprs, list) else [exprs]
+            if key == "subject_id" or not any(isinstance(e, str) and WILDCARD in e for e in expr_list):
+                self.base_config[key] = exprs
+            elif key == "code":
+                self.fields[key] = self._code(expr_list, rtype)
+            else:
+                # Like build_event, the first col() of a list that resolves wins
+                paths = [e[4:-1] for e in expr_list if isinstance(e, str) and e.startswith("col(")]
+                columns = [self._column(path) for path in paths]
+                self.fields[key] = pl.coalesce(columns) if columns else pl.lit(exprs)
+        self.codings = None
+        if with_codings:
+            self.codings = [self._column(path) if path else pl.lit(None) for path in coding_paths(config)]
+
+    def _column(self, path: str, stringify: bool = False) -> pl.Expr:
+        name = f"__w{len(self.columns)}"
+        if WILDCARD in path:
+            segments = path.split(WILDCARD)
+            self.columns[name] = (segments[:-1], segments[-1], stringify)
+        else:
+            self.columns[name] = ([], path, stringify)
+        return pl.col(name)
+
+    def _code(self, exprs: List[str], rtype: str) -> pl.Expr:
+        parts = []
+        for expr in exprs:
+            if expr.startswith("const("):
+                value = expr[6:-1]
+                parts.append(pl.lit(rtype if value == "resourceType" else value, dtype=pl.Utf8))
+            elif expr.startswith("col("):
+                parts.append(self._column(expr[4:-1], stringify=True))
+            elif expr.startswith("vocab("):
+                parts.append(vocab_expr(self._column(expr[6:-1], stringify=True)))
+        parts = [pl.when(part.is_in(["", "null"])).then(None).otherwise(part) for part in parts]
+        return pl.concat_str(parts, ignore_nulls=True) if parts else pl.lit("")
+
+    def row(self, resource: Dict[str, Any], base: Dict[str, Any]) -> Dict[str, Any]:
+        row = dict(base)
+        for name, (segments, rest, stringify) in self.columns.items():
+            leaf = partial(_stringify_path, rest=rest) if stringify else None
+            if segments:
+                row[name] = extract_nested(resource, segments, rest, leaf)
+            else:
+                value = extract_path(resource, rest)
+                row[name] = _stringify(value) if stringify else value
+        row[MARKER] = extract_nested(resource, self.levels, "", leaf=lambda _: 0)
+        return row
+
+    def depth(self, name: str) -> int:
+        return len(self.columns[name][0]) if name in self.columns else len(self.levels)
+
+
+def _stringify(value: Any) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+def _stringify_path(element: Any, rest: str) -> Optional[str]:
+    return _stringify(extract_path(element, rest) if rest else element)
+
+
+def map_fanout_batch(
+    resources: List[Dict[str, Any]],
+    config: Dict[str, Any],
+    uuid_to_int: Optional[Dict[str, int]] = None,
+    default_config: Optional[Dict[str, Any]] = None,
+    time_window: Optional[TimeWindow] = None,
+    code_metadata: Optional[CodeMetadata] = None,
+    normalizer: Optional[ValueNormalizer] = None,
+) -> Tuple[pl.DataFrame, int]:
+    """
+    Map a batch of resources of one type with a fan-out config to a MEDS typed frame, in the order
+    of event_conversion.build_events. Returns the frame and the number of resources without events
+    (no subject_id, outside of the time window or empty fan-out lists). The values are normalized
+    with normalizer (a units.ValueNormalizer), if given.
+    """
+    if default_config:
+        for key, value in default_config.items():
+            if key not in config:
+                config[key] = value
+    if not resources:
+        return empty_events(), 0
+    rtype = resources[0]["resourceType"]
+    plan = FanoutPlan(config, rtype, with_codings=code_metadata is not None)
+    rows = []
+    with profiling.section(rtype, "fanout", "extract"):
+        for index, res in enumerate(resources):
+            base = build_event(res, plan.base_config, uuid_to_int, time_window=time_window)
+            if base is not None and base.get("subject_id") not in (None, "", "null"):
+                rows.append({**plan.row(res, base), RESOURCE: index})
+    if not rows:
+        return empty_events(), len(resources)
+    columns = [*plan.columns, MARKER]
+    with profiling.section(rtype, "fanout", "explode"):
+        frame = pl.DataFrame(rows, strict=False, infer_schema_length=None)
+        for level in range(1, len(plan.levels) + 1):
+            # Rows of empty lists would explode into a null row instead of no row
+            frame = frame.filter(pl.col(MARKER).list.len() > 0)
+            frame = frame.explode([c for c in columns if plan.depth(c) >= level])
+    with profiling.section(rtype, "fanout", "assemble"):
+        frame = frame.with_columns(**plan.fields)
+        if "time" in plan.fields and time_window is not None:
+            in_window = [in_time_window(t, time_window) for t in frame["time"].to_list()]
+            frame = frame.filter(pl.Series(in_window, dtype=pl.Boolean))
+        if code_metadata is not None:
+            codings = frame.select(pl.col("code"), *plan.codings)
+            for code, system, value, display in codings.unique(maintain_order=True).iter_rows():
+                code_metadata.observe_coding(code, system, value, display)
+    n_emitting = frame[RESOURCE].n_unique()
+    columns = list(meds_required_columns())
+    for col in columns:
+        if col not in frame.columns:
+            frame = frame.with_columns(pl.lit(None).alias(col))
+    if normalizer is None:
+        return cast_to_meds_schema(frame.select(columns)), len(resources) - n_emitting
+    unit = [UNIT_COLUMN] if UNIT_COLUMN in frame.columns else []
+    frame = normalizer.apply(cast_to_meds_schema(frame.select(columns + unit))).select(columns)
+    return frame, len(resources) - n_emitting
+
+
+def empty_events() -> pl.DataFrame:
+    return cast_to_meds_schema(pl.DataFrame(schema={c: pl.Null for c in meds_required_columns()}))
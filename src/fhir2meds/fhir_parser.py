@@ -2,24 +2,44 @@
 fhir_parser.py
 --------------
 Generalized FHIR resource loader for the fhir2meds pipeline.
-Loads all FHIR resources by type from a directory, and provides utilities for filtering and sampling.
+Loads all FHIR resources by type from a directory (local, or a URL of an fsspec filesystem, see storage.py),
+and provides utilities for filtering and sampling.
 """
-import os
+
+import base64
+import json
 import logging
+import os
+import re
 from collections import defaultdict
-from typing import List, Dict, Any, cast
-from omegaconf import OmegaConf
+from functools import lru_cache
 from importlib import import_module
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, cast
+
+from omegaconf import OmegaConf
+
+from . import profiling
+from .storage import is_remote, iter_lines, list_files, open_text, read_range
+from .streaming_json import expand_bundle, iter_json_resources
 
 # Hydra config loading will be handled by the main entrypoint, but allow direct config loading for testing
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'configs', 'event_configs.yaml')
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "configs", "event_configs.yaml")
+
+# Base64 payloads (Attachment.data of DocumentReference, Media, ..., Binary.data) at least this long are
+# replaced by a reference to their location in the file before the line is decoded
+PAYLOAD_MIN_BYTES = 64 << 10
+PAYLOAD_REF_KEY = "_payloadRef"
+PAYLOAD_PATTERN = re.compile(rb'"data"\s*:\s*"')
+# Resources read between two checks of the memory budget
+MEMORY_CHECK_EVERY = 10000
 
 FHIR_VERSION_MODULES = {
-    'R4': 'fhir.resources',
-    'R5': 'fhir.resources.R5',
+    "R4": "fhir.resources",
+    "R5": "fhir.resources.R5",
 }
 
-def load_event_config(config_path: str = CONFIG_PATH, fhir_version: str = 'R4') -> Dict[str, Any]:
+
+def load_event_config(config_path: str = CONFIG_PATH, fhir_version: str = "R4") -> Dict[str, Any]:
     cfg = OmegaConf.load(config_path)
     if fhir_version not in cfg:
         raise ValueError(f"FHIR version {fhir_version} not found in config")
@@ -31,63 +51,282 @@ def load_event_config(config_path: str = CONFIG_PATH, fhir_version: str = 'R4')
         raise TypeError(f"All config keys for {fhir_version} must be strings")
     return dict(section)  # type: ignore
 
-def get_fhir_resource_class(resource_type: str, fhir_version: str = 'R4'):
+
+def load_event_configs(
+    config_paths: Optional[Dict[str, Optional[str]]] = None, fhir_version: str = "R4"
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Load named event configs from {name: path}; a path of None loads the packaged config.
+    Without config_paths, only the packaged config is loaded, under the name "".
+    """
+    if not config_paths:
+        return {"": load_event_config(fhir_version=fhir_version)}
+    return {
+        name: load_event_config(path or CONFIG_PATH, fhir_version=fhir_version)
+        for name, path in config_paths.items()
+    }
+
+
+def combine_event_configs(event_configs: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Config to load resources for several event configs at once: the first config, with the
+    resource types of all of them.
+    """
+    configs = list(event_configs.values())
+    resources = list(dict.fromkeys(rtype for config in configs for rtype in config["resources"]))
+    return {**configs[0], "resources": resources}
+
+
+@lru_cache(maxsize=None)
+def get_fhir_resource_class(resource_type: str, fhir_version: str = "R4"):
     """
     Dynamically import the correct FHIR resource class for the given type and version.
+    Classes are cached per (type, version), so the import only happens once per process.
     """
-    if fhir_version == 'R4':
+    if fhir_version == "R4":
         module = import_module(f"fhir.resources.{resource_type.lower()}")
-    elif fhir_version == 'R5':
+    elif fhir_version == "R5":
         module = import_module(f"fhir.resources.R5.{resource_type.lower()}")
     else:
         raise ValueError(f"Unsupported FHIR version: {fhir_version}")
     return getattr(module, resource_type)
 
-def load_fhir_resources_by_type(fhir_dir: str, event_config: Dict[str, Any], fhir_version: str = 'R4', validate_with_fhir_resources: bool = False) -> Dict[str, List[Any]]:
+
+def parse_fhir_resource(data: Dict[str, Any], fhir_version: str = "R4"):
+    """
+    Validate a raw resource dict into its fhir.resources model.
+    """
+    resource_class = get_fhir_resource_class(data.get("resourceType"), fhir_version)
+    if hasattr(resource_class, "model_validate"):
+        return resource_class.model_validate(data)
+    return resource_class.parse_obj(data)
+
+
+def list_fhir_files(fhir_dir: str) -> List[str]:
+    """
+    List all .ndjson/.json files below fhir_dir in a stable (sorted) order.
+    """
+    if is_remote(fhir_dir):
+        return list_files(str(fhir_dir))
+    paths = []
+    for root, dirs, files in os.walk(fhir_dir):
+        for fname in files:
+            if fname.endswith(".ndjson") or fname.endswith(".json"):
+                paths.append(os.path.join(root, fname))
+    return sorted(paths)
+
+
+def strip_payloads(line: bytes, fpath: str, offset: int, min_bytes: int = PAYLOAD_MIN_BYTES) -> bytes:
+    """
+    Replace "data" strings of at least min_bytes in a raw NDJSON line by a reference
+    {"_payloadRef": {"path": ..., "offset": ..., "length": ...}} to their bytes in the file, without
+    decoding the line. offset is the position of the line in the file.
+
+    Examples:
+        >>> line = b'{"resourceType": "Binary", "data": "aGVsbG8gd29ybGQ="}'
+        >>> strip_payloads(line, "Binary.ndjson", 100, min_bytes=8)
+        b'{"resourceType": "Binary", "_payloadRef": {"path": "Binary.ndjson", "offset": 136, "length": 16}}'
+    """
+    pieces = []
+    pos = 0
+    for match in PAYLOAD_PATTERN.finditer(line):
+        if match.start() < pos:
+            continue
+        start = match.end()
+        end = line.find(b'"', start)
+        # An escaped quote is not the end of the string; base64 never contains one, so leave it to the decoder
+        if end - start < min_bytes or line[end - 1 : end] == b"\\":
+            continue
+        ref = {"path": fpath, "offset": offset + start, "length": end - start}
+        pieces.append(line[pos : match.start()])
+        pieces.append(f'"{PAYLOAD_REF_KEY}": {json.dumps(ref)}'.encode())
+        pos = end + 1
+    if not pieces:
+        return line
+    pieces.append(line[pos:])
+    return b"".join(pieces)
+
+
+def read_payload(ref: Dict[str, Any], decode: bool = True) -> Any:
+    """
+    Read a payload stripped by strip_payloads back from its file: the decoded bytes, or the base64
+    text if decode is False.
+    """
+    if is_remote(ref["path"]):
+        raw = read_range(ref["path"], ref["offset"], ref["offset"] + ref["length"])
+    else:
+        with open(ref["path"], "rb") as f:
+            f.seek(ref["offset"])
+            raw = f.read(ref["length"])
+    # The raw bytes are the JSON string body, e.g. with escaped slashes or line breaks
+    text = json.loads(b'"' + raw + b'"')
+    return base64.b64decode(text) if decode else text
+
+
+def iter_file_resources(
+    fpath: str, payload_min_bytes: Optional[int] = PAYLOAD_MIN_BYTES, cohort: Optional[Any] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the raw resources of one .ndjson or .json file, with Bundles expanded into their entries.
+    NDJSON is read line by line; .json files (single resources, arrays or Bundles of any size)
+    are streamed incrementally instead of being loaded as a whole.
+    In NDJSON files, base64 payloads of at least payload_min_bytes are not decoded but replaced by
+    a byte-offset reference (see strip_payloads and read_payload); None keeps them.
+    If cohort (a cohort.Cohort) is given, NDJSON lines that only reference Patients outside of it
+    are skipped before being decoded.
+    """
+    if fpath.endswith(".json"):
+        with open_text(fpath) if is_remote(fpath) else open(fpath) as f:
+            try:
+                yield from iter_json_resources(f)
+            except ValueError as e:
+                print(f"Failed to parse {fpath}: {e}")
+        return
+    # Remote NDJSON is read as concurrent range requests, see storage.iter_lines
+    for line_offset, line in iter_lines(fpath) if is_remote(fpath) else _iter_local_lines(fpath):
+        if not line.strip():
+            continue
+        if cohort is not None and not cohort.may_contain(line):
+            continue
+        if payload_min_bytes is not None and len(line) > payload_min_bytes:
+            line = strip_payloads(line, fpath, line_offset, payload_min_bytes)
+        try:
+            data = json.loads(line)
+        except Exception as e:
+            print(f"Failed to parse line in {fpath}: {e}")
+            continue
+        yield from expand_bundle(data)
+
+
+def _iter_local_lines(fpath: str) -> Iterator[Tuple[int, bytes]]:
+    with open(fpath, "rb") as f:
+        offset = 0
+        for line in f:
+            yield offset, line
+            offset += len(line)
+
+
+def sniff_resource_type(fpath: str) -> Optional[str]:
+    """
+    Return the resourceType of the first resource in an NDJSON file, reading a single line.
+    Returns None when the file may contain several types (.json files and Bundles).
+    """
+    if not fpath.endswith(".ndjson"):
+        return None
+    with open_text(fpath) if is_remote(fpath) else open(fpath) as f:
+        for line in f:
+            if line.strip():
+                try:
+                    rtype = json.loads(line).get("resourceType")
+                except Exception:
+                    return None
+                return None if rtype == "Bundle" else rtype
+    return None
+
+
+def iter_resources(
+    fhir_dir: str,
+    types: Optional[List[str]] = None,
+    limit: Optional[int] = None,
+    subject_only: bool = False,
+    files: Optional[List[str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily yield raw resources from fhir_dir, optionally restricted to some resource types and to
+    at most limit resources per type.
+
+    Like FHIR Bulk Data exports, each NDJSON file is assumed to hold a single resource type: files
+    whose first resource has an unrequested type are skipped after reading one line, and a file is
+    abandoned as soon as its type reached the limit. Iteration stops once every requested type did.
+    If subject_only is True, only resources associated with a Patient are yielded (and counted).
+    """
+    wanted = set(types) if types is not None else None
+    counts: Dict[str, int] = defaultdict(int)
+
+    def done(rtype):
+        return limit is not None and counts[rtype] >= limit
+
+    if files is None:
+        files = list_fhir_files(fhir_dir)
+    for fpath in files:
+        if wanted is not None and limit is not None and all(done(t) for t in wanted):
+            return
+        file_type = sniff_resource_type(fpath)
+        if file_type is not None and ((wanted is not None and file_type not in wanted) or done(file_type)):
+            continue
+        for data in iter_file_resources(fpath):
+            if not isinstance(data, dict):
+                continue
+            rtype = data.get("resourceType")
+            if (wanted is not None and rtype not in wanted) or done(rtype):
+                continue
+            if subject_only and not is_subject_associated(data):
+                continue
+            counts[rtype] += 1
+            yield data
+            if file_type is not None and done(file_type):
+                break
+
+
+def load_fhir_resources_by_type(
+    fhir_dir: str,
+    event_config: Dict[str, Any],
+    fhir_version: str = "R4",
+    validate_with_fhir_resources: bool = False,
+    files: Optional[List[str]] = None,
+    progress: Optional[Callable[[str], None]] = None,
+    payload_min_bytes: Optional[int] = PAYLOAD_MIN_BYTES,
+    cohort: Optional[Any] = None,
+    governor: Optional[Any] = None,
+) -> Dict[str, List[Any]]:
     """
     Load and parse FHIR resources by type using fhir.resources and config.
     Only loads resource types specified in the config.
     If validate_with_fhir_resources is False, loads raw dicts instead of validated objects.
+    If files is given, only those files are parsed instead of every file in fhir_dir.
+    If progress is given, it is called with the path of every file once it has been parsed.
+    Large base64 payloads are replaced by byte-offset references, see iter_file_resources.
+    If cohort (a cohort.Cohort) is given, resources of subjects outside of it are dropped right
+    after their subject reference is read.
+    If governor (a memory.MemoryGovernor) is given, memory is checked every MEMORY_CHECK_EVERY
+    resources and a MemoryError is raised once the budget is exceeded.
     """
     event_config = cast(Dict[str, Any], event_config)
     resources = defaultdict(list)
-    resource_types = event_config['resources']  # type: ignore
-    for root, dirs, files in os.walk(fhir_dir):
-        for fname in files:
-            if fname.endswith('.ndjson') or fname.endswith('.json'):
-                fpath = os.path.join(root, fname)
-                logging.info(f"Parsing file {fpath}")
-                with open(fpath) as f:
-                    for line in f:
-                        if not line.strip():
-                            continue
+    resource_types = event_config["resources"]  # type: ignore
+    if files is None:
+        files = list_fhir_files(fhir_dir)
+    n_read = 0
+    for fpath in files:
+        logging.info(f"Parsing file {fpath}")
+        with profiling.section("decode", os.path.basename(str(fpath))):
+            for data in iter_file_resources(fpath, payload_min_bytes=payload_min_bytes, cohort=cohort):
+                n_read += 1
+                if governor is not None and n_read % MEMORY_CHECK_EVERY == 0:
+                    governor.check(f"Loading {fpath}")
+                if not isinstance(data, dict):
+                    continue
+                rtype = data.get("resourceType")
+                if rtype in resource_types:
+                    if cohort is not None and not cohort.keep(data):
+                        continue
+                    if validate_with_fhir_resources:
                         try:
-                            import json
-                            data = json.loads(line)
+                            resources[rtype].append(parse_fhir_resource(data, fhir_version))
                         except Exception as e:
-                            print(f"Failed to parse line in {fpath}: {e}")
-                            continue
-                        rtype = data.get("resourceType")
-                        if rtype in resource_types:
-                            if validate_with_fhir_resources:
-                                try:
-                                    resource_class = get_fhir_resource_class(rtype, fhir_version)
-                                    resource_obj = resource_class.parse_obj(data)
-                                    resources[rtype].append(resource_obj)
-                                    print(f"Loaded {rtype}: {resource_obj}")  # DEBUG
-                                except Exception as e:
-                                    logging.warning(f"Failed to parse {rtype} with fhir.resources: {e}")
-                                    resources[rtype].append(data)
-                                    print(f"Loaded {rtype} as dict: {data}")  # DEBUG
-                            else:
-                                resources[rtype].append(data)
-                                # print(f"Loaded {rtype} as dict: {data}")  # DEBUG
+                            logging.warning(f"Failed to parse {rtype} with fhir.resources: {e}")
+                            resources[rtype].append(data)
+                    else:
+                        resources[rtype].append(data)
+        if progress is not None:
+            progress(fpath)
 
     # print(f"Resource types loaded: {list(resources.keys())}")  # DEBUG
     # for k, v in resources.items():
     #     print(f"Loaded {len(v)} resources of type {k}")  # DEBUG
     return resources
 
+
 def is_subject_associated(resource: Any) -> bool:
     # Handle dicts
     if isinstance(resource, dict):
@@ -105,21 +344,47 @@ def is_subject_associated(resource: Any) -> bool:
             return True
         return False
     # Handle objects
-    rtype = getattr(resource, 'resource_type', None) or getattr(resource, 'resourceType', None)
+    rtype = getattr(resource, "resource_type", None) or getattr(resource, "resourceType", None)
     if rtype == "Patient":
         return True
     # Check 'subject' reference
-    subject = getattr(resource, 'subject', None)
-    ref = getattr(subject, 'reference', None) if subject else None
+    subject = getattr(resource, "subject", None)
+    ref = getattr(subject, "reference", None) if subject else None
     if ref and ref.startswith("Patient/"):
         return True
     # Check 'patient' reference
-    patient = getattr(resource, 'patient', None)
-    ref = getattr(patient, 'reference', None) if patient else None
+    patient = getattr(resource, "patient", None)
+    ref = getattr(patient, "reference", None) if patient else None
     if ref and ref.startswith("Patient/"):
         return True
     return False
 
+
+def get_subject_reference(resource: Any) -> Optional[str]:
+    """
+    Return the Patient UUID a resource belongs to: the id for Patient resources,
+    otherwise the id from a 'subject' or 'patient' reference of the form 'Patient/<id>'.
+    """
+    if isinstance(resource, dict):
+        if resource.get("resourceType") == "Patient":
+            return resource.get("id")
+        for field in ("subject", "patient"):
+            obj = resource.get(field)
+            ref = obj.get("reference", "") if isinstance(obj, dict) else ""
+            if ref and ref.startswith("Patient/"):
+                return ref.split("/")[-1]
+        return None
+    rtype = getattr(resource, "resource_type", None) or getattr(resource, "resourceType", None)
+    if rtype == "Patient":
+        return getattr(resource, "id", None)
+    for field in ("subject", "patient"):
+        obj = getattr(resource, field, None)
+        ref = getattr(obj, "reference", None) if obj else None
+        if ref and ref.startswith("Patient/"):
+            return ref.split("/")[-1]
+    return None
+
+
 def filter_subject_resources_by_type(resources_by_type: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
     """
     Filter all loaded resources globally, keeping only those associated with a subject.
@@ -132,14 +397,21 @@ def filter_subject_resources_by_type(resources_by_type: Dict[str, List[Any]]) ->
         print(f"Kept {len(subject_resources)} subject-associated resources of type {rtype}")  # DEBUG
         skipped = len(resources) - len(subject_resources)
         if skipped > 0:
-            logging.info(f"Skipped {skipped} of {len(resources)} {rtype} resources (not associated with a subject)")
+            logging.info(
+                f"Skipped {skipped} of {len(resources)} {rtype} resources (not associated with a subject)"
+            )
         filtered[rtype] = subject_resources
     print(f"Subject-associated types: {[(k, len(v)) for k, v in filtered.items()]}")  # DEBUG
     return filtered
 
-def get_sample_resources_by_type(fhir_dir: str, event_config: dict, fhir_version: str = 'R4', n: int = 3) -> Dict[str, List[Any]]:
+
+def get_sample_resources_by_type(
+    fhir_dir: str, event_config: dict, fhir_version: str = "R4", n: int = 3
+) -> Dict[str, List[Any]]:
     """
     Return up to n samples for each resource type found in the directory.
     """
-    all_resources = load_fhir_resources_by_type(fhir_dir, event_config, fhir_version)
-    return {rtype: resources[:n] for rtype, resources in all_resources.items()} 
\ No newline at end of file
+    samples = defaultdict(list)
+    for resource in iter_resources(fhir_dir, types=event_config["resources"], limit=n):
+        samples[resource["resourceType"]].append(resource)
+    return dict(samples)
@@ -0,0 +1,326 @@
+"""
+manifest.py
+-----------
+Integrity manifest of a MEDS output directory and its verification. metadata/manifest.json
+records for every data shard its row count, subject count, min/max time, size, SHA-256 checksum
+and schema fingerprint, checksums of the metadata files, a checksum of the whole dataset (over
+the shard checksums) and the number of source values lost in the MEDS casts, so downstream jobs
+can tell whether a dataset changed without reading it.
+Entries of shards whose size and mtime did not change are reused when the manifest is rewritten.
+Shards written straight to an output URL (storage.open_output) are not on local disk; their
+entries are recorded as partials when they are written and added to the manifest.
+
+verify_output checks a directory against the manifest and the meds DataSchema from Parquet
+footers and row-group statistics only (schema, row counts, null counts, time ranges), which takes
+seconds for any dataset size; with full=True it also recomputes the checksums and checks every
+value with vectorized polars expressions.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .sharding import PARTIALS_DIR
+
+MANIFEST_PATH = os.path.join("metadata", "manifest.json")
+METADATA_FILES = ("codes.parquet", "subject_splits.parquet", "subject_index.parquet", "dataset.json")
+HASH_BLOCK = 1 << 20
+MANIFEST_VERSION = 1
+SHARD_PARTIALS_DIR = os.path.join(PARTIALS_DIR, "manifest")
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def schema_fingerprint(schema: pa.Schema) -> str:
+    """
+    Fingerprint of the column names, types and nullability of a schema (metadata is ignored).
+
+    Examples:
+        >>> a = pa.schema([("subject_id", pa.int64()), ("code", pa.string())])
+        >>> b = pa.schema([("subject_id", pa.int64()), ("code", pa.large_string())])
+        >>> schema_fingerprint(a) == schema_fingerprint(a.with_metadata({b"k": b"v"}))
+        True
+        >>> schema_fingerprint(a) == schema_fingerprint(b)
+        False
+    """
+    fields = ",".join(
+        f"{field.name}:{field.type}:{'null' if field.nullable else 'not null'}" for field in schema
+    )
+    return hashlib.sha256(fields.encode()).hexdigest()[:16]
+
+
+def _isoformat(value: Any) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def shard_entry(output_dir: str, path: str) -> Dict[str, Any]:
+    """
+    Manifest entry of one shard (path relative to output_dir).
+    """
+    full_path = os.path.join(output_dir, path)
+    parquet_file = pq.ParquetFile(full_path)
+    columns = pl.from_arrow(parquet_file.read(columns=["subject_id", "time"]))
+    stat = os.stat(full_path)
+    return {
+        "path": path,
+        "n_rows": parquet_file.metadata.num_rows,
+        "n_subjects": columns["subject_id"].n_unique(),
+        "min_time": _isoformat(columns["time"].min()),
+        "max_time": _isoformat(columns["time"].max()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(full_path),
+        "schema_fingerprint": schema_fingerprint(parquet_file.schema_arrow),
+    }
+
+
+def written_shard_entry(
+    path: str, events: pl.DataFrame, schema: pa.Schema, size: int, sha256: str
+) -> Dict[str, Any]:
+    """
+    Manifest entry of a shard written to an output URL, from the frame it was written from and the
+    size and checksum of the written bytes.
+    """
+    return {
+        "path": path,
+        "n_rows": events.height,
+        "n_subjects": events["subject_id"].n_unique(),
+        "min_time": _isoformat(events["time"].min()),
+        "max_time": _isoformat(events["time"].max()),
+        "size": size,
+        "mtime_ns": None,
+        "sha256": sha256,
+        "schema_fingerprint": schema_fingerprint(schema),
+    }
+
+
+def write_shard_partial(output_dir: str, name: str, entry: Dict[str, Any]) -> None:
+    partial_dir = os.path.join(str(output_dir), SHARD_PARTIALS_DIR)
+    os.makedirs(partial_dir, exist_ok=True)
+    with open(os.path.join(partial_dir, f"{name}.json"), "w") as f:
+        json.dump(entry, f)
+
+
+def load_shard_partials(output_dir: str) -> List[Dict[str, Any]]:
+    partial_dir = os.path.join(str(output_dir), SHARD_PARTIALS_DIR)
+    if not os.path.isdir(partial_dir):
+        return []
+    entries = []
+    for fname in sorted(os.listdir(partial_dir)):
+        if fname.endswith(".json"):
+            with open(os.path.join(partial_dir, fname)) as f:
+                entries.append(json.load(f))
+    return entries
+
+
+def list_shards(output_dir: str) -> List[str]:
+    data_dir = os.path.join(str(output_dir), "data")
+    if not os.path.isdir(data_dir):
+        return []
+    return sorted(os.path.join("data", f) for f in os.listdir(data_dir) if f.endswith(".parquet"))
+
+
+def load_manifest(output_dir: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(str(output_dir), MANIFEST_PATH)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(
+    output_dir: str, max_workers: int = 8, lost_values: Optional[Dict[str, int]] = None
+) -> Dict[str, Any]:
+    """
+    Write metadata/manifest.json for the shards in output_dir/data and the metadata files.
+    lost_values counts the values lost in the MEDS casts by kind (see meds_writer.drain_lost_values);
+    if not given, the counts of the previous manifest are kept.
+    """
+    output_dir = str(output_dir)
+    previous = load_manifest(output_dir) or {}
+    previous_shards = {entry["path"]: entry for entry in previous.get("shards", [])}
+
+    def entry(path: str) -> Dict[str, Any]:
+        # Shards are immutable once written: an unchanged size and mtime means an unchanged file
+        old = previous_shards.get(path)
+        stat = os.stat(os.path.join(output_dir, path))
+        if old is not None and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+            return old
+        return shard_entry(output_dir, path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shards = list(executor.map(entry, list_shards(output_dir)))
+    shards = sorted(shards + load_shard_partials(output_dir), key=lambda shard: shard["path"])
+    metadata = {}
+    for name in METADATA_FILES:
+        path = os.path.join(output_dir, "metadata", name)
+        if os.path.exists(path):
+            metadata[name] = {"size": os.path.getsize(path), "sha256": file_sha256(path)}
+    times = [t for shard in shards for t in (shard["min_time"], shard["max_time"]) if t is not None]
+    manifest = {
+        "manifest_version": MANIFEST_VERSION,
+        "created_at": datetime.datetime.now().isoformat(),
+        "n_shards": len(shards),
+        "n_rows": sum(shard["n_rows"] for shard in shards),
+        "min_time": min(times) if times else None,
+        "max_time": max(times) if times else None,
+        "schema_fingerprints": sorted({shard["schema_fingerprint"] for shard in shards}),
+        "data_sha256": hashlib.sha256(
+            "".join(f"{shard['path']}:{shard['sha256']}\n" for shard in shards).encode()
+        ).hexdigest(),
+        "shards": shards,
+        "metadata": metadata,
+        "lost_values": lost_values if lost_values is not None else previous.get("lost_values", {}),
+    }
+    os.makedirs(os.path.join(output_dir, "metadata"), exist_ok=True)
+    tmp_path = os.path.join(output_dir, MANIFEST_PATH + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(output_dir, MANIFEST_PATH))
+    logging.info(f"Wrote manifest of {len(shards)} shards ({manifest['n_rows']} rows) to {MANIFEST_PATH}")
+    return manifest
+
+
+def meds_schema() -> pa.Schema:
+    from meds import DataSchema
+
+    return DataSchema.schema()
+
+
+def check_footer(output_dir: str, entry: Dict[str, Any], schema: pa.Schema) -> List[str]:
+    """
+    Problems of a shard found from its Parquet footer: schema, row count, size and the null counts
+    and time range of the row-group statistics.
+    """
+    path = entry["path"]
+    full_path = os.path.join(output_dir, path)
+    problems = []
+    metadata = pq.read_metadata(full_path)
+    arrow_schema = metadata.schema.to_arrow_schema()
+    for field in schema:
+        if field.name not in arrow_schema.names:
+            problems.append(f"{path}: missing column {field.name}")
+        elif not arrow_schema.field(field.name).type.equals(field.type):
+            actual = arrow_schema.field(field.name).type
+            problems.append(f"{path}: column {field.name} is {actual}, expected {field.type}")
+    if schema_fingerprint(arrow_schema) != entry["schema_fingerprint"]:
+        problems.append(f"{path}: schema differs from the manifest")
+    if metadata.num_rows != entry["n_rows"]:
+        problems.append(f"{path}: {metadata.num_rows} rows, manifest has {entry['n_rows']}")
+    if os.path.getsize(full_path) != entry["size"]:
+        problems.append(f"{path}: size {os.path.getsize(full_path)}, manifest has {entry['size']}")
+    columns = {name: i for i, name in enumerate(arrow_schema.names)}
+    min_times, max_times = [], []
+    for rg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(rg)
+        for name in ("subject_id", "code"):
+            stats = row_group.column(columns[name]).statistics if name in columns else None
+            if stats is not None and stats.null_count:
+                problems.append(f"{path}: {stats.null_count} null {name} values in row group {rg}")
+        stats = row_group.column(columns["time"]).statistics if "time" in columns else None
+        if stats is not None and stats.has_min_max:
+            min_times.append(stats.min)
+            max_times.append(stats.max)
+    footer_range = (
+        _isoformat(min(min_times)) if min_times else None,
+        _isoformat(max(max_times)) if max_times else None,
+    )
+    expected_range = (entry["min_time"], entry["max_time"])
+    if row_group_time_stats_complete(metadata, columns) and footer_range != expected_range:
+        problems.append(f"{path}: time range {footer_range} differs from the manifest")
+    return problems
+
+
+def row_group_time_stats_complete(metadata: pq.FileMetaData, columns: Dict[str, int]) -> bool:
+    if "time" not in columns:
+        return False
+    for rg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(rg)
+        stats = row_group.column(columns["time"]).statistics
+        if stats is None or (not stats.has_min_max and stats.null_count != row_group.num_rows):
+            return False
+    return True
+
+
+def check_values(output_dir: str, entry: Dict[str, Any], codes: Optional[pl.Series] = None) -> List[str]:
+    """
+    Problems of a shard found by reading it: checksum, non-null subject ids and codes, finite
+    numeric values, subject count and (if given) codes missing from metadata/codes.parquet.
+    """
+    path = entry["path"]
+    full_path = os.path.join(output_dir, path)
+    problems = []
+    if file_sha256(full_path) != entry["sha256"]:
+        problems.append(f"{path}: checksum differs from the manifest")
+    events = pl.read_parquet(full_path)
+    summary = events.select(
+        null_subjects=pl.col("subject_id").is_null().sum(),
+        bad_codes=(pl.col("code").is_null() | (pl.col("code") == "")).sum(),
+        non_finite=(pl.col("numeric_value").is_nan() | pl.col("numeric_value").is_infinite()).sum(),
+        n_subjects=pl.col("subject_id").n_unique(),
+    ).row(0, named=True)
+    if summary["null_subjects"]:
+        problems.append(f"{path}: {summary['null_subjects']} null subject_id values")
+    if summary["bad_codes"]:
+        problems.append(f"{path}: {summary['bad_codes']} null or empty codes")
+    if summary["non_finite"]:
+        problems.append(f"{path}: {summary['non_finite']} NaN or infinite numeric_value values")
+    if summary["n_subjects"] != entry["n_subjects"]:
+        problems.append(f"{path}: {summary['n_subjects']} subjects, manifest has {entry['n_subjects']}")
+    if codes is not None:
+        missing = events.select(pl.col("code").unique()).filter(~pl.col("code").is_in(codes.to_list())).height
+        if missing:
+            problems.append(f"{path}: {missing} codes missing from metadata/codes.parquet")
+    return problems
+
+
+def verify_output(output_dir: str, full: bool = False, max_workers: int = 8) -> List[str]:
+    """
+    Verify an output directory against its manifest and the meds DataSchema; returns the problems
+    found (empty if the output is intact). full=True also checks checksums and every value.
+    """
+    output_dir = str(output_dir)
+    manifest = load_manifest(output_dir)
+    if manifest is None:
+        return [f"{MANIFEST_PATH} not found"]
+    entries = {entry["path"]: entry for entry in manifest["shards"]}
+    shards = list_shards(output_dir)
+    problems = [f"{path}: not in the manifest" for path in shards if path not in entries]
+    problems += [f"{path}: missing" for path in entries if path not in set(shards)]
+    present = [entries[path] for path in shards if path in entries]
+    for name, expected in manifest.get("metadata", {}).items():
+        path = os.path.join(output_dir, "metadata", name)
+        if not os.path.exists(path):
+            problems.append(f"metadata/{name}: missing")
+        elif os.path.getsize(path) != expected["size"] or (full and file_sha256(path) != expected["sha256"]):
+            problems.append(f"metadata/{name}: differs from the manifest")
+    schema = meds_schema()
+    codes = None
+    codes_path = os.path.join(output_dir, "metadata", "codes.parquet")
+    if full and os.path.exists(codes_path):
+        codes = pl.read_parquet(codes_path, columns=["code"])["code"]
+
+    def check(entry: Dict[str, Any]) -> List[str]:
+        shard_problems = check_footer(output_dir, entry, schema)
+        if full:
+            shard_problems += check_values(output_dir, entry, codes)
+        return shard_problems
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for shard_problems in executor.map(check, present):
+            problems.extend(shard_problems)
+    return problems
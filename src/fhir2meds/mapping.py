@@ -0,0 +1,202 @@
+"""
+mapping.py
+----------
+The event mapping stage of a conversion: subject-associated resources to MEDS events, in-process
+(per type as event dicts, or as frames for types with wildcard paths and when normalizing units),
+in batches sized by a memory.MemoryGovernor, or on a process pool (parallel_mapping).
+"""
+
+import polars as pl
+from omegaconf import DictConfig
+
+from .cohort import make_time_window
+from .event_conversion import build_event
+from .fanout import has_wildcards, map_fanout_batch
+from .meds_writer import events_to_dataframe
+from .memory import MAP_OVERHEAD, SpilledEvents
+from .units import make_normalizer, with_unit_expression
+
+
+def map_events(
+    subject_resources, event_config, uuid_to_int, cfg: DictConfig, code_metadata=None, governor=None
+):
+    """
+    Map subject-associated resources to MEDS events, in-process or on a process pool.
+    Returns a list of event dicts, or a MEDS typed frame when mapping on a process pool.
+    With a memory.MemoryGovernor, resources are mapped in batches sized to the memory headroom
+    and the events are returned as memory.SpilledEvents.
+    The codings behind the emitted codes are recorded in code_metadata, if given.
+    """
+    max_events = cfg.get("max_events", None)
+    verbose = cfg.get("verbose", False)
+    mapping_workers = cfg.get("mapping_workers", 1)
+    time_window = make_time_window(cfg.get("time_window_start", None), cfg.get("time_window_end", None))
+    normalizer = make_normalizer(
+        cfg.get("normalize_units", False),
+        cfg.get("unit_conversions", None),
+        cfg.get("promote_numeric_text", False),
+    )
+    event_config = with_unit_expression(event_config, cfg.get("normalize_units", False))
+    if mapping_workers != 1:
+        # Map on a process pool; events come back as one MEDS typed frame
+        from .parallel_mapping import map_resources_parallel
+
+        if max_events is not None:
+            subject_resources = {
+                rtype: resources[:max_events] for rtype, resources in subject_resources.items()
+            }
+        all_events = map_resources_parallel(
+            subject_resources,
+            event_config,
+            uuid_to_int,
+            max_workers=mapping_workers,
+            batch_size=cfg.get("mapping_batch_size", 5000),
+            verbose=verbose,
+            code_metadata=code_metadata,
+            time_window=time_window,
+            governor=governor,
+            normalizer=normalizer,
+        )
+    else:
+        all_events = [] if governor is None else SpilledEvents(governor)
+        # Types with wildcard paths (and all types when normalizing) are mapped to frames, which keep
+        # the mapping order
+        fanout_frames = []
+        for rtype, resources in subject_resources.items():
+            if verbose:
+                print(f"\nProcessing {len(resources)} {rtype} resources...")
+            if max_events is not None and len(resources) > max_events:
+                if verbose:
+                    print(f"Limiting to first {max_events} {rtype} resources for debugging.")
+                resources = resources[:max_events]
+            config = event_config.get(rtype, event_config["default"])
+            if governor is None and has_wildcards({**event_config["default"], **config}):
+                frame, filtered_out = map_fanout_batch(
+                    resources,
+                    config,
+                    uuid_to_int,
+                    event_config["default"],
+                    time_window,
+                    code_metadata,
+                    normalizer,
+                )
+                if verbose:
+                    print(
+                        f"Mapped {frame.height} events from {rtype}. {filtered_out} resources without events."
+                    )
+                fanout_frames.append((len(all_events), frame))
+                continue
+            if governor is not None:
+                map_governed(
+                    resources,
+                    rtype,
+                    event_config,
+                    uuid_to_int,
+                    time_window,
+                    code_metadata,
+                    governor,
+                    all_events,
+                    cfg.get("mapping_batch_size", 5000),
+                    normalizer,
+                )
+                continue
+            mapped_events = [
+                build_event(
+                    res,
+                    event_config.get(rtype, event_config["default"]),
+                    uuid_to_int,
+                    event_config["default"],
+                    time_window=time_window,
+                )
+                for res in resources
+            ]
+            # Filter out events with missing subject_id or outside of the time window
+            events = [
+                e for e in mapped_events if e is not None and e.get("subject_id") not in (None, "", "null")
+            ]
+            if code_metadata is not None:
+                config = event_config.get(rtype, event_config["default"])
+                for res, event in zip(resources, mapped_events):
+                    if event is not None and event.get("subject_id") not in (None, "", "null"):
+                        code_metadata.observe(res, config, event)
+            filtered_out = len(mapped_events) - len(events)
+            if verbose:
+                print(
+                    f"Mapped {len(events)} events from {rtype}. "
+                    f"Filtered out {filtered_out} events due to missing subject_id or other issues."
+                )
+                if filtered_out > 0:
+                    print(f"Example filtered event: {mapped_events[0] if mapped_events else 'None'}")
+            if normalizer is not None:
+                # Values are normalized column-wise, on a frame per type
+                fanout_frames.append((len(all_events), events_to_dataframe(events, normalizer=normalizer)))
+                continue
+            all_events.extend(events)
+        if fanout_frames:
+            all_events = interleave_frames(all_events, fanout_frames)
+    return all_events
+
+
+def interleave_frames(events, frames):
+    """
+    Combine event dicts with frames mapped columnar, each inserted at its (position, frame) in events.
+    """
+    parts = []
+    start = 0
+    for position, frame in frames:
+        if position > start:
+            parts.append(events_to_dataframe(events[start:position]))
+        parts.append(frame)
+        start = position
+    if start < len(events):
+        parts.append(events_to_dataframe(events[start:]))
+    return pl.concat(parts, how="vertical_relaxed")
+
+
+def map_governed(
+    resources,
+    rtype,
+    event_config,
+    uuid_to_int,
+    time_window,
+    code_metadata,
+    governor,
+    spilled,
+    batch_size,
+    normalizer=None,
+):
+    """
+    Map the resources of one type in batches sized by the governor, appending each batch to
+    spilled (memory.SpilledEvents) as a MEDS typed frame.
+    """
+    config = event_config.get(rtype, event_config["default"])
+    fanout = has_wildcards({**event_config["default"], **config})
+    start = 0
+    while start < len(resources):
+        batch = resources[start : start + governor.batch_rows(f"map:{rtype}", batch_size)]
+        if fanout:
+            frame, _ = map_fanout_batch(
+                batch, config, uuid_to_int, event_config["default"], time_window, code_metadata, normalizer
+            )
+            governor.observe(f"map:{rtype}", frame.estimated_size() * MAP_OVERHEAD, len(batch))
+            spilled.append(frame)
+            start += len(batch)
+            continue
+        events = []
+        for res in batch:
+            event = build_event(res, config, uuid_to_int, event_config["default"], time_window=time_window)
+            if event is not None and event.get("subject_id") not in (None, "", "null"):
+                if code_metadata is not None:
+                    code_metadata.observe(res, config, event)
+                events.append(event)
+        frame = events_to_dataframe(events, normalizer=normalizer)
+        governor.observe(f"map:{rtype}", frame.estimated_size() * MAP_OVERHEAD, len(batch))
+        spilled.append(frame)
+        start += len(batch)
+
+
+def release_events(events, governor) -> None:
+    if isinstance(events, SpilledEvents):
+        events.close()
+    if governor is not None:
+        governor.log()
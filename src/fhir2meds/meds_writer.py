@@ -1,11 +1,34 @@
+import logging
 import os
+import threading
 import traceback
-import pyarrow.parquet as pq
-from typing import List, Dict, Any
-import polars as pl
-from meds import DataSchema
+from collections import Counter, deque
 from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
+
+import polars as pl
 import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .manifest import write_shard_partial, written_shard_entry
+from .sharding import write_split_partial
+from .storage import PART_SIZE, DigestWriter, open_output
+from .subject_index import write_index_partial
+from .units import UNIT_COLUMN
+
+if TYPE_CHECKING:
+    from .memory import MemoryGovernor, SpilledEvents
+
+# Copies of a shard alive while it is written (slice, sorted frame, Arrow table)
+WRITE_COPIES = 3
+MIN_SHARD_ROWS = 1000
+FLOAT32_MAX = 3.4028234663852886e38
+# Values lost in the non-strict MEDS casts of this process, by kind (see drain_lost_values)
+LOST_VALUES: Counter = Counter()
+_LOST_VALUES_LOCK = threading.Lock()
+STRICT_CASTS = False
+
 
 def robust_cast_time_column(pl_df):
     if "time" in pl_df.columns:
@@ -27,10 +50,66 @@ def robust_cast_time_column(pl_df):
             .otherwise(None)
             .alias("time")
         )
-    print(pl_df.head(5))
+    logging.debug(pl_df.head(5))
     return pl_df
 
+
+def count_lossy_casts(pl_df):
+    """
+    Count the values the non-strict MEDS casts of cast_to_meds_schema would lose, by kind: integer
+    subject_ids out of the Int64 range (cast to null) and numeric values that overflow Float32 (cast
+    to inf) or are not numbers (cast to null). Non-integer subject_id strings (unresolved patient
+    references) are not counted; their rows are dropped when the shard is written.
+    """
+    lost = {}
+    if "subject_id" in pl_df.columns and pl_df.schema["subject_id"].is_integer():
+        subject_id = pl.col("subject_id")
+        out_of_range = subject_id.is_not_null() & subject_id.cast(pl.Int64, strict=False).is_null()
+        lost["subject_id values out of the Int64 range"] = pl_df.select(out_of_range.sum()).item()
+    if "numeric_value" in pl_df.columns:
+        value = pl.col("numeric_value")
+        dtype = pl_df.schema["numeric_value"]
+        if dtype.is_numeric():
+            out_of_range = value.cast(pl.Float64).abs() > FLOAT32_MAX
+            lost["numeric_value values out of the Float32 range"] = pl_df.select(out_of_range.sum()).item()
+        elif dtype != pl.Null:
+            not_numbers = value.is_not_null() & value.cast(pl.Float64, strict=False).is_null()
+            lost["numeric_value values that are not numbers"] = pl_df.select(not_numbers.sum()).item()
+    return {kind: n for kind, n in lost.items() if n}
+
+
+def set_strict_casts(strict: bool) -> None:
+    """
+    Make cast_to_meds_schema raise on lossy casts (strict_casts) instead of counting them.
+    """
+    global STRICT_CASTS
+    STRICT_CASTS = strict
+
+
+def record_lost_values(lost):
+    with _LOST_VALUES_LOCK:
+        LOST_VALUES.update(lost)
+
+
+def drain_lost_values():
+    """
+    Return and reset the values lost in the MEDS casts since the last drain, by kind.
+    """
+    with _LOST_VALUES_LOCK:
+        lost = dict(LOST_VALUES)
+        LOST_VALUES.clear()
+    return lost
+
+
 def cast_to_meds_schema(pl_df):
+    lost = count_lossy_casts(pl_df)
+    if lost:
+        summary = ", ".join(f"{n} {kind}" for kind, n in lost.items())
+        if STRICT_CASTS:
+            raise ValueError(f"Events cannot be cast to the MEDS schema: {summary}")
+        # A few bad source values must not abort a conversion; they are counted in the manifest
+        logging.warning(f"Casting events to the MEDS schema loses {summary}")
+        record_lost_values(lost)
     # Todo: check whats happening with
     # subject_id: Int64
     if "subject_id" in pl_df.columns:
@@ -49,18 +128,23 @@ def cast_to_meds_schema(pl_df):
         pl_df = pl_df.with_columns(pl.col("text_value").cast(pl.Utf8, strict=False))
     return pl_df
 
+
 def cast_arrow_table_to_meds_schema(arrow_table):
-    schema = pa.schema([
-        pa.field("subject_id", pa.int64(), nullable=False),
-        pa.field("time", pa.timestamp("us"), nullable=True),
-        pa.field("code", pa.string(), nullable=False),
-        pa.field("numeric_value", pa.float32(), nullable=True),
-        pa.field("text_value", pa.large_string(), nullable=True),
-    ])
+    schema = pa.schema(
+        [
+            pa.field("subject_id", pa.int64(), nullable=False),
+            pa.field("time", pa.timestamp("us"), nullable=True),
+            pa.field("code", pa.string(), nullable=False),
+            pa.field("numeric_value", pa.float32(), nullable=True),
+            pa.field("text_value", pa.large_string(), nullable=True),
+        ]
+    )
     # Only cast columns that exist in the table
     fields = [f for f in schema if f.name in arrow_table.schema.names]
     cast_schema = pa.schema(fields)
-    return arrow_table.cast(cast_schema, safe=False)
+    # A safe cast raises on overflows and truncation instead of writing garbage values
+    return arrow_table.cast(cast_schema, safe=True)
+
 
 def cast_arrow_code_to_string(arrow_table):
     schema = arrow_table.schema
@@ -74,9 +158,11 @@ def cast_arrow_code_to_string(arrow_table):
     # Cast the table to the new schema
     return arrow_table.cast(new_schema)
 
+
 def build_patient_id_map(patient_dir):
-    import os
     import json
+    import os
+
     uuid_to_int = {}
     for fname in os.listdir(patient_dir):
         if fname.endswith(".json") or fname.endswith(".ndjson"):
@@ -90,7 +176,8 @@ def build_patient_id_map(patient_dir):
                         for ident in data.get("identifier", []):
                             if ident.get("system", "").endswith("/identifier/patient"):
                                 uuid_to_int[uuid] = int(ident["value"])
-    return uuid_to_int 
+    return uuid_to_int
+
 
 def safe_str(val):
     if val is None:
@@ -100,54 +187,201 @@ def safe_str(val):
     # If it's a datetime, convert to ISO string
     if hasattr(val, "isoformat"):
         return val.isoformat()
-    return str(val) 
+    return str(val)
+
 
+def events_to_dataframe(events, required_cols=None, normalizer=None):
+    """
+    Build a frame with the MEDS columns and types from a list of event dicts.
+    Rows without a subject_id are kept here and dropped when the shard is written.
+    With a units.ValueNormalizer, the values are normalized (using the unit of the events).
+    """
+    if required_cols is None:
+        required_cols = list(meds_required_columns())
+    pl_df = pl.DataFrame(events, infer_schema_length=10000)
+    for col in required_cols:
+        if col not in pl_df.columns:
+            pl_df = pl_df.with_columns(pl.lit(None).alias(col))
+    if normalizer is None:
+        return cast_to_meds_schema(pl_df.select(required_cols))
+    unit = [UNIT_COLUMN] if UNIT_COLUMN in pl_df.columns else []
+    return normalizer.apply(cast_to_meds_schema(pl_df.select([*required_cols, *unit]))).select(required_cols)
 
-def write_single_shard(shard, required_cols, output_dir, shard_idx, verbose=False):
+
+def write_single_shard(
+    shard,
+    required_cols,
+    output_dir,
+    shard_idx,
+    verbose=False,
+    shard_prefix="",
+    split_fractions=None,
+    split_seed=0,
+    subject_index=False,
+    row_group_size=None,
+    output_uri=None,
+    part_size=PART_SIZE,
+):
     try:
         data_dir = os.path.join(output_dir, "data")
 
-        os.makedirs(data_dir, exist_ok=True)
+        if not output_uri:
+            os.makedirs(data_dir, exist_ok=True)
         if verbose:
             print(f"Writing shard {shard_idx} with {len(shard)} events to {data_dir}")
-        if shard_idx ==1:
-            print(f"Shard {shard_idx} has {len(shard)} events.")
-        pl_df = pl.DataFrame(shard, infer_schema_length=10000)
-        if shard_idx == 1:
-            print(f"shard test: {shard_idx}")
-            print(f"time {shard_idx}: {pl_df['time'].is_null().sum()}")
-            print(f"text_value {shard_idx}: {pl_df['text_value'].is_null().sum()}")
-            print(f"code {shard_idx}: {pl_df['code'].is_null().sum()}")
-            print(f"numeric_value {shard_idx}: {pl_df['numeric_value'].is_null().sum()}")
-            print(f"subject_id {shard_idx}: {pl_df['subject_id'].is_null().sum()}")
-        for col in required_cols:
-            if col not in pl_df.columns:
-                pl_df = pl_df.with_columns(pl.lit(None).alias(col))
-        pl_df = pl_df.select(required_cols)
-        pl_df = cast_to_meds_schema(pl_df)
+        # Shards sliced from a frame built by events_to_dataframe are already MEDS typed
+        pl_df = shard if isinstance(shard, pl.DataFrame) else events_to_dataframe(shard, required_cols)
+        if verbose:
+            print(f"Null counts in shard {shard_idx}: {pl_df.null_count().to_dicts()[0]}")
         # if verbose:
         #     # print("subject_id values before filtering:", pl_df["subject_id"])
         null_rows = pl_df.filter(pl.col("subject_id").is_null())
+        if null_rows.height > 0:
+            logging.warning(
+                f"Dropping {null_rows.height} events without an integer subject_id from shard {shard_idx}"
+            )
         if verbose and null_rows.height > 0:
             print("Rows with null subject_id:", null_rows)
         pl_df = pl_df.filter(pl.col("subject_id").is_not_null())
+        if subject_index:
+            # Sorted shards keep every subject in a contiguous run of rows and row groups
+            pl_df = pl_df.sort("subject_id", "time", nulls_last=False, maintain_order=True)
         arrow_table = pl_df.to_arrow()
         arrow_table = cast_arrow_table_to_meds_schema(arrow_table)
         if verbose:
             print("Arrow table schema before validation:", arrow_table.schema)
         if verbose:
             print("Validated table:", arrow_table)
-        pq.write_table(arrow_table, os.path.join(data_dir, f"{shard_idx}.parquet"))
+        shard_path = os.path.join(data_dir, f"{shard_prefix}{shard_idx}.parquet")
+        footer = None
+        if output_uri:
+            # Streamed to the output URL in part_size parts, nothing is staged on local disk
+            path = f"data/{shard_prefix}{shard_idx}.parquet"
+            collector = []
+            with open_output(f"{output_uri.rstrip('/')}/{path}", part_size) as f, DigestWriter(f) as writer:
+                pq.write_table(
+                    arrow_table, writer, row_group_size=row_group_size, metadata_collector=collector
+                )
+            footer = collector[0]
+            entry = written_shard_entry(path, pl_df, arrow_table.schema, writer.size, writer.sha256())
+            write_shard_partial(output_dir, f"{shard_prefix}{shard_idx}", entry)
+        else:
+            pq.write_table(arrow_table, shard_path, row_group_size=row_group_size)
+        if subject_index:
+            write_index_partial(output_dir, f"{shard_prefix}{shard_idx}", pl_df, shard_path, footer)
+        if split_fractions is not None:
+            # Each shard assigns the splits of its own subjects, assemble_subject_splits combines them
+            subject_ids = pl_df["subject_id"].unique().to_list()
+            write_split_partial(
+                output_dir, f"{shard_prefix}{shard_idx}", subject_ids, split_fractions, split_seed
+            )
         if verbose:
             print(f"Shard {shard_idx} written successfully.")
     except Exception as e:
+        # A missing shard must fail the conversion, not be left out of the manifest
         print(f"Error writing shard {shard_idx}: {e}")
         traceback.print_exc()
+        raise
 
-def write_meds_sharded_parquet(events: List[Dict[str, Any]], output_dir: str, shard_size: int = 10000, max_workers: int = 4, verbose: bool = False):
+
+@lru_cache(maxsize=None)
+def meds_required_columns():
+    """
+    Column names of the MEDS DataSchema. meds is imported on first use to keep CLI startup fast.
+    """
+    from meds import DataSchema
+
+    return tuple(DataSchema.schema().names)
+
+
+def iter_shards(events, shard_size: int, governor=None):
+    """
+    Yield the shards of events: slices of at most shard_size rows of a list of event dicts, a frame
+    or SpilledEvents (re-chunked across its spilled frames). With a memory.MemoryGovernor, shards
+    of frames are made smaller when shard_size rows would not fit the remaining headroom.
+    """
+    from .memory import SpilledEvents
+
+    if not isinstance(events, SpilledEvents):
+        rows = _shard_rows(events, shard_size, governor)
+        for i in range(0, len(events), rows):
+            yield events[i : i + rows]
+        return
+    carry = None
+    for chunk in events.iter_frames():
+        carry = chunk if carry is None else pl.concat([carry, chunk], how="vertical_relaxed")
+        rows = _shard_rows(carry, shard_size, governor)
+        while carry.height >= rows:
+            yield carry[:rows]
+            carry = carry[rows:]
+    if carry is not None and carry.height > 0:
+        yield carry
+
+
+def _shard_rows(events, shard_size, governor):
+    if governor is None or not isinstance(events, pl.DataFrame) or events.height == 0:
+        return shard_size
+    # Writing holds the sorted copy and the Arrow table of a shard besides its slice
+    governor.observe("write", events.estimated_size() * WRITE_COPIES, events.height)
+    return governor.batch_rows("write", shard_size, minimum=min(shard_size, MIN_SHARD_ROWS))
+
+
+def write_meds_sharded_parquet(
+    events: Union[List[Dict[str, Any]], pl.DataFrame, "SpilledEvents"],
+    output_dir: str,
+    shard_size: int = 10000,
+    max_workers: int = 4,
+    verbose: bool = False,
+    shard_prefix: str = "",
+    split_fractions: Optional[Dict[str, float]] = None,
+    split_seed: int = 0,
+    subject_index: bool = False,
+    row_group_size: Optional[int] = None,
+    governor: Optional["MemoryGovernor"] = None,
+    output_uri: Optional[str] = None,
+    part_size: int = PART_SIZE,
+):
+    """
+    Write events as data/{shard_prefix}{shard_idx}.parquet files of at most shard_size rows.
+    events is either a list of event dicts, a frame built by events_to_dataframe or
+    memory.SpilledEvents.
+    Distributed workers pass a distinct shard_prefix so their shards never collide.
+    If split_fractions is given, every shard also writes the subject splits of its subjects
+    (see sharding.write_split_partial).
+    If subject_index is True, shards are sorted by (subject_id, time) and index their subjects
+    (see subject_index.write_index_partial); row_group_size sets the rows per Parquet row group.
+    At most max_workers shards are in flight; with a memory.MemoryGovernor, shards are sized to the
+    memory headroom and only one is in flight while the governor reports pressure.
+    With an output_uri (fsspec URL), the shards are written to output_uri/data in part_size parts
+    instead of output_dir/data; the metadata files stay in output_dir.
+    """
     os.makedirs(output_dir, exist_ok=True)
-    required_cols = list(DataSchema.schema().names)
-    n = len(events)
-    shards = [(events[i:i+shard_size], required_cols, output_dir, i//shard_size, verbose) for i in range(0, n, shard_size)]
+    required_cols = list(meds_required_columns())
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        executor.map(lambda args: write_single_shard(*args), shards) 
\ No newline at end of file
+        pending = deque()
+        for shard_idx, shard in enumerate(iter_shards(events, shard_size, governor)):
+            while pending and (
+                len(pending) >= max_workers or (governor is not None and governor.under_pressure())
+            ):
+                pending.popleft().result()
+                if governor is not None:
+                    governor.relieve()
+            pending.append(
+                executor.submit(
+                    write_single_shard,
+                    shard,
+                    required_cols,
+                    output_dir,
+                    shard_idx,
+                    verbose,
+                    shard_prefix,
+                    split_fractions,
+                    split_seed,
+                    subject_index,
+                    row_group_size,
+                    output_uri,
+                    part_size,
+                )
+            )
+        for future in pending:
+            future.result()
@@ -0,0 +1,241 @@
+"""
+memory.py
+---------
+Memory budget of a conversion (memory_limit). A MemoryGovernor measures the resident set size of
+the process and its mapping workers (from /proc, with resource.getrusage as fallback) and learns
+the bytes per row of the Arrow batches flowing through each stage. From those it sizes the next
+batch of the mapper and the next shard of the writer to fit the remaining headroom, and reports
+pressure once RSS passes HIGH_WATER of the budget. Under pressure the mapper and writer stop
+submitting work until outstanding batches finish (backpressure), and mapped events are spilled
+from memory to Parquet files (SpilledEvents) that the writer reads back one at a time. The reader
+holds every decoded resource (deduplication and the patient map need all of them), so it can only
+fail early with a MemoryError instead of being killed; sharded execution is the remedy there.
+"""
+
+import gc
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import weakref
+from typing import Dict, Iterator, List, Optional, Union
+
+import polars as pl
+
+# Fraction of the budget above which the governor reports pressure
+HIGH_WATER = 0.8
+# Share of the headroom a single in-flight batch may take
+BATCH_FRACTION = 0.25
+# Share of the budget mapped events may take in memory before they are spilled
+SPILL_FRACTION = 0.25
+# Resources and event dicts of a mapping batch in flight, relative to the Arrow size of its events
+MAP_OVERHEAD = 8
+# Smoothing of the measured bytes per row
+EMA_WEIGHT = 0.5
+UNITS = {"": 1, "B": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+SIZE_PATTERN = re.compile(r"^\s*([0-9.]+)\s*([KMGT]?)(I?B)?\s*$", re.IGNORECASE)
+
+
+def physical_memory() -> int:
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def parse_memory_limit(value: Union[int, float, str]) -> int:
+    """
+    Budget in bytes from a byte count, a size with unit (K/M/G/T, decimal units are read as
+    binary) or a percentage of the physical memory.
+
+    Examples:
+        >>> parse_memory_limit(1024), parse_memory_limit("512MiB"), parse_memory_limit("2G")
+        (1024, 536870912, 2147483648)
+        >>> parse_memory_limit("50%") == physical_memory() // 2
+        True
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip()
+    if text.endswith("%"):
+        return int(physical_memory() * float(text[:-1]) / 100)
+    match = SIZE_PATTERN.match(text)
+    if match is None:
+        raise ValueError(f"Invalid memory_limit {value!r}, expected e.g. 8GiB, 512MB or 75%")
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+def _statm_rss(pid: Union[int, str]) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def process_rss(include_children: bool = True) -> int:
+    """
+    Current RSS of this process plus (if include_children) its live child processes, such as the
+    mapping workers. Without /proc, the peak RSS of the process is used.
+    """
+    rss = _statm_rss("self")
+    if rss is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    if include_children:
+        rss += sum(_statm_rss(child.pid) or 0 for child in multiprocessing.active_children())
+    return rss
+
+
+class MemoryGovernor:
+    """
+    Budget of limit bytes, shared by the reader, mapper and writer of a conversion.
+    """
+
+    def __init__(self, limit: int, spill_dir: Optional[str] = None):
+        if limit <= 0:
+            raise ValueError(f"memory_limit must be positive, got {limit}")
+        self.limit = limit
+        self.spill_dir = spill_dir
+        self.bytes_per_row: Dict[str, float] = {}
+        self.n_waits = 0
+
+    def rss(self) -> int:
+        return process_rss()
+
+    def headroom(self) -> int:
+        return max(self.limit - self.rss(), 0)
+
+    def under_pressure(self) -> bool:
+        return self.rss() >= self.limit * HIGH_WATER
+
+    def observe(self, key: str, nbytes: int, rows: int) -> None:
+        """
+        Record the size of a batch of rows of a stage (key), e.g. its Arrow buffer size.
+        """
+        if rows <= 0:
+            return
+        per_row = nbytes / rows
+        previous = self.bytes_per_row.get(key)
+        self.bytes_per_row[key] = (
+            per_row if previous is None else EMA_WEIGHT * per_row + (1 - EMA_WEIGHT) * previous
+        )
+
+    def batch_rows(self, key: str, default: int, minimum: int = 1) -> int:
+        """
+        Rows of the next batch of a stage: default until its rows were measured, then as many as
+        fit BATCH_FRACTION of the headroom, between minimum and default.
+
+        Examples:
+            >>> governor = MemoryGovernor(1 << 40)
+            >>> governor.batch_rows("write", 10000)
+            10000
+            >>> governor.observe("write", nbytes=1 << 40, rows=10)
+            >>> governor.batch_rows("write", 10000, minimum=100)
+            100
+        """
+        per_row = self.bytes_per_row.get(key)
+        if not per_row:
+            return default
+        rows = int(self.headroom() * BATCH_FRACTION / per_row)
+        return max(minimum, min(default, rows))
+
+    def relieve(self) -> bool:
+        """
+        Under pressure, collect garbage; return whether the process is below the high-water mark.
+        """
+        if not self.under_pressure():
+            return True
+        self.n_waits += 1
+        gc.collect()
+        return not self.under_pressure()
+
+    def check(self, stage: str) -> None:
+        """
+        Raise a MemoryError if RSS exceeds the budget even after collecting garbage, so a stage
+        that cannot spill stops cleanly instead of being killed by the OOM killer.
+        """
+        if self.rss() < self.limit:
+            return
+        gc.collect()
+        rss = self.rss()
+        if rss >= self.limit:
+            raise MemoryError(
+                f"{stage} uses {rss >> 20} MiB, more than memory_limit ({self.limit >> 20} MiB). "
+                "Convert with num_workers > 1, a cohort_path or a larger memory_limit"
+            )
+
+    def log(self) -> None:
+        sizes = ", ".join(
+            f"{key}: {int(per_row)} B/row" for key, per_row in sorted(self.bytes_per_row.items())
+        )
+        logging.info(
+            f"Memory: RSS {self.rss() >> 20} MiB of {self.limit >> 20} MiB budget, "
+            f"{self.n_waits} waits under pressure ({sizes})"
+        )
+
+
+class SpilledEvents:
+    """
+    MEDS typed event frames in mapping order. Frames stay in memory until they take SPILL_FRACTION
+    of the budget or the governor reports pressure; then they are written to a Parquet spill file.
+    """
+
+    def __init__(self, governor: MemoryGovernor):
+        self.governor = governor
+        self.frames: List[pl.DataFrame] = []
+        self.nbytes = 0
+        self.spill_paths: List[str] = []
+        self.n_rows = 0
+        self._dir: Optional[str] = None
+        self._cleanup = None
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def append(self, frame: pl.DataFrame) -> None:
+        self.frames.append(frame)
+        self.n_rows += frame.height
+        self.nbytes += frame.estimated_size()
+        if self.nbytes >= self.governor.limit * SPILL_FRACTION or self.governor.under_pressure():
+            self.spill()
+
+    def spill(self) -> None:
+        if not self.frames:
+            return
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix="fhir2meds_spill_", dir=self.governor.spill_dir)
+            self._cleanup = weakref.finalize(self, shutil.rmtree, self._dir, True)
+        path = os.path.join(self._dir, f"{len(self.spill_paths)}.parquet")
+        pl.concat(self.frames, how="vertical_relaxed").write_parquet(path)
+        logging.info(
+            f"Spilled {sum(f.height for f in self.frames)} events ({self.nbytes >> 20} MiB) to {path}"
+        )
+        self.spill_paths.append(path)
+        self.frames = []
+        self.nbytes = 0
+        gc.collect()
+
+    def iter_frames(self) -> Iterator[pl.DataFrame]:
+        """
+        Yield the events in order, reading the spill files back one at a time.
+        """
+        for path in self.spill_paths:
+            yield pl.read_parquet(path)
+        yield from self.frames
+
+    def collect(self) -> pl.DataFrame:
+        from .meds_writer import events_to_dataframe
+
+        frames = list(self.iter_frames())
+        return pl.concat(frames, how="vertical_relaxed") if frames else events_to_dataframe([])
+
+    def close(self) -> None:
+        """
+        Remove the spill files.
+        """
+        self.frames = []
+        if self._cleanup is not None:
+            self._cleanup()
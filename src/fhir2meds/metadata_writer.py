@@ -1,9 +1,14 @@
-import os
-import json
 import datetime
+import json
+import logging
+import os
+
+import polars as pl
 import pyarrow as pa
 import pyarrow.parquet as pq
-import logging
+
+from .memory import SpilledEvents
+
 
 def write_dataset_metadata(
     output_dir,
@@ -55,18 +60,61 @@ def write_dataset_metadata(
         json.dump(metadata, f, indent=2)
 
 
-def write_codes_metadata(output_dir, events):
+def event_codes(events):
     """
-    Write code metadata to metadata/codes.parquet in the output directory.
-    Matches CodeMetadataSchema: code, description, parent_codes.
+    Distinct non-empty codes of a list of event dicts, an events frame or memory.SpilledEvents.
+    """
+    if isinstance(events, SpilledEvents):
+        return set().union(*(event_codes(frame) for frame in events.iter_frames()))
+    if isinstance(events, pl.DataFrame):
+        return set(events.filter(pl.col("code").is_not_null() & (pl.col("code") != ""))["code"].to_list())
+    return set(e["code"] for e in events if e.get("code"))
+
+
+def event_subject_ids(events):
+    """
+    Distinct non-null subject ids of a list of event dicts, an events frame or memory.SpilledEvents.
+    """
+    if isinstance(events, SpilledEvents):
+        return set().union(*(event_subject_ids(frame) for frame in events.iter_frames()))
+    if isinstance(events, pl.DataFrame):
+        return set(events["subject_id"].drop_nulls().to_list())
+    return set(e["subject_id"] for e in events if e.get("subject_id") is not None)
+
+
+def build_codes_table(events, code_metadata=None):
+    """
+    Build the code metadata table (code, description, parent_codes) for the given events.
+    Descriptions and parents come from code_metadata (a code_metadata.CodeMetadata collected while
+    mapping); codes without a known description are described by the code itself.
+    """
+    return codes_table(list(event_codes(events)), code_metadata)
+
+
+def codes_table(codes, code_metadata=None):
     """
-    codes = set(e["code"] for e in events if e.get("code"))
+    Build the code metadata table of the given codes, described by code_metadata.
+    """
+    descriptions = []
+    parent_codes = []
+    for code in codes:
+        description, parents = code_metadata.describe(code) if code_metadata is not None else (None, [])
+        descriptions.append(description or code)
+        parent_codes.append(parents)
     data = {
-        "code": list(codes),
-        "description": [c for c in codes],
-        "parent_codes": [[] for _ in codes],
+        "code": pa.array(codes, type=pa.string()),
+        "description": pa.array(descriptions, type=pa.string()),
+        "parent_codes": pa.array(parent_codes, type=pa.list_(pa.string())),
     }
-    table = pa.table(data)
+    return pa.table(data)
+
+
+def write_codes_metadata(output_dir, events, code_metadata=None):
+    """
+    Write code metadata to metadata/codes.parquet in the output directory.
+    Matches CodeMetadataSchema: code, description, parent_codes.
+    """
+    table = build_codes_table(events, code_metadata)
     pq.write_table(table, os.path.join(output_dir, "metadata", "codes.parquet"))
 
 
@@ -75,10 +123,18 @@ def write_subject_splits(output_dir, events, split_name="train"):
     Write subject splits to metadata/subject_splits.parquet in the output directory.
     Columns: subject_id, split. All assigned to split_name by default.
     """
-    subject_ids = set(e["subject_id"] for e in events if e.get("subject_id") is not None)
+    subject_ids = event_subject_ids(events)
+    write_subject_splits_for_ids(output_dir, subject_ids, split_name=split_name)
+
+
+def write_subject_splits_for_ids(output_dir, subject_ids, split_name="train"):
+    """
+    Write subject splits for an already collected set of subject ids.
+    """
+    subject_ids = set(subject_ids)
     data = {
         "subject_id": list(subject_ids),
         "split": [split_name] * len(subject_ids),
     }
     table = pa.table(data)
-    pq.write_table(table, os.path.join(output_dir, "metadata", "subject_splits.parquet")) 
\ No newline at end of file
+    pq.write_table(table, os.path.join(output_dir, "metadata", "subject_splits.parquet"))
@@ -0,0 +1,257 @@
+"""
+parallel_mapping.py
+-------------------
+Process-pool version of the event mapping stage.
+Resources are mapped with build_event in batches on worker processes, each of which returns a
+columnar (MEDS typed) batch instead of a list of dicts. The patient UUID map is written once as an
+Arrow IPC file of sorted UUIDs that workers memory-map and look up with a vectorized binary search
+per batch, so it is shared through the page cache rather than pickled into every task or copied into
+a dict per worker. Workers are started with forkserver (or spawn) rather than fork: forking a parent
+whose polars/Arrow thread pools are already running deadlocks the children.
+"""
+
+import logging
+import multiprocessing
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import polars as pl
+import pyarrow as pa
+
+from . import meds_writer, profiling
+from .code_metadata import CodeMetadata
+from .cohort import TimeWindow
+from .event_conversion import build_event
+from .fanout import has_wildcards, map_fanout_batch
+from .fhir_parser import get_subject_reference
+from .meds_writer import events_to_dataframe, meds_required_columns
+from .memory import MAP_OVERHEAD, MemoryGovernor, SpilledEvents
+from .units import ValueNormalizer
+
+IN_FLIGHT_PER_WORKER = 2
+# Polars wraps string_view columns without copying them (pyarrow>=16)
+UUID_TYPE = pa.string_view() if hasattr(pa, "string_view") else pa.string()
+# Per-worker state set by _init_worker
+_STATE: Dict[str, Any] = {}
+
+
+def write_patient_map(uuid_to_int: Dict[str, int], path: str) -> None:
+    """
+    Write the patient UUID to integer map as an Arrow IPC file with columns (uuid, subject_id).
+    """
+    uuids = sorted(uuid_to_int)
+    table = pa.table(
+        {
+            "uuid": pa.array(uuids, type=UUID_TYPE),
+            "subject_id": pa.array([uuid_to_int[u] for u in uuids], type=pa.int64()),
+        }
+    )
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def open_patient_map(path: str) -> pa.Table:
+    """
+    Memory-map a patient map written by write_patient_map. The returned table does not copy the
+    file, so all workers read the same pages.
+    """
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+class PatientMap:
+    """
+    Patient UUID to integer id lookups against a memory-mapped patient map.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "map.arrow")
+    >>> write_patient_map({"b": 2, "a": 1, "c": 3}, path)
+    >>> sorted(PatientMap(open_patient_map(path)).lookup(["c", "x", "a", "c"]).items())
+    [('a', 1), ('c', 3)]
+    """
+
+    def __init__(self, table: pa.Table):
+        # The series wrap the mapped buffers, so the map is not copied into the worker
+        frame = pl.from_arrow(table)
+        self.uuids = frame["uuid"]
+        self.subject_ids = frame["subject_id"]
+
+    def lookup(self, uuids: List[str]) -> Dict[str, int]:
+        """
+        Return the integer ids of the given UUIDs that are in the map, with one binary search for all.
+        """
+        query = pl.Series(uuids, dtype=pl.String).unique()
+        if query.is_empty() or self.uuids.is_empty():
+            return {}
+        index = self.uuids.search_sorted(query, side="left")
+        in_range = index < self.uuids.len()
+        query, index = query.filter(in_range), index.filter(in_range)
+        found = self.uuids.gather(index) == query
+        return dict(
+            zip(query.filter(found).to_list(), self.subject_ids.gather(index.filter(found)).to_list())
+        )
+
+
+def _patient_map() -> PatientMap:
+    # The map is opened once per worker; every batch only resolves the patients it references
+    if "patient_map" not in _STATE:
+        _STATE["patient_map"] = PatientMap(open_patient_map(_STATE["patient_map_path"]))
+    return _STATE["patient_map"]
+
+
+def _init_worker(
+    patient_map_path: str,
+    event_config: Dict[str, Any],
+    time_window: Optional[TimeWindow] = None,
+    normalizer: Optional[ValueNormalizer] = None,
+    profile_allocations: Optional[bool] = None,
+    strict_casts: bool = False,
+) -> None:
+    _STATE["patient_map_path"] = patient_map_path
+    meds_writer.set_strict_casts(strict_casts)
+    _STATE["event_config"] = event_config
+    _STATE["time_window"] = time_window
+    # Every worker memoizes the unit conversions of the (code, unit) pairs it sees
+    _STATE["normalizer"] = normalizer
+    if profile_allocations is not None:
+        # Workers profile their batches and return the stacks with every result
+        profiling.enable(profile_allocations)
+
+
+def map_batch(
+    rtype: str, resources: List[Any]
+) -> Tuple[pl.DataFrame, int, CodeMetadata, Optional[profiling.Stats], Dict[str, int]]:
+    """
+    Map one batch of resources of a single type to a MEDS typed frame.
+    Returns the frame, the number of events dropped for a missing subject_id or outside of the time
+    window, the code metadata observed in the batch, the profiled stacks (if profiling) and the
+    values lost in the MEDS casts (see meds_writer.drain_lost_values).
+    """
+    frame, dropped, code_metadata = _map_batch(rtype, resources)
+    stats = profiling.ACTIVE.drain() if profiling.ACTIVE is not None else None
+    return frame, dropped, code_metadata, stats, meds_writer.drain_lost_values()
+
+
+def _map_batch(rtype: str, resources: List[Any]) -> Tuple[pl.DataFrame, int, CodeMetadata]:
+    event_config = _STATE["event_config"]
+    time_window = _STATE.get("time_window")
+    normalizer = _STATE.get("normalizer")
+    references = [get_subject_reference(res) for res in resources]
+    uuid_to_int = _patient_map().lookup([uuid for uuid in references if uuid is not None])
+    config = event_config.get(rtype, event_config["default"])
+    code_metadata = CodeMetadata()
+    if has_wildcards({**event_config["default"], **config}):
+        frame, dropped = map_fanout_batch(
+            resources, config, uuid_to_int, event_config["default"], time_window, code_metadata, normalizer
+        )
+        return frame, dropped, code_metadata
+    events = []
+    for res in resources:
+        event = build_event(res, config, uuid_to_int, event_config["default"], time_window=time_window)
+        if event is not None and event.get("subject_id") not in (None, "", "null"):
+            code_metadata.observe(res, config, event)
+            events.append(event)
+    frame = events_to_dataframe(events, list(meds_required_columns()), normalizer)
+    return frame, len(resources) - len(events), code_metadata
+
+
+def map_resources_parallel(
+    subject_resources: Dict[str, List[Any]],
+    event_config: Dict[str, Any],
+    uuid_to_int: Dict[str, int],
+    max_workers: Optional[int] = None,
+    batch_size: int = 5000,
+    verbose: bool = False,
+    code_metadata: Optional[CodeMetadata] = None,
+    time_window: Optional[TimeWindow] = None,
+    governor: Optional[MemoryGovernor] = None,
+    normalizer: Optional[ValueNormalizer] = None,
+) -> Union[pl.DataFrame, SpilledEvents]:
+    """
+    Map all resources to events on a process pool and return them as a single MEDS typed frame,
+    in the same order as the sequential mapping loop (mapping.map_events). At most
+    IN_FLIGHT_PER_WORKER batches per worker are submitted ahead of the results being consumed.
+
+    Args:
+        subject_resources: Subject-associated resources by type.
+        event_config: The event config for the FHIR version.
+        uuid_to_int: Patient UUID to integer id map.
+        max_workers: Number of worker processes; defaults to os.cpu_count().
+        batch_size: Number of resources mapped per task.
+        verbose: Print per-type progress.
+        code_metadata: Collects the codings of the emitted codes, if given.
+        time_window: Only keep events within this window (see cohort.make_time_window).
+        governor: A memory.MemoryGovernor; batches are then sized to the memory headroom, no new
+            batches are submitted under pressure and the events are returned as SpilledEvents.
+        normalizer: A units.ValueNormalizer the values of every batch are normalized with.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    profile_allocations = profiling.ACTIVE.allocations if profiling.ACTIVE is not None else None
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in start_methods else "spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        map_path = os.path.join(tmp_dir, "uuid_to_int.arrow")
+        write_patient_map(uuid_to_int, map_path)
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(
+                map_path,
+                event_config,
+                time_window,
+                normalizer,
+                profile_allocations,
+                meds_writer.STRICT_CASTS,
+            ),
+        ) as executor:
+            # Bounded number of batches in flight; completed batches are consumed in submission order
+            pending = deque()
+            frames = [] if governor is None else SpilledEvents(governor)
+            filtered_out: Dict[str, int] = {}
+
+            def consume():
+                rtype, n_resources, future = pending.popleft()
+                frame, dropped, batch_codes, stats, lost = future.result()
+                if stats:
+                    profiling.ACTIVE.merge(stats)
+                meds_writer.record_lost_values(lost)
+                if governor is not None:
+                    governor.observe(f"map:{rtype}", frame.estimated_size() * MAP_OVERHEAD, n_resources)
+                frames.append(frame)
+                if code_metadata is not None:
+                    code_metadata.update(batch_codes)
+                filtered_out[rtype] = filtered_out.get(rtype, 0) + dropped
+
+            for rtype, resources in subject_resources.items():
+                start = 0
+                while start < len(resources):
+                    size = batch_size if governor is None else governor.batch_rows(f"map:{rtype}", batch_size)
+                    while pending and (
+                        len(pending) >= IN_FLIGHT_PER_WORKER * max_workers
+                        or (governor is not None and governor.under_pressure())
+                    ):
+                        consume()
+                        if governor is not None:
+                            governor.relieve()
+                    batch = resources[start : start + size]
+                    pending.append((rtype, len(batch), executor.submit(map_batch, rtype, batch)))
+                    start += size
+            while pending:
+                consume()
+    if verbose:
+        for rtype, dropped in filtered_out.items():
+            print(f"Mapped {rtype}. Filtered out {dropped} events due to missing subject_id or other issues.")
+    if governor is not None:
+        logging.info(
+            f"Mapped {len(frames)} events on {max_workers} workers, {len(frames.spill_paths)} spill files"
+        )
+        return frames
+    if not frames:
+        return events_to_dataframe([], list(meds_required_columns()))
+    logging.info(
+        f"Mapped {sum(f.height for f in frames)} events in {len(frames)} batches on {max_workers} workers"
+    )
+    return pl.concat(frames, how="vertical_relaxed")
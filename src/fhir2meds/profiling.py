@@ -0,0 +1,217 @@
+"""
+profiling.py
+------------
+Opt-in cost attribution of a conversion (profile=true). While a Profiler is active, the time (and
+with allocations=True the net memory allocated, traced with tracemalloc) of every pipeline stage
+and, within mapping, of every (resource type, config key, expression) evaluated by build_event is
+accumulated per call stack, e.g.
+
+    map;Observation;code;vocab(code[coding][0][system])
+
+Input files are attributed to decode;{file name}. Mapping workers of parallel_mapping profile their
+batches themselves and send the stacks back with the results, so worker time is summed over
+processes and may exceed the wall time of the map stage. write() exports a report sorted by self
+time and the stacks in the collapsed format of flamegraph.pl / speedscope (self microseconds).
+
+Instrumented code checks ACTIVE once per call, so a disabled profiler costs one global lookup.
+"""
+
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Tuple
+
+Stack = Tuple[str, ...]
+# calls, nanoseconds, net bytes allocated
+Stats = Dict[Stack, List[int]]
+REPORT_FILE = "report.txt"
+STACKS_FILE = "stacks.folded"
+ALLOCATIONS_FILE = "allocations.folded"
+
+ACTIVE: Optional["Profiler"] = None
+
+
+class Profiler:
+    """
+    Inclusive time and allocations per call stack. The stack is the current stage followed by the
+    frames of the open sections.
+    """
+
+    def __init__(self, allocations: bool = False):
+        self.allocations = allocations
+        self.stats: Stats = {}
+        self.stack: List[str] = []
+        self._stage: Optional[Tuple[str, Tuple[int, int]]] = None
+        self._tracing = False
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+
+    def start(self) -> Tuple[int, int]:
+        return time.perf_counter_ns(), tracemalloc.get_traced_memory()[0] if self.allocations else 0
+
+    def stop(self, frames: Stack, started: Tuple[int, int]) -> None:
+        """
+        Record a call of frames (below the current stack) that started at started (see start()).
+        """
+        elapsed = time.perf_counter_ns() - started[0]
+        allocated = tracemalloc.get_traced_memory()[0] - started[1] if self.allocations else 0
+        key = (*self.stack, *frames)
+        entry = self.stats.get(key)
+        if entry is None:
+            self.stats[key] = [1, elapsed, allocated]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += allocated
+
+    @contextmanager
+    def section(self, *frames: str) -> Iterator[None]:
+        started = self.start()
+        self.stack.extend(frames)
+        try:
+            yield
+        finally:
+            del self.stack[len(self.stack) - len(frames) :]
+            self.stop(frames, started)
+
+    def stage(self, name: Optional[str]) -> None:
+        """
+        End the current pipeline stage and start stage name (None only ends it).
+        """
+        if self._stage is not None:
+            previous, started = self._stage
+            self.stack = []
+            self.stop((previous,), started)
+        self._stage = None
+        if name is not None:
+            self.stack = [name]
+            self._stage = (name, self.start())
+
+    def merge(self, stats: Stats) -> None:
+        """
+        Add stacks recorded by another profiler (e.g. of a mapping worker) below the current stack.
+        """
+        for stack, (calls, elapsed, allocated) in stats.items():
+            key = (*self.stack, *stack)
+            entry = self.stats.setdefault(key, [0, 0, 0])
+            entry[0] += calls
+            entry[1] += elapsed
+            entry[2] += allocated
+
+    def drain(self) -> Stats:
+        stats, self.stats = self.stats, {}
+        return stats
+
+    def close(self) -> None:
+        self.stage(None)
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def self_stats(self) -> Dict[Stack, Tuple[int, int, int, int, int]]:
+        """
+        (calls, total ns, self ns, total bytes, self bytes) of every stack, where self excludes the
+        time recorded in its child stacks. Stacks only recorded through their children (e.g. the
+        resource type of map;Observation;code) get their children's totals.
+
+        Examples:
+            >>> profiler = Profiler()
+            >>> profiler.stats = {("map", "Patient", "code"): [2, 30, 0], ("map",): [1, 100, 0]}
+            >>> stats = profiler.self_stats()
+            >>> stats[("map",)], stats[("map", "Patient")], stats[("map", "Patient", "code")]
+            ((1, 100, 70, 0, 0), (0, 30, 0, 0, 0), (2, 30, 30, 0, 0))
+        """
+        stacks = set(self.stats)
+        for stack in self.stats:
+            stacks.update(stack[:depth] for depth in range(1, len(stack)))
+        totals = {}
+        # Deepest stacks first, so the totals of all children are known when a stack is reached
+        children: Dict[Stack, List[int]] = {}
+        for stack in sorted(stacks, key=len, reverse=True):
+            child_ns, child_bytes = children.get(stack, (0, 0))
+            calls, elapsed, allocated = self.stats.get(stack, (0, child_ns, child_bytes))
+            totals[stack] = (calls, elapsed, max(elapsed - child_ns, 0), allocated, allocated - child_bytes)
+            if len(stack) > 1:
+                parent = children.setdefault(stack[:-1], [0, 0])
+                parent[0] += elapsed
+                parent[1] += allocated
+        return totals
+
+    def report(self, limit: Optional[int] = None) -> str:
+        """
+        Table of the stacks sorted by self time (the limit most expensive ones, if given).
+        """
+        rows = sorted(self.self_stats().items(), key=lambda item: (-item[1][2], item[0]))[:limit]
+        lines = [f"{'self s':>10} {'total s':>10} {'calls':>10} {'self MiB':>10} {'total MiB':>10}  stack"]
+        for stack, (calls, elapsed, self_elapsed, allocated, self_allocated) in rows:
+            lines.append(
+                f"{self_elapsed / 1e9:>10.3f} {elapsed / 1e9:>10.3f} {calls:>10} "
+                f"{self_allocated / (1 << 20):>10.2f} {allocated / (1 << 20):>10.2f}  {';'.join(stack)}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def collapsed(self, allocations: bool = False) -> str:
+        """
+        Collapsed stacks with the self microseconds (or self bytes allocated) of every stack.
+        """
+        lines = []
+        for stack, (_, _, self_elapsed, _, self_allocated) in sorted(self.self_stats().items()):
+            value = self_allocated if allocations else self_elapsed // 1000
+            if value > 0:
+                # ; separates frames and the value follows the last space
+                frames = [frame.replace(";", ",").replace(" ", "_") for frame in stack]
+                lines.append(f"{';'.join(frames)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, output_dir: str) -> None:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, REPORT_FILE), "w") as f:
+            f.write(self.report())
+        with open(os.path.join(output_dir, STACKS_FILE), "w") as f:
+            f.write(self.collapsed())
+        if self.allocations:
+            with open(os.path.join(output_dir, ALLOCATIONS_FILE), "w") as f:
+                f.write(self.collapsed(allocations=True))
+
+
+def enable(allocations: bool = False) -> Profiler:
+    global ACTIVE
+    ACTIVE = Profiler(allocations)
+    return ACTIVE
+
+
+def disable() -> Optional[Profiler]:
+    global ACTIVE
+    profiler, ACTIVE = ACTIVE, None
+    if profiler is not None:
+        profiler.close()
+    return profiler
+
+
+def section(*frames: str):
+    """
+    Context manager recording frames on the active profiler (a no-op without one).
+    """
+    return ACTIVE.section(*frames) if ACTIVE is not None else nullcontext()
+
+
+def stage(name: Optional[str]) -> None:
+    if ACTIVE is not None:
+        ACTIVE.stage(name)
+
+
+def expression_label(exprs) -> str:
+    """
+    Frame name of a config expression or list of fallback expressions.
+
+    Examples:
+        >>> expression_label("col(valueQuantity.value)")
+        'col(valueQuantity.value)'
+        >>> expression_label(["col(issued)", "col(authoredOn)"])
+        'col(issued)|col(authoredOn)'
+    """
+    if isinstance(exprs, list):
+        return "|".join(str(expr) for expr in exprs)
+    return str(exprs)
@@ -0,0 +1,242 @@
+"""
+resource_cache.py
+-----------------
+Optional columnar cache that makes re-runs with an edited event config cheap.
+Decoded resources are stored per input file and resource type as Parquet tables with nested structs,
+in a directory named after the file's fingerprint (path, size, mtime and parse options), so a changed file is
+re-parsed while unchanged files are never decoded from JSON again. Mapped events are stored per
+resource type under a hash of the type's effective config section (plus everything else the
+mapping depends on); only types whose hash changed are re-mapped, from the cached resources.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .fhir_parser import PAYLOAD_MIN_BYTES, iter_file_resources
+
+CACHE_VERSION = 1
+TYPES_MARKER = "_types.json"
+# Column of the fallback layout for resources Arrow cannot represent losslessly as structs
+JSON_COLUMN = "_json"
+
+
+def _digest(value: Any) -> str:
+    text = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def file_fingerprint(fpath: str, payload_min_bytes: Optional[int] = PAYLOAD_MIN_BYTES) -> str:
+    """
+    Fingerprint of an input file parsed with the given options; changes whenever the file is
+    rewritten or would be parsed differently.
+    """
+    stat = os.stat(fpath)
+    return _digest([CACHE_VERSION, os.path.abspath(fpath), stat.st_size, stat.st_mtime_ns, payload_min_bytes])
+
+
+def config_fingerprint(event_config: Dict[str, Any], rtype: str, **extra) -> str:
+    """
+    Hash of the config a resource type is mapped with: its own section merged with the default
+    section (as build_event does), plus any extra values the mapping depends on.
+
+    Examples:
+        >>> cfg = {"default": {"code": ["const(resourceType)"]}, "Condition": {"time": "col(onsetDateTime)"}}
+        >>> config_fingerprint(cfg, "Condition") == config_fingerprint(cfg, "Condition")
+        True
+        >>> config_fingerprint(cfg, "Condition") == config_fingerprint(cfg, "Encounter")
+        False
+    """
+    default = event_config.get("default", {})
+    section = {**default, **event_config.get(rtype, default)}
+    return _digest([CACHE_VERSION, rtype, section, extra])
+
+
+def drop_nulls(value: Any) -> Any:
+    """
+    Remove the null members Arrow adds to structs for keys a resource did not have.
+
+    Examples:
+        >>> drop_nulls({"id": "1", "valueString": None, "code": {"coding": [{"code": "x", "display": None}]}})
+        {'id': '1', 'code': {'coding': [{'code': 'x'}]}}
+    """
+    if isinstance(value, dict):
+        return {k: drop_nulls(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [drop_nulls(v) for v in value]
+    return value
+
+
+def resources_to_table(resources: List[Dict[str, Any]]) -> pa.Table:
+    """
+    Convert resources of one type to a table with one (nested struct) column per top-level field.
+    Resources Arrow cannot store losslessly (conflicting value types, empty objects, integers that
+    would be widened to floats) are stored as one JSON string column instead.
+    """
+    try:
+        table = pa.Table.from_struct_array(pa.array(resources))
+        pq.write_table(table, pa.BufferOutputStream())
+        for original, restored in zip(resources, table.to_pylist()):
+            if json.dumps(original, sort_keys=True) != json.dumps(drop_nulls(restored), sort_keys=True):
+                raise ValueError("lossy struct conversion")
+        return table
+    except (pa.ArrowException, ValueError) as e:
+        logging.debug(f"Caching {len(resources)} resources as JSON strings: {e}")
+        return pa.table({JSON_COLUMN: pa.array([json.dumps(r) for r in resources], type=pa.large_string())})
+
+
+def table_to_resources(table: pa.Table) -> List[Dict[str, Any]]:
+    if table.column_names == [JSON_COLUMN]:
+        return [json.loads(text) for text in table.column(JSON_COLUMN).to_pylist()]
+    return [drop_nulls(row) for row in table.to_pylist()]
+
+
+def _write_atomic(table: pa.Table, path: str) -> None:
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class ResourceCache:
+    """
+    Cache of decoded resources (per input file and type) and mapped events (per type) below cache_dir.
+
+    Every entry is named after the fingerprint that validates it, so there is no central manifest and
+    several sharded workers can share one cache directory. Files are parsed with payload_min_bytes
+    (see fhir_parser.iter_file_resources).
+    """
+
+    def __init__(self, cache_dir: str, payload_min_bytes: Optional[int] = PAYLOAD_MIN_BYTES):
+        self.cache_dir = str(cache_dir)
+        self.payload_min_bytes = payload_min_bytes
+        self.resources_dir = os.path.join(self.cache_dir, "resources")
+        self.events_dir = os.path.join(self.cache_dir, "events")
+        os.makedirs(self.resources_dir, exist_ok=True)
+        os.makedirs(self.events_dir, exist_ok=True)
+        # Per input file: fingerprint and {resource type: count}, filled by update()
+        self.fingerprints: Dict[str, str] = {}
+        self.file_types: Dict[str, Dict[str, int]] = {}
+        self.n_parsed = 0
+
+    def _file_dir(self, fingerprint: str) -> str:
+        return os.path.join(self.resources_dir, fingerprint)
+
+    def update(self, files: Iterable[str]) -> None:
+        """
+        Make sure every file has an up-to-date cache entry, parsing only new and changed files.
+        All resource types of a file are cached, so enabling another type later needs no re-parse.
+        """
+        for fpath in files:
+            fingerprint = file_fingerprint(fpath, self.payload_min_bytes)
+            marker = os.path.join(self._file_dir(fingerprint), TYPES_MARKER)
+            if os.path.exists(marker):
+                with open(marker) as f:
+                    self.file_types[fpath] = json.load(f)["types"]
+            else:
+                self.file_types[fpath] = self._cache_file(fpath, fingerprint)
+                self.n_parsed += 1
+            self.fingerprints[fpath] = fingerprint
+        n_cached = len(self.fingerprints) - self.n_parsed
+        logging.info(f"Resource cache: {n_cached} files cached, {self.n_parsed} files parsed")
+
+    def _cache_file(self, fpath: str, fingerprint: str) -> Dict[str, int]:
+        logging.info(f"Parsing file {fpath} into the resource cache")
+        by_type: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for data in iter_file_resources(fpath, payload_min_bytes=self.payload_min_bytes):
+            if isinstance(data, dict) and data.get("resourceType"):
+                by_type[data["resourceType"]].append(data)
+        self._remove_stale_entries(fpath)
+        file_dir = self._file_dir(fingerprint)
+        os.makedirs(file_dir, exist_ok=True)
+        for rtype, resources in by_type.items():
+            _write_atomic(resources_to_table(resources), os.path.join(file_dir, f"{rtype}.parquet"))
+        types = {rtype: len(resources) for rtype, resources in by_type.items()}
+        # The marker is written last, so a half-written entry is never used
+        with open(os.path.join(file_dir, TYPES_MARKER), "w") as f:
+            json.dump({"path": os.path.abspath(fpath), "types": types}, f)
+        return types
+
+    def _remove_stale_entries(self, fpath: str) -> None:
+        path = os.path.abspath(fpath)
+        for name in os.listdir(self.resources_dir):
+            marker = os.path.join(self.resources_dir, name, TYPES_MARKER)
+            try:
+                with open(marker) as f:
+                    stale = json.load(f)["path"] == path
+            except (OSError, ValueError, KeyError):
+                continue
+            if stale:
+                shutil.rmtree(os.path.join(self.resources_dir, name), ignore_errors=True)
+
+    def resource_types(self) -> List[str]:
+        """
+        Resource types of the updated files, in order of first appearance (like load_fhir_resources_by_type).
+        """
+        types: Dict[str, None] = {}
+        for fpath in self.fingerprints:
+            types.update(dict.fromkeys(self.file_types[fpath]))
+        return list(types)
+
+    def files_with_type(self, rtype: str) -> List[str]:
+        return [fpath for fpath in self.fingerprints if self.file_types[fpath].get(rtype)]
+
+    def input_fingerprint(self, rtype: str) -> str:
+        """
+        Fingerprint of all cached input a resource type is read from.
+        """
+        return _digest([self.fingerprints[fpath] for fpath in self.files_with_type(rtype)])
+
+    def load_resources(self, rtype: str) -> List[Dict[str, Any]]:
+        resources: List[Dict[str, Any]] = []
+        for fpath in self.files_with_type(rtype):
+            path = os.path.join(self._file_dir(self.fingerprints[fpath]), f"{rtype}.parquet")
+            resources.extend(table_to_resources(pq.read_table(path)))
+        return resources
+
+    def _events_path(self, rtype: str, key: str, scope: str = "") -> str:
+        return os.path.join(self.events_dir, f"{scope}{rtype}-{key}.parquet")
+
+    def load_events(self, rtype: str, key: str, scope: str = "") -> Optional[pl.DataFrame]:
+        """
+        Return the cached events of a type mapped under key, or None if they must be re-mapped.
+        """
+        path = self._events_path(rtype, key, scope)
+        if not os.path.exists(path):
+            return None
+        return pl.read_parquet(path)
+
+    def store_events(
+        self,
+        rtype: str,
+        key: str,
+        events: pl.DataFrame,
+        scope: str = "",
+        codes: Optional[List[Dict[str, Any]]] = None,
+    ) -> None:
+        """
+        Cache the events of a type under key, replacing entries of older keys of the same scope.
+        codes are the code_metadata records observed while mapping them.
+        """
+        prefix = f"{scope}{rtype}-"
+        for name in os.listdir(self.events_dir):
+            if name.startswith(prefix) and name.endswith(".parquet") and "-" not in name[len(prefix) :]:
+                os.remove(os.path.join(self.events_dir, name))
+        codes_table = pa.Table.from_pylist(
+            codes or [],
+            schema=pa.schema([(name, pa.string()) for name in ("code", "system", "source_code", "display")]),
+        )
+        _write_atomic(codes_table, self._events_path(rtype, key, scope).replace(".parquet", ".codes.parquet"))
+        # The events are written last, their presence marks a complete entry
+        _write_atomic(events.to_arrow(), self._events_path(rtype, key, scope))
+
+    def load_codes(self, rtype: str, key: str, scope: str = "") -> List[Dict[str, Any]]:
+        path = self._events_path(rtype, key, scope).replace(".parquet", ".codes.parquet")
+        return pq.read_table(path).to_pylist() if os.path.exists(path) else []
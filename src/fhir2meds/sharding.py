@@ -0,0 +1,261 @@
+"""
+sharding.py
+-----------
+Deterministic work partitioning for running fhir2meds on several processes or machines.
+Each worker (worker_index out of num_workers) converts its own slice of the input, writes its own
+data shards and per-worker metadata partials; merge_worker_partials combines the partials into the
+final MEDS metadata once all workers are done.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .code_metadata import CodeMetadata
+from .metadata_writer import codes_table, event_codes
+
+PARTIALS_DIR = os.path.join("metadata", "partials")
+SPLIT_PARTIALS_DIR = os.path.join(PARTIALS_DIR, "subject_splits")
+DONE_MARKER = "_DONE.json"
+CODE_METADATA_PARTIAL = "code_metadata.json"
+DEFAULT_SPLIT_FRACTIONS = {"train": 0.8, "tuning": 0.1, "held_out": 0.1}
+
+
+def stable_hash(value: Any, seed: int = 0) -> int:
+    """
+    Hash a value to a 64-bit integer that is identical across processes and machines
+    (unlike the builtin hash, which is salted per interpreter).
+
+    Examples:
+        >>> stable_hash("Patient/123") == stable_hash("Patient/123")
+        True
+        >>> stable_hash("Patient/123") == stable_hash("Patient/123", seed=1)
+        False
+    """
+    digest = hashlib.blake2b(f"{seed}:{value}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def validate_split_fractions(fractions: Dict[str, float]) -> None:
+    if not fractions or any(f < 0 for f in fractions.values()) or abs(sum(fractions.values()) - 1) > 1e-6:
+        raise ValueError(f"Split fractions must be non-negative and sum to 1, got {dict(fractions)}")
+
+
+def assign_split(
+    subject_id: Any, fractions: Dict[str, float] = DEFAULT_SPLIT_FRACTIONS, seed: int = 0
+) -> str:
+    """
+    Split of a subject, from a stable hash of its subject_id. The assignment only depends on the
+    subject, fractions and seed, so every shard writer and worker computes it independently and a
+    subject keeps its split across incremental re-runs.
+
+    Examples:
+        >>> assign_split(10000032) == assign_split(10000032)
+        True
+        >>> assign_split(10000032, {"train": 1.0})
+        'train'
+    """
+    point = stable_hash(subject_id, seed) / 2**64
+    cumulative = 0.0
+    for split, fraction in fractions.items():
+        cumulative += fraction
+        if point < cumulative:
+            return split
+    return split
+
+
+def split_partial_path(output_dir: str, name: str) -> str:
+    return os.path.join(str(output_dir), SPLIT_PARTIALS_DIR, f"{name}.parquet")
+
+
+def write_split_partial(
+    output_dir: str, name: str, subject_ids: Iterable[int], fractions: Dict[str, float], seed: int = 0
+) -> None:
+    """
+    Write the splits of the subjects of one data shard to metadata/partials/subject_splits/{name}.parquet.
+    """
+    subject_ids = sorted(set(subject_ids))
+    table = pa.table(
+        {
+            "subject_id": pa.array(subject_ids, type=pa.int64()),
+            "split": pa.array([assign_split(s, fractions, seed) for s in subject_ids], type=pa.string()),
+        }
+    )
+    os.makedirs(os.path.dirname(split_partial_path(output_dir, name)), exist_ok=True)
+    pq.write_table(table, split_partial_path(output_dir, name))
+
+
+def assemble_subject_splits(output_dir: str) -> int:
+    """
+    Combine the per-shard split partials into metadata/subject_splits.parquet and return the number
+    of subjects. A subject spread over several shards has the same split in all of them.
+    """
+    partial_dir = os.path.join(str(output_dir), SPLIT_PARTIALS_DIR)
+    paths = sorted(os.listdir(partial_dir)) if os.path.isdir(partial_dir) else []
+    schema = pa.schema([("subject_id", pa.int64()), ("split", pa.string())])
+    tables = [
+        pq.read_table(os.path.join(partial_dir, p)).cast(schema) for p in paths if p.endswith(".parquet")
+    ]
+    table = pa.concat_tables(tables) if tables else schema.empty_table()
+    splits = pl.from_arrow(table).unique("subject_id").sort("subject_id")
+    os.makedirs(os.path.join(str(output_dir), "metadata"), exist_ok=True)
+    pq.write_table(
+        splits.to_arrow().cast(schema), os.path.join(str(output_dir), "metadata", "subject_splits.parquet")
+    )
+    return splits.height
+
+
+def validate_worker_args(worker_index: int, num_workers: int) -> None:
+    if num_workers < 1:
+        raise ValueError(f"num_workers must be >= 1, got {num_workers}")
+    if not 0 <= worker_index < num_workers:
+        raise ValueError(f"worker_index must be in [0, {num_workers}), got {worker_index}")
+
+
+def partition_files(
+    files: Iterable[str], worker_index: int, num_workers: int, sizes: Optional[Dict[str, int]] = None
+) -> List[str]:
+    """
+    Return the input files assigned to worker_index.
+    Files are assigned largest first to the worker with the fewest bytes so far, so every worker
+    computes the same balanced assignment from the same directory listing.
+
+    Examples:
+        >>> files = ["a.ndjson", "b.ndjson", "c.ndjson"]
+        >>> sizes = {"a.ndjson": 10, "b.ndjson": 7, "c.ndjson": 5}
+        >>> partition_files(files, 0, 2, sizes=sizes)
+        ['a.ndjson']
+        >>> partition_files(files, 1, 2, sizes=sizes)
+        ['b.ndjson', 'c.ndjson']
+    """
+    validate_worker_args(worker_index, num_workers)
+    files = sorted(set(files))
+    if sizes is None:
+        sizes = {f: os.path.getsize(f) for f in files}
+    loads = [0] * num_workers
+    assigned: Dict[int, List[str]] = {i: [] for i in range(num_workers)}
+    for fpath in sorted(files, key=lambda f: (-sizes[f], f)):
+        target = min(range(num_workers), key=lambda i: (loads[i], i))
+        loads[target] += sizes[fpath]
+        assigned[target].append(fpath)
+    return sorted(assigned[worker_index])
+
+
+def subject_in_partition(subject_key: Optional[str], worker_index: int, num_workers: int) -> bool:
+    """
+    Return True if the subject (a Patient UUID) falls into worker_index's hash bucket.
+    Resources without a subject are never assigned to a worker.
+    """
+    if subject_key is None:
+        return False
+    return stable_hash(subject_key) % num_workers == worker_index
+
+
+def worker_shard_prefix(worker_index: int, num_workers: int) -> str:
+    """
+    Prefix for the data shards of a worker, e.g. data/2_0.parquet for worker 2.
+    Single-process runs keep the plain data/{shard_idx}.parquet naming.
+    """
+    return "" if num_workers == 1 else f"{worker_index}_"
+
+
+def worker_partial_dir(output_dir: str, worker_index: int) -> str:
+    return os.path.join(str(output_dir), PARTIALS_DIR, f"worker_{worker_index}")
+
+
+def write_worker_partials(
+    output_dir: str,
+    worker_index: int,
+    num_workers: int,
+    events: List[Dict[str, Any]],
+    code_metadata=None,
+    lost_values: Optional[Dict[str, int]] = None,
+):
+    """
+    Write the codes seen by one worker and its code metadata (observed codings and indexed
+    terminology, which the codes of other workers may need), followed by a done marker. (Subject
+    splits are written per data shard.) The marker is written last so merge_worker_partials never
+    reads a half-written partial.
+    """
+    partial_dir = worker_partial_dir(output_dir, worker_index)
+    os.makedirs(partial_dir, exist_ok=True)
+    codes = pa.table({"code": pa.array(sorted(event_codes(events)), type=pa.string())})
+    pq.write_table(codes, os.path.join(partial_dir, "codes.parquet"))
+    with open(os.path.join(partial_dir, CODE_METADATA_PARTIAL), "w") as f:
+        json.dump((code_metadata or CodeMetadata()).to_dict(), f)
+    with open(os.path.join(partial_dir, DONE_MARKER), "w") as f:
+        marker = {"worker_index": worker_index, "num_workers": num_workers, "n_events": len(events)}
+        json.dump({**marker, "lost_values": lost_values or {}}, f)
+    logging.info(f"Worker {worker_index}/{num_workers} wrote metadata partials to {partial_dir}")
+
+
+def clear_worker_outputs(output_dir: str, worker_index: int, num_workers: int):
+    """
+    Remove the data shards and partials of one worker, leaving other workers' outputs untouched.
+    """
+    prefix = worker_shard_prefix(worker_index, num_workers)
+    data_dir = os.path.join(str(output_dir), "data")
+    if os.path.isdir(data_dir):
+        for fname in os.listdir(data_dir):
+            if fname.startswith(prefix) and fname.endswith(".parquet"):
+                os.remove(os.path.join(data_dir, fname))
+    # Per-shard partials (subject splits, subject index, manifest) are named like the shards
+    shard_partials = os.path.join(str(output_dir), PARTIALS_DIR)
+    for partial_dir in [
+        os.path.join(shard_partials, d) for d in ("subject_splits", "subject_index", "manifest")
+    ]:
+        if os.path.isdir(partial_dir):
+            for fname in os.listdir(partial_dir):
+                if fname.startswith(prefix) and fname.endswith((".parquet", ".json")):
+                    os.remove(os.path.join(partial_dir, fname))
+    partial_dir = worker_partial_dir(output_dir, worker_index)
+    if os.path.isdir(partial_dir):
+        for fname in os.listdir(partial_dir):
+            os.remove(os.path.join(partial_dir, fname))
+
+
+def merge_worker_partials(output_dir: str, num_workers: int) -> Dict[str, int]:
+    """
+    Combine the per-worker partials into metadata/codes.parquet and metadata/subject_splits.parquet.
+    Returns the values all workers lost in the MEDS casts, by kind.
+
+    Raises:
+        FileNotFoundError: If any worker has not finished writing its partials.
+    """
+    output_dir = str(output_dir)
+    partial_dirs = [worker_partial_dir(output_dir, i) for i in range(num_workers)]
+    missing = [i for i, d in enumerate(partial_dirs) if not os.path.exists(os.path.join(d, DONE_MARKER))]
+    if missing:
+        raise FileNotFoundError(f"Workers {missing} of {num_workers} have not finished writing partials")
+
+    # Codes are described once all workers' codings and terminology are combined: the CodeSystem
+    # of a code may have been converted by another worker than the resources using it
+    code_metadata = CodeMetadata()
+    codes = {}
+    for partial_dir in partial_dirs:
+        for code in pq.read_table(os.path.join(partial_dir, "codes.parquet")).column("code").to_pylist():
+            codes.setdefault(code, None)
+        with open(os.path.join(partial_dir, CODE_METADATA_PARTIAL)) as f:
+            code_metadata.update(CodeMetadata.from_dict(json.load(f)))
+    codes = codes_table(list(codes), code_metadata)
+    os.makedirs(os.path.join(output_dir, "metadata"), exist_ok=True)
+    pq.write_table(codes, os.path.join(output_dir, "metadata", "codes.parquet"))
+
+    n_subjects = assemble_subject_splits(output_dir)
+    if os.path.isdir(os.path.join(output_dir, PARTIALS_DIR, "subject_index")):
+        from .subject_index import assemble_subject_index
+
+        assemble_subject_index(output_dir)
+    logging.info(f"Merged partials of {num_workers} workers: {len(codes)} codes, {n_subjects} subjects")
+    lost_values: Dict[str, int] = {}
+    for partial_dir in partial_dirs:
+        with open(os.path.join(partial_dir, DONE_MARKER)) as f:
+            for kind, n in json.load(f).get("lost_values", {}).items():
+                lost_values[kind] = lost_values.get(kind, 0) + n
+    return lost_values
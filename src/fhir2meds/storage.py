@@ -0,0 +1,217 @@
+"""
+storage.py
+----------
+Input and output on fsspec filesystems (s3://, gs://, memory://, ...), so exports in an object
+store are converted without being copied to local disk first. fsspec (plus the filesystem's
+package, e.g. s3fs) is an optional dependency, imported only for URLs with a protocol; plain
+local paths keep using os/open.
+
+Large NDJSON objects are read as concurrent byte-range requests of READ_BLOCK bytes, with up to
+READ_AHEAD ranges in flight ahead of the parser; lines are stitched across range boundaries and
+keep their byte offsets (for the payload references of fhir_parser.strip_payloads). Data shards
+are written straight to the output URL as multipart uploads of PART_SIZE parts; the metadata files
+are written locally and uploaded file by file in parallel.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import posixpath
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Iterator, List, Tuple
+
+PROTOCOL_PATTERN = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*://")
+FHIR_SUFFIXES = (".ndjson", ".json")
+READ_BLOCK = 8 << 20
+READ_AHEAD = 4
+PART_SIZE = 64 << 20
+UPLOAD_WORKERS = 8
+
+
+def is_remote(path: Any) -> bool:
+    """
+    Whether path is a URL to be opened through fsspec (anything with a protocol but file://).
+
+    Examples:
+        >>> is_remote("s3://bucket/export"), is_remote("memory://export"), is_remote("/data/export")
+        (True, True, False)
+        >>> is_remote("file:///data/export")
+        False
+    """
+    path = str(path)
+    return bool(PROTOCOL_PATTERN.match(path)) and not path.startswith("file://")
+
+
+def get_filesystem(url: str) -> Tuple[Any, str]:
+    """
+    The fsspec filesystem of a URL and the path within it.
+    """
+    try:
+        from fsspec.core import url_to_fs
+    except ImportError as e:
+        raise ImportError(
+            f"Reading or writing {url} requires fsspec (and the package of its filesystem, e.g. s3fs)"
+        ) from e
+    return url_to_fs(url)
+
+
+def list_files(url: str, suffixes: Tuple[str, ...] = FHIR_SUFFIXES) -> List[str]:
+    """
+    URLs of all files below url ending with one of suffixes, in a stable (sorted) order.
+    """
+    fs, root = get_filesystem(url)
+    return sorted(fs.unstrip_protocol(path) for path in fs.find(root) if path.endswith(suffixes))
+
+
+def file_size(url: str) -> int:
+    fs, path = get_filesystem(url)
+    return fs.size(path)
+
+
+def open_input(url: str, block_size: int = READ_BLOCK) -> BinaryIO:
+    """
+    Open a remote file for sequential reading with a read-ahead cache of block_size blocks.
+    """
+    fs, path = get_filesystem(url)
+    return fs.open(path, "rb", block_size=block_size, cache_type="readahead")
+
+
+def open_text(url: str, block_size: int = READ_BLOCK) -> io.TextIOWrapper:
+    return io.TextIOWrapper(open_input(url, block_size=block_size), encoding="utf-8")
+
+
+def read_range(url: str, start: int, end: int) -> bytes:
+    fs, path = get_filesystem(url)
+    return fs.cat_file(path, start=start, end=end)
+
+
+def iter_range_lines(
+    read: Callable[[int, int], bytes], size: int, block: int = READ_BLOCK, read_ahead: int = READ_AHEAD
+) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yield (offset, line) of a file of size bytes, fetched as [start, end) ranges through read with
+    up to read_ahead ranges in flight. Lines keep their trailing newline, like iterating a file.
+
+    Examples:
+        >>> data = b'{"a": 1}\\n{"b": 2}\\n\\n{"c": 3}'
+        >>> list(iter_range_lines(lambda start, end: data[start:end], len(data), block=5, read_ahead=2))
+        [(0, b'{"a": 1}\\n'), (9, b'{"b": 2}\\n'), (18, b'\\n'), (19, b'{"c": 3}')]
+    """
+    ranges = [(start, min(start + block, size)) for start in range(0, size, block)]
+    buffer = b""
+    offset = 0
+    with ThreadPoolExecutor(max_workers=max(read_ahead, 1)) as executor:
+        pending = deque()
+        queued = 0
+        while queued < len(ranges) or pending:
+            while queued < len(ranges) and len(pending) < max(read_ahead, 1):
+                pending.append(executor.submit(read, *ranges[queued]))
+                queued += 1
+            buffer += pending.popleft().result()
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                yield offset, line + b"\n"
+                offset += len(line) + 1
+    if buffer:
+        yield offset, buffer
+
+
+def iter_lines(
+    url: str, block: int = READ_BLOCK, read_ahead: int = READ_AHEAD
+) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yield (offset, line) of a remote file, reading large files as concurrent range requests.
+    """
+    size = file_size(url)
+    if size <= block:
+        with open_input(url, block_size=block) as f:
+            offset = 0
+            for line in f:
+                yield offset, line
+                offset += len(line)
+        return
+    yield from iter_range_lines(lambda start, end: read_range(url, start, end), size, block, read_ahead)
+
+
+def open_output(url: str, part_size: int = PART_SIZE) -> BinaryIO:
+    """
+    Open a remote file for sequential writing, sent in parts of part_size bytes (multipart on
+    object stores).
+    """
+    fs, path = get_filesystem(url)
+    fs.makedirs(posixpath.dirname(path), exist_ok=True)
+    return fs.open(path, "wb", block_size=part_size)
+
+
+class DigestWriter(io.RawIOBase):
+    """
+    Write-through file that keeps the size and SHA-256 checksum of everything written to it.
+
+    Examples:
+        >>> writer = DigestWriter(io.BytesIO())
+        >>> writer.write(b"abc"), writer.tell(), writer.sha256()[:12]
+        (3, 3, 'ba7816bf8f01')
+    """
+
+    def __init__(self, raw: BinaryIO):
+        super().__init__()
+        self.raw = raw
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        n_bytes = memoryview(data).nbytes
+        self.raw.write(data)
+        self.digest.update(data)
+        self.size += n_bytes
+        return n_bytes
+
+    def tell(self) -> int:
+        return self.size
+
+    def sha256(self) -> str:
+        return self.digest.hexdigest()
+
+
+def upload_file(local_path: str, url: str, part_size: int = PART_SIZE) -> None:
+    """
+    Upload a file, streamed in parts of part_size bytes (multipart on object stores).
+    """
+    with open(local_path, "rb") as src, open_output(url, part_size) as dst:
+        while True:
+            chunk = src.read(part_size)
+            if not chunk:
+                break
+            dst.write(chunk)
+
+
+def upload_directory(
+    local_dir: str,
+    url: str,
+    part_size: int = PART_SIZE,
+    max_workers: int = UPLOAD_WORKERS,
+    exclude: Tuple[str, ...] = (),
+) -> int:
+    """
+    Upload every file below local_dir to the same relative path below url, max_workers at a time.
+    Files below the relative directories in exclude are skipped. Returns the number of files.
+    """
+    local_dir = str(local_dir)
+    uploads = []
+    for root, dirs, files in os.walk(local_dir):
+        rel_root = os.path.relpath(root, local_dir)
+        dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(rel_root, d)) not in exclude]
+        for fname in files:
+            rel_path = os.path.normpath(os.path.join(rel_root, fname))
+            uploads.append((os.path.join(root, fname), f"{url.rstrip('/')}/{rel_path.replace(os.sep, '/')}"))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda args: upload_file(*args, part_size=part_size), uploads))
+    logging.info(f"Uploaded {len(uploads)} files from {local_dir} to {url}")
+    return len(uploads)
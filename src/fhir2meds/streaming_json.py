@@ -0,0 +1,186 @@
+"""
+streaming_json.py
+-----------------
+Incremental reading of FHIR JSON documents and Bundles.
+Single-file searchset or transaction Bundles can be far larger than memory, so the top-level
+document is parsed key by key with json.JSONDecoder.raw_decode over a growing read buffer and the
+Bundle's entry array is decoded one entry at a time. Only a single entry is held in memory at once.
+"""
+
+import json
+import re
+from typing import Any, Dict, Iterator, Optional, TextIO
+
+WHITESPACE = re.compile(r"\s*")
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def expand_bundle(resource: Any, full_urls: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the resources contained in a (possibly nested) Bundle, or the resource itself otherwise.
+
+    Entries without a resource (e.g. DELETE requests of a transaction Bundle) are skipped.
+    Transaction Bundles reference other entries by fullUrl (urn:uuid:...); patient references to
+    entries seen earlier in the Bundle are rewritten to the usual Patient/<id> form.
+
+    Examples:
+        >>> bundle = {"resourceType": "Bundle", "type": "transaction", "entry": [
+        ...     {"fullUrl": "urn:uuid:p1", "resource": {"resourceType": "Patient"}},
+        ...     {"resource": {"resourceType": "Observation", "subject": {"reference": "urn:uuid:p1"}}},
+        ...     {"request": {"method": "DELETE", "url": "Observation/1"}},
+        ... ]}
+        >>> [r["resourceType"] for r in expand_bundle(bundle)]
+        ['Patient', 'Observation']
+        >>> list(expand_bundle(bundle))[1]["subject"]
+        {'reference': 'Patient/p1'}
+    """
+    if not isinstance(resource, dict) or resource.get("resourceType") != "Bundle":
+        yield resource
+        return
+    if full_urls is None:
+        full_urls = {}
+    for entry in resource.get("entry", None) or []:
+        yield from expand_bundle_entry(entry, full_urls)
+
+
+def expand_bundle_entry(entry: Any, full_urls: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+    if not isinstance(entry, dict) or not isinstance(entry.get("resource"), dict):
+        return
+    resource = entry["resource"]
+    full_url = entry.get("fullUrl")
+    if (
+        isinstance(full_url, str)
+        and full_url.startswith("urn:uuid:")
+        and resource.get("resourceType") != "Bundle"
+    ):
+        if not resource.get("id"):
+            resource["id"] = full_url[len("urn:uuid:") :]
+        full_urls[full_url] = f"{resource.get('resourceType')}/{resource['id']}"
+    for field in ("subject", "patient"):
+        ref = resource.get(field)
+        if isinstance(ref, dict) and ref.get("reference") in full_urls:
+            ref["reference"] = full_urls[ref["reference"]]
+    yield from expand_bundle(resource, full_urls)
+
+
+class _StreamBuffer:
+    """
+    A read buffer over a text file that decodes one JSON value at a time.
+    """
+
+    def __init__(self, fp: TextIO, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, min_size: int = 0) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fp.read(max(self.chunk_size, min_size))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Return the next non-whitespace character without consuming it, or '' at the end of the file.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found!r} while streaming JSON")
+        self.pos += 1
+
+    def decode_value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # Incomplete value: read at least as much again as is buffered, so large values
+                # are re-parsed a logarithmic number of times only.
+                if not self.fill(min_size=len(self.buf) - self.pos):
+                    raise
+                continue
+            if end == len(self.buf) and not self.eof and not isinstance(value, (dict, list, str)):
+                # A number or literal at the end of the buffer may continue in the next chunk
+                if self.fill():
+                    continue
+            self.pos = end
+            return value
+
+
+def _iter_array(stream: _StreamBuffer) -> Iterator[Any]:
+    stream.expect("[")
+    while True:
+        char = stream.peek()
+        if char == "]":
+            stream.pos += 1
+            return
+        if char == ",":
+            stream.pos += 1
+            continue
+        if char == "":
+            raise ValueError("Unexpected end of file inside a JSON array")
+        yield stream.decode_value()
+
+
+def _iter_document(stream: _StreamBuffer) -> Iterator[Dict[str, Any]]:
+    if stream.peek() == "[":
+        for value in _iter_array(stream):
+            yield from expand_bundle(value)
+        return
+    stream.expect("{")
+    doc: Dict[str, Any] = {}
+    full_urls: Dict[str, str] = {}
+    while True:
+        char = stream.peek()
+        if char == "}":
+            stream.pos += 1
+            break
+        if char == ",":
+            stream.pos += 1
+            continue
+        if char == "":
+            raise ValueError("Unexpected end of file inside a JSON object")
+        key = stream.decode_value()
+        stream.expect(":")
+        if key == "entry" and doc.get("resourceType") == "Bundle" and stream.peek() == "[":
+            for entry in _iter_array(stream):
+                yield from expand_bundle_entry(entry, full_urls)
+        else:
+            doc[key] = stream.decode_value()
+    yield from expand_bundle(doc, full_urls)
+
+
+def iter_json_resources(fp: TextIO, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the resources of a JSON file holding one or more concatenated resources, arrays of
+    resources or Bundles. Bundle entries are yielded as individual resources.
+
+    Examples:
+        >>> import io
+        >>> text = '{"resourceType": "Bundle", "type": "searchset", "total": 2, "entry": ['
+        >>> text += '{"resource": {"resourceType": "Patient", "id": "a"}},'
+        >>> text += '{"resource": {"resourceType": "Patient", "id": "b"}}]}'
+        >>> [r["id"] for r in iter_json_resources(io.StringIO(text), chunk_size=8)]
+        ['a', 'b']
+        >>> [r["id"] for r in iter_json_resources(io.StringIO('{"resourceType": "Patient", "id": "c"}'))]
+        ['c']
+    """
+    stream = _StreamBuffer(fp, chunk_size=chunk_size)
+    while stream.peek():
+        yield from _iter_document(stream)
@@ -0,0 +1,157 @@
+"""
+subject_index.py
+----------------
+Index of where every subject's events are in the MEDS output, and a reader built on it.
+Each data shard is written sorted by (subject_id, time) and indexes its own subjects: shard file,
+row and row-group range, event count and min/max time. The per-shard partials are combined into
+metadata/subject_index.parquet, so loading one patient reads only the row groups holding them
+instead of scanning every file in data/.
+"""
+
+import os
+from typing import Iterable, List, Optional
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .sharding import PARTIALS_DIR
+
+INDEX_PARTIALS_DIR = os.path.join(PARTIALS_DIR, "subject_index")
+INDEX_PATH = os.path.join("metadata", "subject_index.parquet")
+INDEX_SCHEMA = pa.schema(
+    [
+        ("subject_id", pa.int64()),
+        ("shard", pa.string()),
+        ("row_start", pa.int64()),
+        ("row_end", pa.int64()),
+        ("row_group_start", pa.int32()),
+        ("row_group_end", pa.int32()),
+        ("n_events", pa.int64()),
+        ("min_time", pa.timestamp("us")),
+        ("max_time", pa.timestamp("us")),
+    ]
+)
+
+
+def shard_index(events: pl.DataFrame, shard: str, row_group_rows: List[int]) -> pl.DataFrame:
+    """
+    Index of one shard whose events are sorted by subject_id. shard is the path of the shard
+    relative to the output directory and row_group_rows the number of rows of each row group.
+    Row and row-group ranges are half-open [start, end).
+
+    Examples:
+        >>> from datetime import datetime
+        >>> times = [None, datetime(2020, 1, 1), datetime(2021, 1, 1)]
+        >>> events = pl.DataFrame({"subject_id": [1, 1, 2], "time": times})
+        >>> index = shard_index(events, "data/0.parquet", [2, 1])
+        >>> index.select("subject_id", "row_group_start", "row_group_end", "n_events").rows()
+        [(1, 0, 1, 2), (2, 1, 2, 1)]
+    """
+    starts = [0]
+    for n_rows in row_group_rows[:-1]:
+        starts.append(starts[-1] + n_rows)
+    starts = pl.Series(starts, dtype=pl.Int64)
+    index = (
+        events.with_row_index("row")
+        .group_by("subject_id", maintain_order=True)
+        .agg(
+            row_start=pl.col("row").min().cast(pl.Int64),
+            row_end=pl.col("row").max().cast(pl.Int64) + 1,
+            n_events=pl.len().cast(pl.Int64),
+            min_time=pl.col("time").min(),
+            max_time=pl.col("time").max(),
+        )
+    )
+    return index.select(
+        pl.col("subject_id").cast(pl.Int64),
+        pl.lit(shard).alias("shard"),
+        "row_start",
+        "row_end",
+        (starts.search_sorted(index["row_start"], side="right") - 1).cast(pl.Int32).alias("row_group_start"),
+        starts.search_sorted(index["row_end"] - 1, side="right").cast(pl.Int32).alias("row_group_end"),
+        "n_events",
+        pl.col("min_time").cast(pl.Datetime("us")),
+        pl.col("max_time").cast(pl.Datetime("us")),
+    )
+
+
+def write_index_partial(
+    output_dir: str,
+    name: str,
+    events: pl.DataFrame,
+    shard_path: str,
+    metadata: Optional[pq.FileMetaData] = None,
+) -> None:
+    """
+    Index a shard that was just written to shard_path, using the row groups of its Parquet footer.
+    Shards written to an output URL pass the footer as metadata instead of it being read back.
+    """
+    if metadata is None:
+        metadata = pq.ParquetFile(shard_path).metadata
+    row_group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    shard = os.path.relpath(shard_path, str(output_dir))
+    index = shard_index(events, shard, row_group_rows)
+    partial_dir = os.path.join(str(output_dir), INDEX_PARTIALS_DIR)
+    os.makedirs(partial_dir, exist_ok=True)
+    pq.write_table(index.to_arrow().cast(INDEX_SCHEMA), os.path.join(partial_dir, f"{name}.parquet"))
+
+
+def assemble_subject_index(output_dir: str) -> int:
+    """
+    Combine the per-shard index partials into metadata/subject_index.parquet; returns its number of rows.
+    """
+    partial_dir = os.path.join(str(output_dir), INDEX_PARTIALS_DIR)
+    paths = sorted(os.listdir(partial_dir)) if os.path.isdir(partial_dir) else []
+    tables = [
+        pq.read_table(os.path.join(partial_dir, p)).cast(INDEX_SCHEMA)
+        for p in paths
+        if p.endswith(".parquet")
+    ]
+    table = pa.concat_tables(tables) if tables else INDEX_SCHEMA.empty_table()
+    index = pl.from_arrow(table).sort("subject_id", "shard", "row_start")
+    os.makedirs(os.path.join(str(output_dir), "metadata"), exist_ok=True)
+    pq.write_table(index.to_arrow().cast(INDEX_SCHEMA), os.path.join(str(output_dir), INDEX_PATH))
+    return index.height
+
+
+def load_subject_index(output_dir: str) -> pl.DataFrame:
+    return pl.read_parquet(os.path.join(str(output_dir), INDEX_PATH))
+
+
+def read_subjects(
+    output_dir: str, subject_ids: Iterable[int], index: Optional[pl.DataFrame] = None
+) -> pl.DataFrame:
+    """
+    Load the events of some subjects, sorted by (subject_id, time), reading only the row groups
+    the subject index points to. Pass index (from load_subject_index) to answer many queries.
+    """
+    output_dir = str(output_dir)
+    subject_ids = list(subject_ids)
+    if index is None:
+        index = load_subject_index(output_dir)
+    hits = index.filter(pl.col("subject_id").is_in(subject_ids))
+    frames = []
+    for (shard,), entries in hits.group_by("shard", maintain_order=True):
+        row_groups = sorted(
+            {
+                rg
+                for start, end in entries.select("row_group_start", "row_group_end").rows()
+                for rg in range(start, end)
+            }
+        )
+        table = pq.ParquetFile(os.path.join(output_dir, shard)).read_row_groups(row_groups)
+        frames.append(pl.from_arrow(table).filter(pl.col("subject_id").is_in(subject_ids)))
+    if not frames:
+        shards = sorted(index["shard"].unique().to_list())
+        if not shards:
+            return pl.DataFrame()
+        return pl.from_arrow(pq.read_schema(os.path.join(output_dir, shards[0])).empty_table())
+    return pl.concat(frames).sort("subject_id", "time", nulls_last=False, maintain_order=True)
+
+
+def read_subject(output_dir: str, subject_id: int, index: Optional[pl.DataFrame] = None) -> pl.DataFrame:
+    """
+    Load the timeline of a single subject, see read_subjects.
+    """
+    return read_subjects(output_dir, [subject_id], index=index)
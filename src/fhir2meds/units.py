@@ -0,0 +1,172 @@
+"""
+units.py
+--------
+Normalization of event values while mapping (normalize_units, promote_numeric_text). Numeric
+values are converted to canonical units through a (code, unit) -> (factor, offset) table: the
+conversion of a pair is resolved once (code-specific rows first, then rows for any code) and
+memoized, and each mapped batch is converted with one vectorized expression over its distinct
+pairs. Text values that hold a plain number (e.g. "7.4" in Observation.valueString) are moved to
+numeric_value. The unit comes from the `unit` key of the event config and is not written; when
+converting units, configs without one get UNIT_EXPRESSION in their default section.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import polars as pl
+import yaml
+
+UNITS_PATH = os.path.join(os.path.dirname(__file__), "configs", "units.yaml")
+UNIT_COLUMN = "unit"
+# The UCUM code of valueQuantity, with its human-readable unit as fallback
+UNIT_EXPRESSION = ["col(valueQuantity.code)", "col(valueQuantity.unit)"]
+NUMERIC_PATTERN = r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$"
+# Separates code and unit in the keys of the per-batch conversion lookup
+KEY_SEPARATOR = "\x1f"
+
+Conversion = Tuple[float, float]
+
+
+class ValueNormalizer:
+    """
+    Unit conversions (rows of code (optional), unit, to, factor, offset (optional)) and numeric
+    text promotion applied to frames of mapped events.
+    """
+
+    def __init__(
+        self, conversions: Optional[List[Dict[str, Any]]] = None, promote_numeric_text: bool = False
+    ):
+        self.table: Dict[Tuple[Optional[str], str], Conversion] = {}
+        for row in conversions or []:
+            conversion = (float(row["factor"]), float(row.get("offset", 0.0)))
+            self.table[(row.get("code"), str(row["unit"]))] = conversion
+        self.promote_numeric_text = promote_numeric_text
+        self.memo: Dict[Tuple[str, str], Optional[Conversion]] = {}
+
+    @classmethod
+    def from_yaml(cls, path: Optional[str] = None, promote_numeric_text: bool = False) -> "ValueNormalizer":
+        with open(path or UNITS_PATH) as f:
+            conversions = yaml.safe_load(f).get("conversions", [])
+        return cls(conversions, promote_numeric_text)
+
+    def conversion(self, code: str, unit: str) -> Optional[Conversion]:
+        """
+        (factor, offset) of the values of code in unit, or None if they are kept as they are.
+
+        Examples:
+            >>> normalizer = ValueNormalizer([
+            ...     {"unit": "[lb_av]", "to": "kg", "factor": 0.5},
+            ...     {"code": "Observation//LOINC//2345-7", "unit": "mg/dL", "to": "mmol/L", "factor": 0.0555},
+            ... ])
+            >>> normalizer.conversion("Observation//weight", "[lb_av]")
+            (0.5, 0.0)
+            >>> normalizer.conversion("Observation//LOINC//2345-7", "mg/dL")
+            (0.0555, 0.0)
+            >>> normalizer.conversion("Observation//other", "mg/dL") is None
+            True
+        """
+        key = (code, unit)
+        if key not in self.memo:
+            self.memo[key] = self.table.get(key, self.table.get((None, unit)))
+        return self.memo[key]
+
+    def convert_units(self, frame: pl.DataFrame) -> pl.DataFrame:
+        if not self.table or UNIT_COLUMN not in frame.columns:
+            return frame
+        measured = pl.col("numeric_value").is_not_null() & pl.col(UNIT_COLUMN).is_not_null()
+        pairs = frame.filter(measured).select("code", pl.col(UNIT_COLUMN).cast(pl.Utf8)).unique()
+        factors, offsets = {}, {}
+        for code, unit in pairs.iter_rows():
+            conversion = self.conversion(code, unit)
+            if conversion is not None:
+                factors[f"{code}{KEY_SEPARATOR}{unit}"], offsets[f"{code}{KEY_SEPARATOR}{unit}"] = conversion
+        if not factors:
+            return frame
+        key = pl.concat_str(["code", pl.col(UNIT_COLUMN).cast(pl.Utf8)], separator=KEY_SEPARATOR)
+        factor = key.replace_strict(factors, default=None, return_dtype=pl.Float64)
+        offset = key.replace_strict(offsets, default=None, return_dtype=pl.Float64)
+        converted = pl.col("numeric_value").cast(pl.Float64) * factor + offset
+        return frame.with_columns(
+            numeric_value=pl.when(factor.is_not_null())
+            .then(converted)
+            .otherwise(pl.col("numeric_value"))
+            .cast(frame.schema["numeric_value"])
+        )
+
+    def promote_text(self, frame: pl.DataFrame) -> pl.DataFrame:
+        """
+        Move text values that are plain numbers to numeric_value (if it is not set).
+
+        Examples:
+            >>> frame = pl.DataFrame({
+            ...     "code": ["a", "a", "a", "a"],
+            ...     "numeric_value": [None, None, None, 1.0],
+            ...     "text_value": [" 7.4", "<5", "1e3", "2"],
+            ... })
+            >>> ValueNormalizer(promote_numeric_text=True).promote_text(frame).rows()
+            [('a', 7.4, None), ('a', None, '<5'), ('a', 1000.0, None), ('a', 1.0, '2')]
+        """
+        numeric = pl.col("numeric_value").is_null() & pl.col("text_value").str.contains(NUMERIC_PATTERN)
+        return frame.with_columns(
+            numeric_value=pl.when(numeric)
+            .then(pl.col("text_value").str.strip_chars().cast(pl.Float64, strict=False))
+            .otherwise(pl.col("numeric_value"))
+            .cast(frame.schema["numeric_value"]),
+            text_value=pl.when(numeric).then(None).otherwise(pl.col("text_value")),
+        )
+
+    def fingerprint(self) -> str:
+        """
+        Hash of the conversion table and options, for keys of cached normalized events.
+
+        Examples:
+            >>> ValueNormalizer().fingerprint() == ValueNormalizer(promote_numeric_text=True).fingerprint()
+            False
+        """
+        rows = sorted([code or "", unit, *conversion] for (code, unit), conversion in self.table.items())
+        payload = json.dumps([rows, self.promote_numeric_text])
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    def apply(self, frame: pl.DataFrame) -> pl.DataFrame:
+        """
+        Normalize a frame of mapped events with MEDS typed code, numeric_value and text_value
+        columns and, for unit conversion, a unit column.
+        """
+        frame = self.convert_units(frame)
+        if self.promote_numeric_text and frame.schema.get("text_value") == pl.Utf8:
+            frame = self.promote_text(frame)
+        return frame
+
+
+def make_normalizer(
+    normalize_units: bool = False, unit_conversions: Optional[str] = None, promote_numeric_text: bool = False
+) -> Optional[ValueNormalizer]:
+    """
+    The normalizer of the normalize_units, unit_conversions and promote_numeric_text options, or
+    None if neither is enabled.
+    """
+    if not normalize_units and not promote_numeric_text:
+        return None
+    if not normalize_units:
+        return ValueNormalizer(promote_numeric_text=True)
+    return ValueNormalizer.from_yaml(unit_conversions, promote_numeric_text)
+
+
+def with_unit_expression(event_config: Dict[str, Any], normalize_units: bool = False) -> Dict[str, Any]:
+    """
+    The event config with UNIT_EXPRESSION as the unit of its default section when converting units
+    and the default section has none. Without unit conversion, no unit is resolved.
+
+    Examples:
+        >>> config = {"default": {"numeric_value": "col(valueQuantity.value)"}}
+        >>> with_unit_expression(config) is config
+        True
+        >>> with_unit_expression(config, normalize_units=True)["default"]["unit"]
+        ['col(valueQuantity.code)', 'col(valueQuantity.unit)']
+    """
+    default = event_config.get("default", {})
+    if not normalize_units or UNIT_COLUMN in default:
+        return event_config
+    return {**event_config, "default": {**default, UNIT_COLUMN: UNIT_EXPRESSION}}
@@ -0,0 +1,162 @@
+"""
+validation.py
+-------------
+Production validation of raw FHIR resources against the fhir.resources models.
+Resources are validated in batches on a process pool, optionally on a sample only (every Nth
+resource and/or the first K per type), and failures are aggregated by resource type and error kind
+instead of being logged one by one. The resources themselves stay plain dicts for event mapping.
+"""
+
+import json
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .fhir_parser import parse_fhir_resource
+
+
+class ValidationReport:
+    """
+    Validation counts per resource type and failure counts per (resource type, error kind).
+    """
+
+    def __init__(self):
+        self.checked: Counter = Counter()
+        self.failed: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.examples: Dict[Tuple[str, str], str] = {}
+
+    def update(self, rtype: str, checked: int, failed: int, failures: Counter, examples: Dict[str, str]):
+        self.checked[rtype] += checked
+        self.failed[rtype] += failed
+        for kind, count in failures.items():
+            self.failures[(rtype, kind)] += count
+            self.examples.setdefault((rtype, kind), examples[kind])
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "checked": dict(self.checked),
+            "failed": dict(self.failed),
+            "failures": [
+                {
+                    "resource_type": rtype,
+                    "error_kind": kind,
+                    "count": count,
+                    "example": self.examples[(rtype, kind)],
+                }
+                for (rtype, kind), count in self.failures.most_common()
+            ],
+        }
+
+    def log(self):
+        total = sum(self.checked.values())
+        logging.info(f"Validated {total} resources, {sum(self.failed.values())} failed")
+        for (rtype, kind), count in self.failures.most_common():
+            logging.warning(
+                f"{count} {rtype} resources failed validation with {kind}: {self.examples[(rtype, kind)]}"
+            )
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def error_kinds(exc: Exception) -> List[Tuple[str, str]]:
+    """
+    Split an exception into (error kind, message) pairs. Pydantic validation errors are keyed by
+    error type and field location, so the same problem on different resources is counted together.
+    """
+    if hasattr(exc, "errors"):
+        try:
+            kinds = []
+            for err in exc.errors():
+                loc = ".".join(str(x) for x in err.get("loc", ()))
+                kinds.append((f"{err.get('type')} at {loc}", err.get("msg", "")))
+            if kinds:
+                return kinds
+        except Exception:
+            pass
+    return [(type(exc).__name__, str(exc))]
+
+
+def sample_resources(resources: List[Any], every_n: int = 1, first_k: Optional[int] = None) -> List[Any]:
+    """
+    Select every_n-th resource, limited to the first first_k selected ones.
+
+    Examples:
+        >>> sample_resources(list(range(10)), every_n=3)
+        [0, 3, 6, 9]
+        >>> sample_resources(list(range(10)), every_n=2, first_k=2)
+        [0, 2]
+    """
+    selected = resources[:: max(every_n, 1)]
+    if first_k is not None:
+        selected = selected[:first_k]
+    return selected
+
+
+def validate_batch(rtype: str, resources: List[Dict[str, Any]], fhir_version: str = "R4"):
+    """
+    Validate one batch of resources of a single type. Runs inside the worker processes, where the
+    resource class is imported once and cached by get_fhir_resource_class.
+    """
+    failures: Counter = Counter()
+    examples: Dict[str, str] = {}
+    failed = 0
+    for data in resources:
+        try:
+            parse_fhir_resource(data, fhir_version)
+        except Exception as e:
+            failed += 1
+            for kind, msg in error_kinds(e):
+                failures[kind] += 1
+                examples.setdefault(kind, f"{data.get('id')}: {msg}")
+    return rtype, len(resources), failed, failures, examples
+
+
+def _iter_batches(
+    resources_by_type, every_n, first_k, batch_size
+) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    for rtype, resources in resources_by_type.items():
+        selected = sample_resources(resources, every_n=every_n, first_k=first_k)
+        for i in range(0, len(selected), batch_size):
+            yield rtype, selected[i : i + batch_size]
+
+
+def validate_resources(
+    resources_by_type: Dict[str, List[Dict[str, Any]]],
+    fhir_version: str = "R4",
+    every_n: int = 1,
+    first_k: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    batch_size: int = 1000,
+) -> ValidationReport:
+    """
+    Validate raw resource dicts with fhir.resources and return an aggregated ValidationReport.
+
+    Args:
+        resources_by_type: Raw resources as returned by load_fhir_resources_by_type.
+        fhir_version: FHIR version of the models to validate against.
+        every_n: Only validate every Nth resource of each type.
+        first_k: Only validate the first K sampled resources of each type.
+        max_workers: Number of worker processes; defaults to os.cpu_count(). 1 validates in-process.
+        batch_size: Number of resources sent to a worker per task.
+    """
+    report = ValidationReport()
+    batches = _iter_batches(resources_by_type, every_n, first_k, batch_size)
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1:
+        for rtype, batch in batches:
+            report.update(*validate_batch(rtype, batch, fhir_version))
+        return report
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(validate_batch, rtype, batch, fhir_version) for rtype, batch in batches]
+        for future in futures:
+            report.update(*future.result())
+    return report
@@ -0,0 +1,360 @@
+"""
+watch.py
+--------
+Continuous micro-batch conversion (`stage=watch`). The converter polls raw_input_dir, converts the
+files that appeared since the last poll into delta shards (data/delta{batch}_{shard}.parquet) and
+refreshes the metadata, keeping the patient map, code metadata and the set of emitted codes warm in
+memory instead of re-parsing the whole input. Every compact_every batches the delta shards are
+merged into a new generation of subject-sorted shards (data/c{generation}_{shard}.parquet).
+
+Files are assumed to be immutable once written (as the NDJSON files of a FHIR feed or Bulk Data
+export are); a file is picked up once it was not modified for settle_seconds. Resources of patients
+whose Patient resource did not arrive yet are held back until it does, for at most pending_batches
+batches and max_pending resources (the oldest are dropped first). Duplicates are only dropped
+within a micro-batch. The processed files and the pending resources are kept in
+metadata/watch_state.json, so a restarted watcher continues where it stopped.
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .code_metadata import DEFAULT_MAX_CODES, CodeMetadata
+from .dedup import deduplicate_resources
+from .event_conversion import build_events, patient_id_map_from_resources
+from .fhir_parser import (
+    PAYLOAD_MIN_BYTES,
+    filter_subject_resources_by_type,
+    get_subject_reference,
+    iter_resources,
+    list_fhir_files,
+    load_fhir_resources_by_type,
+)
+from .manifest import write_manifest
+from .meds_writer import events_to_dataframe, write_meds_sharded_parquet
+from .metadata_writer import write_codes_metadata
+from .sharding import SPLIT_PARTIALS_DIR, assemble_subject_splits
+from .subject_index import INDEX_PARTIALS_DIR, assemble_subject_index
+
+STATE_PATH = os.path.join("metadata", "watch_state.json")
+CODES_PATH = os.path.join("metadata", "partials", "watch_codes.parquet")
+STAGING_DIR = ".compaction"
+DELTA_PREFIX = "delta"
+PENDING_BATCHES = 10
+MAX_PENDING = 100000
+CODE_RECORD_SCHEMA = pa.schema([(name, pa.string()) for name in ("code", "system", "source_code", "display")])
+
+
+def map_subject_resources(subject_resources, event_config, uuid_to_int, code_metadata, time_window=None):
+    """
+    Map subject-associated resources in-process, like the sequential path of the CLI.
+    """
+    events = []
+    for rtype, resources in subject_resources.items():
+        config = event_config.get(rtype, event_config["default"])
+        for res in resources:
+            for event, element_config in build_events(
+                res, config, uuid_to_int, event_config["default"], time_window
+            ):
+                if event.get("subject_id") not in (None, "", "null"):
+                    code_metadata.observe(res, element_config, event)
+                    events.append(event)
+    return events
+
+
+class MicroBatchConverter:
+    """
+    Incremental converter of raw_input_dir into output_dir, see the module docstring.
+    mapper(subject_resources, uuid_to_int, code_metadata) maps resources to events (a list of event
+    dicts or a MEDS typed frame); it defaults to map_subject_resources.
+    """
+
+    def __init__(
+        self,
+        raw_input_dir: str,
+        output_dir: str,
+        event_config: Dict[str, Any],
+        shard_size: int = 10000,
+        compact_every: int = 10,
+        settle_seconds: float = 5.0,
+        split_fractions: Optional[Dict[str, float]] = None,
+        split_seed: int = 0,
+        subject_index: bool = True,
+        row_group_size: Optional[int] = None,
+        deduplicate: bool = True,
+        payload_min_bytes: Optional[int] = PAYLOAD_MIN_BYTES,
+        max_code_metadata: int = DEFAULT_MAX_CODES,
+        manifest: bool = True,
+        mapper: Optional[Callable] = None,
+        pending_batches: int = PENDING_BATCHES,
+        max_pending: int = MAX_PENDING,
+    ):
+        if compact_every < 1:
+            raise ValueError(f"compact_every must be at least 1, got {compact_every}")
+        self.raw_input_dir = str(raw_input_dir)
+        self.output_dir = str(output_dir)
+        self.event_config = event_config
+        self.shard_size = shard_size
+        self.compact_every = compact_every
+        self.settle_seconds = settle_seconds
+        self.split_fractions = split_fractions
+        self.split_seed = split_seed
+        self.subject_index = subject_index
+        self.row_group_size = row_group_size
+        self.deduplicate = deduplicate
+        self.payload_min_bytes = payload_min_bytes
+        self.manifest = manifest
+        self.pending_batches = pending_batches
+        self.max_pending = max_pending
+        self.mapper = mapper or (
+            lambda resources, uuid_to_int, codes: map_subject_resources(
+                resources, event_config, uuid_to_int, codes
+            )
+        )
+        # Warm state
+        self.files: Dict[str, List[int]] = {}
+        # Held back resources by type, as [batch they arrived in, resource]
+        self.pending: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {}
+        self.batch = 0
+        self.generation = 0
+        self.deltas: List[str] = []
+        self.uuid_to_int: Dict[str, int] = {}
+        # Ids of the Patient resources seen, including those without an integer identifier
+        self.patients: Set[str] = set()
+        self.code_metadata = CodeMetadata(max_code_metadata)
+        self.codes = set()
+        os.makedirs(os.path.dirname(os.path.join(self.output_dir, CODES_PATH)), exist_ok=True)
+        self._restore()
+
+    def _restore(self) -> None:
+        path = os.path.join(self.output_dir, STATE_PATH)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            state = json.load(f)
+        self.files = state["files"]
+        self.pending = state["pending"]
+        self.batch = state["batch"]
+        self.generation = state["generation"]
+        self.deltas = state["deltas"]
+        # The patient map and terminology are rebuilt from the processed files, the codes are stored
+        seen = [fpath for fpath in self.files if os.path.exists(fpath)]
+        self._index_reference_resources(
+            iter_resources(self.raw_input_dir, types=["Patient", "CodeSystem", "ConceptMap"], files=seen)
+        )
+        codes_path = os.path.join(self.output_dir, CODES_PATH)
+        if os.path.exists(codes_path):
+            self.code_metadata.update_from_records(pq.read_table(codes_path).to_pylist())
+        codes_table = os.path.join(self.output_dir, "metadata", "codes.parquet")
+        if os.path.exists(codes_table):
+            self.codes.update(pq.read_table(codes_table, columns=["code"]).column("code").to_pylist())
+        if state.get("compaction"):
+            # A compaction was interrupted after it was staged, finish publishing it
+            self._publish(state["compaction"])
+        logging.info(
+            f"Resuming watch at batch {self.batch}: "
+            f"{len(self.files)} files processed, {len(self.deltas)} delta shards"
+        )
+
+    def _save(self, compaction: Optional[Dict[str, Any]] = None) -> None:
+        state = {
+            "files": self.files,
+            "pending": self.pending,
+            "batch": self.batch,
+            "generation": self.generation,
+            "deltas": self.deltas,
+            "compaction": compaction,
+        }
+        path = os.path.join(self.output_dir, STATE_PATH)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _index_reference_resources(self, resources) -> None:
+        resources = list(resources)
+        self.uuid_to_int.update(patient_id_map_from_resources(resources))
+        self.patients.update(
+            res["id"] for res in resources if res.get("resourceType") == "Patient" and "id" in res
+        )
+        self.code_metadata.index_terminology(resources)
+
+    def new_files(self) -> List[str]:
+        """
+        Input files not processed yet that were not modified for settle_seconds.
+        """
+        now = time.time()
+        ready = []
+        for fpath in list_fhir_files(self.raw_input_dir):
+            stat = os.stat(fpath)
+            if fpath in self.files:
+                if self.files[fpath] != [stat.st_size, stat.st_mtime_ns]:
+                    logging.warning(f"Ignoring changes to the already converted file {fpath}")
+                    self.files[fpath] = [stat.st_size, stat.st_mtime_ns]
+                continue
+            if now - stat.st_mtime >= self.settle_seconds:
+                ready.append(fpath)
+        return ready
+
+    def convert(self, files: List[str]) -> int:
+        """
+        Convert files into one batch of delta shards and refresh the metadata; returns the number of events.
+        """
+        for fpath in files:
+            stat = os.stat(fpath)
+            self.files[fpath] = [stat.st_size, stat.st_mtime_ns]
+        resources = load_fhir_resources_by_type(
+            self.raw_input_dir, self.event_config, files=files, payload_min_bytes=self.payload_min_bytes
+        )
+        if self.deduplicate:
+            resources = deduplicate_resources(resources)
+        self._index_reference_resources(
+            res for rtype in ("Patient", "CodeSystem", "ConceptMap") for res in resources.get(rtype, [])
+        )
+        # Hold back resources of patients that are not known yet, release those whose Patient arrived
+        subject_resources = filter_subject_resources_by_type(resources)
+        candidates = [(rtype, self.batch, res) for rtype, items in subject_resources.items() for res in items]
+        candidates += [(rtype, since, res) for rtype, held in self.pending.items() for since, res in held]
+        self.pending = {}
+        ready = {}
+        still_pending = []
+        n_expired = 0
+        for rtype, since, res in candidates:
+            uuid = get_subject_reference(res)
+            if rtype == "Patient" or uuid is None or uuid in self.patients:
+                ready.setdefault(rtype, []).append(res)
+            elif self.batch - since >= self.pending_batches:
+                n_expired += 1
+            else:
+                still_pending.append((rtype, since, res))
+        # Keep the newest max_pending resources
+        n_dropped = max(len(still_pending) - self.max_pending, 0)
+        still_pending.sort(key=lambda item: item[1])
+        for rtype, since, res in still_pending[n_dropped:]:
+            self.pending.setdefault(rtype, []).append((since, res))
+        if n_expired or n_dropped:
+            logging.warning(
+                f"Dropped {n_expired} resources whose Patient did not arrive within {self.pending_batches} "
+                f"batches and {n_dropped} beyond max_pending={self.max_pending}"
+            )
+
+        events = self.mapper(ready, self.uuid_to_int, self.code_metadata)
+        if not isinstance(events, pl.DataFrame):
+            events = events_to_dataframe(events)
+        events = events.filter(pl.col("subject_id").is_not_null())
+        n_events = events.height
+        if n_events:
+            prefix = f"{DELTA_PREFIX}{self.batch}_"
+            self._write(events, self.output_dir, prefix)
+            self.deltas.extend(
+                f"{prefix}{i}" for i in range((n_events + self.shard_size - 1) // self.shard_size)
+            )
+            self.codes.update(events["code"].drop_nulls().unique().to_list())
+        self.batch += 1
+        self._save()
+        self.write_metadata()
+        n_pending = sum(map(len, self.pending.values()))
+        logging.info(
+            f"Batch {self.batch}: {len(files)} files, {n_events} events, {n_pending} resources pending"
+        )
+        return n_events
+
+    def _write(self, events: pl.DataFrame, output_dir: str, prefix: str) -> None:
+        write_meds_sharded_parquet(
+            events,
+            output_dir,
+            shard_size=self.shard_size,
+            shard_prefix=prefix,
+            split_fractions=self.split_fractions,
+            split_seed=self.split_seed,
+            subject_index=self.subject_index,
+            row_group_size=self.row_group_size,
+        )
+
+    def write_metadata(self) -> None:
+        if self.uuid_to_int:
+            pl.DataFrame(self.uuid_to_int).unpivot().write_csv(
+                os.path.join(self.output_dir, "uuid_to_int.csv")
+            )
+        pq.write_table(
+            pa.Table.from_pylist(self.code_metadata.to_records(), schema=CODE_RECORD_SCHEMA),
+            os.path.join(self.output_dir, CODES_PATH),
+        )
+        write_codes_metadata(
+            self.output_dir, [{"code": code} for code in sorted(self.codes)], self.code_metadata
+        )
+        if self.split_fractions is not None:
+            assemble_subject_splits(self.output_dir)
+        if self.subject_index:
+            assemble_subject_index(self.output_dir)
+        if self.manifest:
+            write_manifest(self.output_dir)
+
+    def compact(self) -> None:
+        """
+        Merge the delta shards into a new generation of shards sorted by (subject_id, time).
+        The new shards are staged first and published afterwards, so an interrupted compaction is
+        either not visible at all or finished by the next start.
+        """
+        if not self.deltas:
+            return
+        self.generation += 1
+        data_dir = os.path.join(self.output_dir, "data")
+        events = pl.read_parquet([os.path.join(data_dir, f"{name}.parquet") for name in self.deltas])
+        events = events.sort("subject_id", "time", nulls_last=False, maintain_order=True)
+        staging = os.path.join(self.output_dir, STAGING_DIR)
+        shutil.rmtree(staging, ignore_errors=True)
+        self._write(events, staging, f"c{self.generation}_")
+        compaction = {"generation": self.generation, "deltas": self.deltas}
+        self._save(compaction)
+        self._publish(compaction)
+        logging.info(
+            f"Compacted {len(compaction['deltas'])} delta shards ({events.height} events) "
+            f"into generation {self.generation}"
+        )
+
+    def _publish(self, compaction: Dict[str, Any]) -> None:
+        staging = os.path.join(self.output_dir, STAGING_DIR)
+        # Move the staged shards and partials in place; repeating this after a crash is harmless
+        for subdir in ("data", SPLIT_PARTIALS_DIR, INDEX_PARTIALS_DIR):
+            source = os.path.join(staging, subdir)
+            if not os.path.isdir(source):
+                continue
+            target = os.path.join(self.output_dir, subdir)
+            os.makedirs(target, exist_ok=True)
+            for fname in os.listdir(source):
+                os.replace(os.path.join(source, fname), os.path.join(target, fname))
+        for name in compaction["deltas"]:
+            for subdir in ("data", SPLIT_PARTIALS_DIR, INDEX_PARTIALS_DIR):
+                path = os.path.join(self.output_dir, subdir, f"{name}.parquet")
+                if os.path.exists(path):
+                    os.remove(path)
+        shutil.rmtree(staging, ignore_errors=True)
+        self.deltas = [name for name in self.deltas if name not in set(compaction["deltas"])]
+        self._save()
+        self.write_metadata()
+
+    def run(self, interval: float = 60.0, max_batches: Optional[int] = None) -> None:
+        """
+        Poll for new files every interval seconds and convert them, until max_batches batches were
+        converted (forever if None) or the process is interrupted.
+        """
+        n_batches = 0
+        try:
+            while max_batches is None or n_batches < max_batches:
+                files = self.new_files()
+                if files:
+                    self.convert(files)
+                    n_batches += 1
+                    if len(self.deltas) and self.batch % self.compact_every == 0:
+                        self.compact()
+                    continue
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logging.info("Stopping watch")
@@ -0,0 +1,204 @@
+import json
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from urllib.parse import parse_qs, urlparse
+
+import polars as pl
+import pytest
+import requests
+
+from fhir2meds.bulk_export import BulkExportClient
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+TOKEN = "Bearer secret"
+
+
+class StubExportServer(ThreadingHTTPServer):
+    """Bulk Data server exporting the fixture files, which reports `in progress` polls times first."""
+
+    def __init__(self, polls=2, fail_status=False):
+        super().__init__(("127.0.0.1", 0), StubExportHandler)
+        self.polls = polls
+        self.fail_status = fail_status
+        self.requests = []
+        self.base = f"http://127.0.0.1:{self.server_address[1]}"
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class StubExportHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        server.requests.append((url.path, parse_qs(url.query), self.headers.get("Authorization")))
+        if self.headers.get("Authorization") != TOKEN:
+            self.send(401)
+        elif url.path == "/fhir/$export":
+            self.send(202, headers={"Content-Location": f"{server.base}/status/1"})
+        elif url.path == "/status/1":
+            if server.fail_status:
+                self.send(500, json.dumps({"resourceType": "OperationOutcome"}).encode())
+            elif server.polls > 0:
+                server.polls -= 1
+                self.send(202, headers={"Retry-After": "0", "X-Progress": "50%"})
+            else:
+                output = [
+                    {"type": f.name.split(".")[0], "url": f"{server.base}/files/{f.name}"}
+                    for f in sorted(FHIR_DIR.glob("*.ndjson"))
+                ]
+                manifest = {
+                    "transactionTime": "2024-01-01T00:00:00Z",
+                    "requiresAccessToken": True,
+                    "output": output,
+                }
+                self.send(200, json.dumps(manifest).encode(), {"Content-Type": "application/json"})
+        elif url.path.startswith("/files/"):
+            self.send(200, (FHIR_DIR / url.path[len("/files/") :]).read_bytes())
+        else:
+            self.send(404)
+
+
+def test_export_streams_all_resources():
+    with StubExportServer(polls=2) as server:
+        client = BulkExportClient(
+            f"{server.base}/fhir", headers={"Authorization": TOKEN}, concurrency=2, poll_interval=0
+        )
+        manifest = client.export(types=["Patient", "Condition"])
+        resources = list(client.iter_resources(manifest))
+        kick_off = server.requests[0]
+        assert kick_off[0] == "/fhir/$export" and kick_off[1]["_type"] == ["Patient,Condition"]
+        assert sum(1 for path, _, _ in server.requests if path == "/status/1") == 3
+
+    expected = [
+        json.loads(line) for f in sorted(FHIR_DIR.glob("*.ndjson")) for line in f.read_text().splitlines()
+    ]
+    key = lambda r: json.dumps(r, sort_keys=True)  # noqa: E731
+    assert sorted(map(key, resources)) == sorted(map(key, expected))
+
+
+def test_export_stops_early_and_reports_failures():
+    with StubExportServer(polls=0) as server:
+        client = BulkExportClient(f"{server.base}/fhir", headers={"Authorization": TOKEN}, concurrency=1)
+        manifest = client.export()
+        # Abandoning the stream cancels the remaining downloads
+        resources = client.iter_resources(manifest)
+        assert next(resources)["resourceType"]
+        resources.close()
+
+        with pytest.raises(ValueError):
+            BulkExportClient(f"{server.base}/fhir").export()
+    with StubExportServer(fail_status=True) as server:
+        with pytest.raises(ValueError, match="Bulk export failed: 500"):
+            BulkExportClient(f"{server.base}/fhir", headers={"Authorization": TOKEN}).export()
+
+
+class TrackedSession(requests.Session):
+    """Session recording whether it and the responses it returned were closed."""
+
+    opened = []
+
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+        self.responses = []
+        self.opened.append(self)
+
+    def get(self, url, **kwargs):
+        response = super().get(url, **kwargs)
+        self.responses.append(response)
+        return response
+
+    def close(self):
+        self.closed = True
+        super().close()
+
+
+def test_export_closes_sessions_and_responses():
+    with StubExportServer(polls=0) as server:
+        for stop_early in [False, True]:
+            TrackedSession.opened = []
+            with BulkExportClient(
+                f"{server.base}/fhir", headers={"Authorization": TOKEN}, session_factory=TrackedSession
+            ) as client:
+                resources = client.iter_resources(client.export())
+                if stop_early:
+                    next(resources)
+                    resources.close()
+                else:
+                    list(resources)
+            downloads = TrackedSession.opened[1:]
+            assert downloads and all(session.closed for session in TrackedSession.opened)
+            # Streamed responses give their connection back to the pool when closed
+            assert all(r.raw is None or r.raw.closed for s in downloads for r in s.responses)
+
+
+def test_cli_converts_bulk_export():
+    with TemporaryDirectory() as temp_dir, StubExportServer(polls=1) as server:
+        outputs = {}
+        for name, source in [
+            ("files", f"raw_input_dir={FHIR_DIR}"),
+            ("bulk", f"bulk_export_url={server.base}/fhir"),
+        ]:
+            root = Path(temp_dir) / name
+            command = [
+                sys.executable,
+                "-m",
+                "fhir2meds",
+                source,
+                f"root_output_dir={root}",
+                f"bulk_export_headers={{Authorization: '{TOKEN}'}}",
+                "bulk_export_poll_interval=0",
+            ]
+            out = subprocess.run(command, capture_output=True)
+            assert out.returncode == 0, out.stderr.decode()
+            data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+            outputs[name] = data.sort(data.columns, nulls_last=True)
+        assert outputs["bulk"].height == 24
+        assert outputs["bulk"].equals(outputs["files"])
+
+
+def test_sharded_workers_share_the_patient_map():
+    with TemporaryDirectory() as temp_dir, StubExportServer(polls=0) as server:
+        root = Path(temp_dir) / "sharded"
+        common = [
+            sys.executable,
+            "-m",
+            "fhir2meds",
+            f"bulk_export_url={server.base}/fhir",
+            f"root_output_dir={root}",
+            f"bulk_export_headers={{Authorization: '{TOKEN}'}}",
+            "bulk_export_poll_interval=0",
+            "num_workers=2",
+        ]
+        for worker in range(2):
+            out = subprocess.run([*common, f"worker_index={worker}"], capture_output=True)
+            assert out.returncode == 0, out.stderr.decode()
+        # Only one worker is assigned the Patient file, yet the events of both get integer subject ids
+        files = {path for path, _, _ in server.requests if path.startswith("/files/")}
+        assert "/files/Patient.ndjson" in files
+        data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+        assert data.height == 24
+        assert data["subject_id"].null_count() == 0
+        assert sorted(data["subject_id"].unique().to_list()) == [10000032, 10001217, 10002428]
@@ -0,0 +1,94 @@
+import io
+import json
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+
+from fhir2meds.fhir_parser import (
+    list_fhir_files,
+    load_event_config,
+    load_fhir_resources_by_type,
+)
+from fhir2meds.streaming_json import iter_json_resources
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+EVENT_CONFIG = load_event_config(fhir_version="R4")
+
+
+def fixture_resources():
+    return [
+        json.loads(line) for fpath in list_fhir_files(str(FHIR_DIR)) for line in open(fpath) if line.strip()
+    ]
+
+
+def searchset_bundle(resources):
+    return {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": len(resources),
+        "entry": [{"fullUrl": f"{r['resourceType']}/{r['id']}", "resource": r} for r in resources],
+    }
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_streaming_bundle_matches_json_load(chunk_size):
+    resources = fixture_resources()
+    text = json.dumps(searchset_bundle(resources), indent=2)
+    assert list(iter_json_resources(io.StringIO(text), chunk_size=chunk_size)) == resources
+
+
+def test_streaming_handles_numbers_split_across_chunks():
+    text = json.dumps(
+        {"resourceType": "Bundle", "entry": [{"resource": {"resourceType": "Basic", "n": 123456789}}]}
+    )
+    assert [r["n"] for r in iter_json_resources(io.StringIO(text), chunk_size=3)] == [123456789]
+
+
+def test_truncated_bundle_raises():
+    text = json.dumps(searchset_bundle(fixture_resources()))[:-50]
+    with pytest.raises(ValueError):
+        list(iter_json_resources(io.StringIO(text), chunk_size=16))
+
+
+def test_transaction_bundle_resolves_urn_references():
+    patient = {"resourceType": "Patient", "identifier": [{"system": "x/identifier/patient", "value": "7"}]}
+    obs = {"resourceType": "Observation", "subject": {"reference": "urn:uuid:abc"}, "code": {"coding": []}}
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            {"fullUrl": "urn:uuid:abc", "resource": patient, "request": {"method": "POST", "url": "Patient"}},
+            {"fullUrl": "urn:uuid:def", "resource": obs, "request": {"method": "POST", "url": "Observation"}},
+        ],
+    }
+    with TemporaryDirectory() as temp_dir:
+        (Path(temp_dir) / "transaction.json").write_text(json.dumps(bundle))
+        resources = load_fhir_resources_by_type(temp_dir, EVENT_CONFIG)
+    assert resources["Patient"][0]["id"] == "abc"
+    assert resources["Observation"][0]["subject"]["reference"] == "Patient/abc"
+    assert "Bundle" not in resources
+
+
+def test_bundle_input_converts_like_ndjson():
+    with TemporaryDirectory() as temp_dir:
+        bundle_dir = Path(temp_dir) / "bundles"
+        bundle_dir.mkdir()
+        resources = fixture_resources()
+        # One pretty-printed single-file Bundle and one NDJSON file holding a Bundle per line
+        (bundle_dir / "export.json").write_text(json.dumps(searchset_bundle(resources[:20]), indent=2))
+        (bundle_dir / "rest.ndjson").write_text(
+            "\n".join(json.dumps(searchset_bundle([r])) for r in resources[20:]) + "\n"
+        )
+        outputs = []
+        for name, raw in [("from_ndjson", FHIR_DIR), ("from_bundles", bundle_dir)]:
+            out = Path(temp_dir) / name
+            cmd = [sys.executable, "-m", "fhir2meds", f"raw_input_dir={raw}", f"root_output_dir={out}"]
+            subprocess.run(cmd, check=True, capture_output=True)
+            df = pl.read_parquet(list((out / "data").glob("*.parquet")))
+            outputs.append(df.sort(df.columns, nulls_last=True))
+        assert outputs[1].height > 0
+        assert outputs[0].equals(outputs[1])
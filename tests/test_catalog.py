@@ -0,0 +1,98 @@
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from fhir2meds import catalog as catalog_module
+from fhir2meds.catalog import build_catalog, count_lines_and_offsets, plan, select_files
+from fhir2meds.fhir_parser import load_event_config
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def test_line_counts_and_offsets_match_content():
+    with TemporaryDirectory() as temp_dir:
+        fpath = Path(temp_dir) / "Observation.ndjson"
+        lines = [
+            json.dumps({"resourceType": "Observation", "id": str(i), "pad": "x" * (i % 37)})
+            for i in range(500)
+        ]
+        fpath.write_text("\n".join(lines) + "\n")
+        content = fpath.read_bytes()
+        n_lines, offsets = count_lines_and_offsets(str(fpath), chunk_bytes=1000, block_size=333)
+        assert n_lines == 500
+        assert offsets[0] == 0
+        assert all(content[o - 1 : o] == b"\n" for o in offsets[1:])
+        assert all(b - a >= 1000 for a, b in zip(offsets, offsets[1:]))
+        # Reading the chunks back yields every line exactly once
+        chunks = [content[a:b] for a, b in zip(offsets, offsets[1:] + [len(content)])]
+        assert b"".join(chunks).decode().splitlines() == lines
+
+
+def test_catalog_is_cached_by_size_and_mtime(monkeypatch):
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        shutil.copytree(FHIR_DIR, input_dir)
+        manifest = str(Path(temp_dir) / "catalog.json")
+        first = build_catalog(str(input_dir), manifest_path=manifest)
+        by_name = {Path(e["path"]).name: e for e in first}
+        assert by_name["ObservationChartevents.ndjson"]["resource_type"] == "Observation"
+        assert by_name["ObservationChartevents.ndjson"]["n_resources"] == 12
+        assert by_name["Organization.ndjson"]["subject_fraction"] == 0.0
+
+        scanned = []
+        real_scan_file = catalog_module.scan_file
+        monkeypatch.setattr(
+            catalog_module, "scan_file", lambda p, **kw: scanned.append(p) or real_scan_file(p, **kw)
+        )
+        with open(input_dir / "Condition.ndjson", "a") as f:
+            f.write(open(input_dir / "Condition.ndjson").readline())
+        second = build_catalog(str(input_dir), manifest_path=manifest)
+        assert [Path(p).name for p in scanned] == ["Condition.ndjson"]
+        assert {Path(e["path"]).name: e for e in second}["Condition.ndjson"]["n_resources"] == 4
+
+
+def test_select_files_and_plan():
+    catalog = build_catalog(str(FHIR_DIR))
+    event_config = load_event_config(fhir_version="R4")
+    assert len(select_files(catalog, ["Patient"])) == 1
+    estimate = plan(catalog, event_config)
+    # Every fixture resource except the Organization maps to one event
+    assert estimate["estimated_events"] == 24
+    assert estimate["estimated_output_bytes"] > 0
+    assert estimate["estimated_seconds"] > 0
+
+
+def test_bundles_are_not_skipped_on_a_partial_sample():
+    with TemporaryDirectory() as temp_dir:
+        entries = [{"resource": {"resourceType": "Patient", "id": str(i)}} for i in range(150)]
+        entries.append({"resource": {"resourceType": "Condition", "id": "c"}})
+        bundle = {"resourceType": "Bundle", "type": "collection", "entry": entries}
+        (Path(temp_dir) / "mixed.json").write_text(json.dumps(bundle))
+        (Path(temp_dir) / "patients.json").write_text(json.dumps({**bundle, "entry": entries[:10]}))
+        catalog = build_catalog(temp_dir)
+        by_name = {Path(e["path"]).name: e for e in catalog}
+        assert by_name["mixed.json"]["resource_type"] is None
+        assert by_name["patients.json"]["resource_type"] == "Patient"
+        assert by_name["patients.json"]["n_resources"] == 10
+        assert [Path(p).name for p in select_files(catalog, ["Condition"])] == ["mixed.json"]
+
+
+def test_cli_dry_run_and_catalog():
+    with TemporaryDirectory() as temp_dir:
+        out = Path(temp_dir) / "out"
+        base = [sys.executable, "-m", "fhir2meds", f"raw_input_dir={FHIR_DIR}", f"root_output_dir={out}"]
+        dry = subprocess.run(base + ["dry_run=true"], capture_output=True, check=True)
+        assert b"Estimated events: 24" in dry.stdout
+        assert not (out / "data").exists()
+        subprocess.run(base + ["use_catalog=true"], capture_output=True, check=True)
+        catalog_path = Path(temp_dir) / "out_catalog.json"
+        assert catalog_path.exists()
+        assert len(list((out / "data").glob("*.parquet"))) == 1
+        # Overwriting the output reuses the cached catalog instead of rescanning every file
+        run = subprocess.run(
+            base + ["use_catalog=true", "do_overwrite=true"], capture_output=True, check=True
+        )
+        assert b"(0 scanned, 6 cached)" in run.stdout + run.stderr
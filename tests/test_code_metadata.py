@@ -0,0 +1,104 @@
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+
+from fhir2meds.code_metadata import CodeMetadata
+from fhir2meds.event_conversion import build_event
+from fhir2meds.fhir_parser import load_event_config
+from fhir2meds.metadata_writer import build_codes_table
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+ICD9 = "http://mimic.mit.edu/fhir/mimic/CodeSystem/mimic-diagnosis-icd9"
+
+CODE_SYSTEM = {
+    "resourceType": "CodeSystem",
+    "url": ICD9,
+    "concept": [
+        {
+            "code": "401",
+            "display": "Essential hypertension",
+            "concept": [
+                {"code": "4019", "display": "Unspecified essential hypertension"},
+                {"code": "4011", "display": "Benign essential hypertension"},
+            ],
+        },
+    ],
+}
+CONCEPT_MAP = {
+    "resourceType": "ConceptMap",
+    "group": [
+        {
+            "source": ICD9,
+            "target": "http://snomed.info/sct",
+            "element": [{"code": "4019", "target": [{"code": "59621000", "equivalence": "equivalent"}]}],
+        }
+    ],
+}
+
+
+def condition(code, display=None):
+    coding = {"system": ICD9, "code": code}
+    if display is not None:
+        coding["display"] = display
+    return {
+        "resourceType": "Condition",
+        "subject": {"reference": "Patient/p1"},
+        "code": {"coding": [coding]},
+        "onsetDateTime": "2180-01-01T00:00:00",
+    }
+
+
+def map_events(resources, code_metadata):
+    event_config = load_event_config(fhir_version="R4")
+    events = []
+    for res in resources:
+        config = event_config.get(res["resourceType"], event_config["default"])
+        event = build_event(res, config, {"p1": 1}, event_config["default"])
+        code_metadata.observe(res, config, event)
+        events.append(event)
+    return events
+
+
+def test_descriptions_and_parents_from_terminology():
+    code_metadata = CodeMetadata()
+    code_metadata.index_terminology([CODE_SYSTEM, CONCEPT_MAP])
+    events = map_events(
+        [condition("4019", display="HTN"), condition("4011"), condition("9999")], code_metadata
+    )
+    table = {row["code"]: row for row in build_codes_table(events, code_metadata).to_pylist()}
+
+    # The CodeSystem display wins over the coding's display
+    assert table["Condition//ICD9//4019"]["description"] == "Unspecified essential hypertension"
+    assert table["Condition//ICD9//4019"]["parent_codes"] == ["Condition//ICD9//401", "SNOMED//59621000"]
+    assert table["Condition//ICD9//4011"]["description"] == "Benign essential hypertension"
+    assert table["Condition//ICD9//4011"]["parent_codes"] == ["Condition//ICD9//401"]
+    # Unknown codes are still described by themselves
+    assert table["Condition//ICD9//9999"]["description"] == "Condition//ICD9//9999"
+
+
+def test_code_metadata_is_bounded_and_mergeable():
+    code_metadata = CodeMetadata(max_codes=2)
+    map_events([condition("1"), condition("2"), condition("3", display="three")], code_metadata)
+    assert len(code_metadata.codes) == 2 and code_metadata.n_overflow == 1
+
+    # A later display fills in a code first seen without one
+    other = CodeMetadata()
+    map_events([condition("1", display="one")], other)
+    code_metadata.update_from_records(other.to_records())
+    assert code_metadata.describe("Condition//ICD9//1") == ("one", [])
+
+
+def test_codes_metadata_has_displays():
+    with TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir) / "output"
+        command = [sys.executable, "-m", "fhir2meds", f"raw_input_dir={FHIR_DIR}", f"root_output_dir={root}"]
+        out = subprocess.run(command, capture_output=True)
+        assert out.returncode == 0, out.stderr.decode()
+        codes = pl.read_parquet(root / "metadata" / "codes.parquet")
+        descriptions = dict(zip(codes["code"].to_list(), codes["description"].to_list()))
+        assert descriptions["Condition//ICD9//4019"] == "Unspecified essential hypertension"
+        assert descriptions["Observation//D-LABITEMS//50912"] == "Creatinine"
+        assert descriptions["MEDS_BIRTH"] == "MEDS_BIRTH"
@@ -0,0 +1,73 @@
+import json
+import subprocess
+import sys
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+
+from fhir2meds.cohort import Cohort
+from fhir2meds.fhir_parser import load_event_config, load_fhir_resources_by_type
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+PATIENT_UUID = "6aec9dae-b873-5ede-bedb-43127439e809"  # subject 10000032
+
+
+def read_data(root):
+    data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+    return data.sort(data.columns, nulls_last=True)
+
+
+def test_cohort_prefilter_matches_exact_filter():
+    cohort = Cohort([PATIENT_UUID])
+    resources = load_fhir_resources_by_type(str(FHIR_DIR), load_event_config(), cohort=cohort)
+    lines = [
+        line
+        for f in sorted(FHIR_DIR.glob("*.ndjson"))
+        for line in f.read_bytes().splitlines()
+        if line.strip()
+    ]
+    expected = [json.loads(line) for line in lines if cohort.keep(json.loads(line))]
+    assert sum(map(len, resources.values())) == len(expected)
+    assert resources["Patient"] == [r for r in expected if r["resourceType"] == "Patient"]
+    # Lines of other patients are skipped without being decoded
+    assert sum(1 for line in lines if not cohort.may_contain(line)) > 0
+
+
+def test_cli_converts_cohort_within_time_window():
+    with TemporaryDirectory() as temp_dir:
+        cohort_path = Path(temp_dir) / "cohort.csv"
+        cohort_path.write_text(f"subject\n{PATIENT_UUID}\n10002428,study arm B\n")
+        outputs = {}
+        for name, args in [
+            ("full", []),
+            (
+                "cohort",
+                [
+                    f"cohort_path={cohort_path}",
+                    "time_window_start=2180-07-21",
+                    "time_window_end='2189-01-01T00:00:00'",
+                ],
+            ),
+        ]:
+            root = Path(temp_dir) / name
+            command = [
+                sys.executable,
+                "-m",
+                "fhir2meds",
+                f"raw_input_dir={FHIR_DIR}",
+                f"root_output_dir={root}",
+                *args,
+            ]
+            out = subprocess.run(command, capture_output=True)
+            assert out.returncode == 0, out.stderr.decode()
+            outputs[name] = read_data(root)
+
+        expected = outputs["full"].filter(
+            pl.col("subject_id").is_in([10000032, 10002428])
+            & (pl.col("time") >= datetime(2180, 7, 21))
+            & (pl.col("time") < datetime(2189, 1, 1))
+        )
+        assert 0 < outputs["cohort"].height < outputs["full"].height
+        assert outputs["cohort"].equals(expected)
@@ -0,0 +1,69 @@
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+
+from fhir2meds.dedup import deduplicate_resources, duplicate_candidates
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def observation(id, version=None, last_updated=None, value=None):
+    res = {"resourceType": "Observation", "id": id, "meta": {}, "valueString": value}
+    if version is not None:
+        res["meta"]["versionId"] = version
+    if last_updated is not None:
+        res["meta"]["lastUpdated"] = last_updated
+    return res
+
+
+def test_deduplicate_keeps_latest_version():
+    resources = [
+        observation("a", version="2", value="a2"),
+        observation("b", value="b"),
+        observation("a", version="10", value="a10"),
+        observation("a", version="3", value="a3"),
+        observation("c", last_updated="2024-01-02T00:00:00+02:00", value="c-new"),
+        observation("c", last_updated="2024-01-01T23:00:00Z", value="c-old"),
+        observation("d", value="d1"),
+        observation("d", value="d2"),
+        {"resourceType": "Observation", "valueString": "no id"},
+        {"resourceType": "Observation", "valueString": "no id"},
+    ]
+    result = deduplicate_resources({"Observation": resources})
+    # 2024-01-02T00:00+02:00 is 2024-01-01T22:00Z, so the other version is newer; ties keep the last
+    assert [r["valueString"] for r in result["Observation"]] == ["b", "a10", "c-old", "d2", "no id", "no id"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 20])
+def test_duplicate_candidates_across_chunks(chunk_size):
+    resources = [{"resourceType": "Observation", "id": str(i % 4)} for i in range(10)]
+    resources += [{"resourceType": "Observation"}, {"resourceType": "Condition", "id": "0"}]
+    assert duplicate_candidates(resources, chunk_size=chunk_size) == list(range(10))
+
+
+def test_overlapping_exports_do_not_duplicate_events():
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        shutil.copytree(FHIR_DIR, input_dir)
+        # An incremental export repeating the conditions
+        shutil.copy(FHIR_DIR / "Condition.ndjson", input_dir / "Condition_incremental.ndjson")
+        outputs = {}
+        for name, raw_input_dir in [("original", FHIR_DIR), ("overlapping", input_dir)]:
+            root = Path(temp_dir) / name
+            command = [
+                sys.executable,
+                "-m",
+                "fhir2meds",
+                f"raw_input_dir={raw_input_dir}",
+                f"root_output_dir={root}",
+            ]
+            out = subprocess.run(command, capture_output=True)
+            assert out.returncode == 0, out.stderr.decode()
+            data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+            outputs[name] = data.sort(data.columns, nulls_last=True)
+        assert outputs["overlapping"].equals(outputs["original"])
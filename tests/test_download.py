@@ -0,0 +1,82 @@
+import hashlib
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+from omegaconf import DictConfig
+
+from fhir2meds.download import (
+    CHECKSUM_FILE,
+    VERIFIED_FILE,
+    MockResponse,
+    MockSession,
+    download_data,
+)
+
+BASE = "http://example.com/files/mimic-fhir/"
+FILES = {"Patient.ndjson": '{"id": "1"}\n', "Condition.ndjson": '{"id": "2"}\n'}
+
+
+class CorruptingSession(MockSession):
+    """Serves a truncated copy of some files for their first n_corrupt requests."""
+
+    def __init__(self, pages, corrupt, n_corrupt=1):
+        super().__init__(return_contents=pages)
+        self.n_corrupt = {url: n_corrupt for url in corrupt}
+        self.requests = []
+
+    def get(self, url, stream=False):
+        self.requests.append(url)
+        response = super().get(url, stream)
+        if self.n_corrupt.get(url):
+            self.n_corrupt[url] -= 1
+            return MockResponse(200, response.text[:-3])
+        return response
+
+
+def pages():
+    listing = "".join(f"<a href='{BASE}{name}'>{name}</a>" for name in [*FILES, "README.txt"])
+    sums = "".join(
+        f"{hashlib.sha256(text.encode()).hexdigest()}  mimic-fhir/{name}\n" for name, text in FILES.items()
+    )
+    return {
+        BASE: listing,
+        **{BASE + name: text for name, text in FILES.items()},
+        BASE + "README.txt": "no checksum",
+        f"http://example.com/files/{CHECKSUM_FILE}": sums,
+    }
+
+
+def download(output_dir, session):
+    cfg = DictConfig({"urls": {"dataset": [BASE]}})
+    download_data(Path(output_dir), cfg, session_factory=lambda: session)
+
+
+def test_corrupted_downloads_are_fetched_again_and_recorded():
+    with TemporaryDirectory() as temp_dir:
+        session = CorruptingSession(pages(), corrupt=[BASE + "Patient.ndjson"])
+        download(temp_dir, session)
+        assert session.requests.count(BASE + "Patient.ndjson") == 2
+        for name, text in FILES.items():
+            assert (Path(temp_dir) / name).read_text() == text
+        records = json.loads((Path(temp_dir) / VERIFIED_FILE).read_text())
+        assert set(records) == set(FILES)
+
+        # Verified files are neither downloaded nor hashed again, changed files are
+        (Path(temp_dir) / "Condition.ndjson").write_text("changed")
+        session = CorruptingSession(pages(), corrupt=[])
+        download(temp_dir, session)
+        assert BASE + "Patient.ndjson" not in session.requests
+        assert BASE + "Condition.ndjson" in session.requests
+        assert (Path(temp_dir) / "Condition.ndjson").read_text() == FILES["Condition.ndjson"]
+
+
+def test_persistent_mismatch_fails():
+    with TemporaryDirectory() as temp_dir:
+        session = CorruptingSession(pages(), corrupt=[BASE + "Condition.ndjson"], n_corrupt=10)
+        with pytest.raises(ValueError, match="Failed to download data") as e:
+            download(temp_dir, session)
+        assert "Condition.ndjson" in str(e.value.__cause__)
+        # The intact file is still recorded
+        assert set(json.loads((Path(temp_dir) / VERIFIED_FILE).read_text())) == {"Patient.ndjson"}
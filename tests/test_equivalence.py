@@ -0,0 +1,96 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+
+from fhir2meds.equivalence import (
+    ENGINES,
+    diff_tables,
+    format_report,
+    load_input,
+    read_output,
+    reference_engine,
+    run_harness,
+    synthetic_input,
+)
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def perturbed_engine(subject_resources, event_config, uuid_to_int, output_dir):
+    # Writes the reference rows, but with one value changed and one row dropped
+    reference_engine(subject_resources, event_config, uuid_to_int, output_dir)
+    path = os.path.join(output_dir, "data", "0.parquet")
+    events = pl.read_parquet(path)
+    numeric = events["numeric_value"].is_not_null().arg_true()[0]
+    events = events.with_columns(
+        numeric_value=pl.when(pl.int_range(pl.len()) == numeric)
+        .then(pl.col("numeric_value") + 1)
+        .otherwise(pl.col("numeric_value"))
+    )
+    events.filter(pl.int_range(pl.len()) != events.height - 1).write_parquet(path)
+
+
+def failing_engine(subject_resources, event_config, uuid_to_int, output_dir):
+    raise RuntimeError("not implemented")
+
+
+def test_engines_match_the_reference_on_the_fixture():
+    runs = run_harness(*load_input(str(FHIR_DIR)))
+    assert [run.name for run in runs] == list(ENGINES)
+    assert all(run.ok for run in runs), format_report(runs)
+    assert len({run.n_rows for run in runs}) == 1
+    assert all(run.rows_per_second > 0 for run in runs)
+
+
+def test_engines_match_the_reference_on_synthetic_input():
+    subject_resources, event_config, uuid_to_int = synthetic_input(10, seed=1)
+    runs = run_harness(subject_resources, event_config, uuid_to_int, repeat=2)
+    assert all(run.ok for run in runs), format_report(runs)
+    assert len({run.n_rows for run in runs}) == 1
+    # The synthetic resources are reproducible from the seed
+    assert synthetic_input(10, seed=1)[0] == subject_resources
+
+
+def test_mismatches_are_reported():
+    runs = run_harness(
+        *load_input(str(FHIR_DIR)),
+        engines={"perturbed": perturbed_engine, "failing": failing_engine},
+        limit=3,
+    )
+    reference, perturbed, failing = runs
+    assert reference.ok and not perturbed.ok and not failing.ok
+    assert any("numeric_value" in problem and "reference" in problem for problem in perturbed.problems)
+    assert any(problem.startswith("missing row") for problem in perturbed.problems)
+    assert perturbed.problems[-1].startswith("2 rows missing, 1 unexpected rows")
+    assert failing.problems == ["failed: RuntimeError: not implemented"]
+    report = format_report(runs)
+    assert "perturbed: missing row" in report and "3 problems" in report
+
+
+def test_diff_reports_schema_differences():
+    with TemporaryDirectory() as temp_dir:
+        reference_engine(*load_input(str(FHIR_DIR)), temp_dir)
+        expected = read_output(temp_dir)
+    problems = diff_tables(expected, expected.with_columns(pl.col("subject_id").cast(pl.Int32)).drop("code"))
+    assert problems == ["column subject_id is Int32, reference has Int64", "missing column code"]
+
+
+def test_cli_equivalence_stage():
+    with TemporaryDirectory() as temp_dir:
+        cmd = [
+            sys.executable,
+            "-m",
+            "fhir2meds",
+            f"raw_input_dir={FHIR_DIR}",
+            f"root_output_dir={temp_dir}",
+            "stage=equivalence",
+            "equivalence_engines=[sequential]",
+            "equivalence_synthetic_subjects=5",
+        ]
+        out = subprocess.run(cmd, check=True, capture_output=True).stdout.decode()
+    assert "5 synthetic subjects:" in out
+    assert out.count("sequential ") == 2 and "problems" not in out
@@ -0,0 +1,47 @@
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import yaml
+
+from fhir2meds.fhir_parser import CONFIG_PATH
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def read_data(root):
+    data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+    return data.sort(data.columns, nulls_last=True)
+
+
+def run(*args):
+    out = subprocess.run(
+        [sys.executable, "-m", "fhir2meds", f"raw_input_dir={FHIR_DIR}", *args], capture_output=True
+    )
+    assert out.returncode == 0, out.stderr.decode()
+
+
+def test_event_configs_are_converted_in_one_pass():
+    with TemporaryDirectory() as temp_dir:
+        # A variant keyed on the encounter class instead of the encounter type, without observations
+        with open(CONFIG_PATH) as f:
+            config = yaml.safe_load(f)
+        config["R4"]["Encounter"]["code"] = ["const(resourceType)", "const(//)", "col(class[code])"]
+        config["R4"]["resources"] = [r for r in config["R4"]["resources"] if r != "Observation"]
+        variant_path = Path(temp_dir) / "by_class.yaml"
+        variant_path.write_text(yaml.safe_dump(config))
+
+        single, multi = Path(temp_dir) / "single", Path(temp_dir) / "multi"
+        run(f"root_output_dir={single}")
+        run(f"root_output_dir={multi}", f"event_configs={{default: null, by_class: {variant_path}}}")
+
+        assert read_data(multi / "default").equals(read_data(single))
+        for name in ("codes.parquet", "subject_splits.parquet", "subject_index.parquet", "dataset.json"):
+            assert (multi / "by_class" / "metadata" / name).exists()
+        variant = read_data(multi / "by_class")
+        expected = read_data(single).filter(~pl.col("code").str.starts_with("Observation//"))
+        assert variant.height == expected.height
+        encounter_codes = set(variant.filter(pl.col("code").str.starts_with("Encounter//"))["code"])
+        assert encounter_codes and encounter_codes.isdisjoint(expected["code"])
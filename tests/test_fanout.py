@@ -0,0 +1,200 @@
+import copy
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+import yaml
+
+from fhir2meds.code_metadata import CodeMetadata
+from fhir2meds.cohort import make_time_window
+from fhir2meds.event_conversion import build_events
+from fhir2meds.fanout import map_fanout_batch
+from fhir2meds.fhir_parser import (
+    CONFIG_PATH,
+    load_event_config,
+    load_fhir_resources_by_type,
+)
+from fhir2meds.meds_writer import events_to_dataframe
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+LOINC = "http://loinc.org"
+PANEL_CONFIG = {
+    "code": [
+        "const(resourceType)",
+        "const(//)",
+        "vocab(component[*][code][coding][0][system])",
+        "const(//)",
+        "col(component[*][code][coding][0][code])",
+    ],
+    "numeric_value": "col(component[*][valueQuantity][value])",
+}
+DOSAGE_CONFIG = {
+    "code": ["const(resourceType)", "const(//)", "col(dosageInstruction[*][route][coding][0][code])"],
+    "time": "col(authoredOn)",
+    "numeric_value": "col(dosageInstruction[*][doseAndRate][*][doseQuantity][value])",
+    "text_value": "col(dosageInstruction[*][text])",
+}
+
+
+def panel(i, components, patient="p1"):
+    return {
+        "resourceType": "Observation",
+        "id": f"bp{i}",
+        "subject": {"reference": f"Patient/{patient}"},
+        "effectiveDateTime": f"2180-01-0{i}T10:00:00",
+        "code": {"coding": [{"system": LOINC, "code": "85354-9"}]},
+        "component": components,
+    }
+
+
+def component(code, value, display=None):
+    coding = {"system": LOINC, "code": code}
+    if display is not None:
+        coding["display"] = display
+    return {"code": {"coding": [coding]}, "valueQuantity": {"value": value}}
+
+
+def dosage(text, route, doses):
+    return {
+        "text": text,
+        "route": {"coding": [{"code": route}]},
+        "doseAndRate": [{"doseQuantity": {"value": dose}} for dose in doses],
+    }
+
+
+PANELS = [
+    panel(1, [component("8480-6", 120, "Systolic"), component("8462-4", 80.5, "Diastolic")]),
+    panel(2, []),
+    {"resourceType": "Observation", "id": "single", "subject": {"reference": "Patient/p1"}},
+    panel(3, [component("8480-6", None)]),
+    {**panel(4, [component("8480-6", 130)]), "subject": None},
+    panel(5, [component("8462-4", 70)]),
+]
+MEDICATION_REQUESTS = [
+    {
+        "resourceType": "MedicationRequest",
+        "subject": {"reference": "Patient/p1"},
+        "authoredOn": "2180-02-01",
+        "dosageInstruction": [
+            dosage("twice", "PO", [1, 2.5]),
+            dosage("none", "IV", []),
+            dosage("once", "IV", [5]),
+        ],
+    },
+    {"resourceType": "MedicationRequest", "subject": {"reference": "Patient/p1"}, "authoredOn": "2180-02-02"},
+]
+
+
+def reference_events(resources, config, default_config, uuid_to_int, time_window=None):
+    code_metadata = CodeMetadata()
+    events = []
+    for res in resources:
+        element_events = build_events(res, copy.deepcopy(config), uuid_to_int, default_config, time_window)
+        for event, element_config in element_events:
+            if event.get("subject_id") not in (None, "", "null"):
+                code_metadata.observe(res, element_config, event)
+                events.append(event)
+    return events_to_dataframe(events), code_metadata
+
+
+@pytest.mark.parametrize(
+    "resources, config, time_window",
+    [
+        (PANELS, PANEL_CONFIG, None),
+        (PANELS, PANEL_CONFIG, make_time_window("2180-01-02", "2180-01-05")),
+        (MEDICATION_REQUESTS, DOSAGE_CONFIG, None),
+    ],
+)
+def test_columnar_fanout_matches_reference(resources, config, time_window):
+    default_config = load_event_config()["default"]
+    uuid_to_int = {"p1": 1}
+    want, want_codes = reference_events(resources, config, default_config, uuid_to_int, time_window)
+    codes = CodeMetadata()
+    got, _ = map_fanout_batch(
+        resources, copy.deepcopy(config), uuid_to_int, default_config, time_window, code_metadata=codes
+    )
+    assert got.equals(want)
+    assert codes.codes == want_codes.codes
+
+
+def test_panel_and_nested_dosage_events():
+    default_config = load_event_config()["default"]
+    panels, without_events = map_fanout_batch(PANELS, copy.deepcopy(PANEL_CONFIG), {"p1": 1}, default_config)
+    # The empty panel, the Observation without components and the one without subject
+    assert without_events == 3
+    assert panels["code"].to_list() == [
+        "Observation//LOINC//8480-6",
+        "Observation//LOINC//8462-4",
+        "Observation//LOINC//8480-6",
+        "Observation//LOINC//8462-4",
+    ]
+    assert panels["numeric_value"].to_list() == [120.0, 80.5, None, 70.0]
+    doses, _ = map_fanout_batch(MEDICATION_REQUESTS, copy.deepcopy(DOSAGE_CONFIG), {"p1": 1}, default_config)
+    # Inner doses fan out, enclosing dosage instructions without doses emit nothing
+    assert doses.select("code", "numeric_value", "text_value").rows() == [
+        ("MedicationRequest//PO", 1.0, "twice"),
+        ("MedicationRequest//PO", 2.5, "twice"),
+        ("MedicationRequest//IV", 5.0, "once"),
+    ]
+
+
+def test_fanout_over_fixture_codings():
+    event_config = load_event_config()
+    resources = load_fhir_resources_by_type(str(FHIR_DIR), event_config)["Condition"]
+    uuid_to_int = {res["subject"]["reference"].split("/")[-1]: i for i, res in enumerate(resources)}
+    code = ["const(resourceType)", "const(//)", "col(code[coding][*][code])"]
+    config = {**event_config["default"], "code": code}
+    want, want_codes = reference_events(resources, config, event_config["default"], uuid_to_int)
+    codes = CodeMetadata()
+    got, _ = map_fanout_batch(
+        resources, copy.deepcopy(config), uuid_to_int, event_config["default"], code_metadata=codes
+    )
+    assert got.height >= len(resources)
+    assert got.equals(want)
+    assert codes.codes == want_codes.codes
+
+
+def test_cli_fans_out_panels():
+    # mapping_workers=2 maps in parallel_mapping.map_batch, 1 in the sequential loop of the CLI
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        shutil.copytree(FHIR_DIR, input_dir)
+        patient = "6aec9dae-b873-5ede-bedb-43127439e809"
+        panels = [
+            panel(1, [component("8480-6", 120), component("8462-4", 80)], patient=patient),
+            panel(2, [], patient=patient),
+        ]
+        (input_dir / "Panels.ndjson").write_text("".join(json.dumps(p) + "\n" for p in panels))
+        with open(CONFIG_PATH) as f:
+            config = yaml.safe_load(f)
+        config["R4"]["Observation"] = PANEL_CONFIG
+        config_path = Path(temp_dir) / "panels.yaml"
+        config_path.write_text(yaml.safe_dump(config))
+
+        outputs = []
+        for workers in (1, 2):
+            root = Path(temp_dir) / f"output{workers}"
+            command = [
+                sys.executable,
+                "-m",
+                "fhir2meds",
+                f"raw_input_dir={input_dir}",
+                f"root_output_dir={root}",
+                f"event_configs={{panels: {config_path}}}",
+                f"mapping_workers={workers}",
+            ]
+            out = subprocess.run(command, capture_output=True)
+            assert out.returncode == 0, out.stderr.decode()
+            data = pl.read_parquet(list((root / "panels" / "data").glob("*.parquet")))
+            outputs.append(data.sort(data.columns, nulls_last=True))
+        assert outputs[0].equals(outputs[1])
+        panel_events = outputs[0].filter(pl.col("code").str.starts_with("Observation//LOINC"))
+        assert panel_events.select("subject_id", "code", "numeric_value").rows() == [
+            (10000032, "Observation//LOINC//8462-4", 80.0),
+            (10000032, "Observation//LOINC//8480-6", 120.0),
+        ]
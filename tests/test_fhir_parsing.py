@@ -1,4 +1,12 @@
+import base64
+import json
+import os
+from pathlib import Path
+
 import pytest
+
+from fhir2meds import fhir_parser
+from fhir2meds.event_conversion import iter_events
 from fhir2meds.fhir_parser import get_sample_resources_by_type, load_event_config
 
 FHIR_DIR = "mimic-fhir"
@@ -20,14 +28,91 @@ RESOURCE_TYPES = [
     # Add more as needed
 ]
 
+
 @pytest.mark.parametrize("resource_type", RESOURCE_TYPES)
 def test_fhir_resource_parsing(resource_type):
-    samples_by_type = get_sample_resources_by_type(FHIR_DIR, event_config=EVENT_CONFIG, fhir_version="R4", n=3)
+    samples_by_type = get_sample_resources_by_type(
+        FHIR_DIR, event_config=EVENT_CONFIG, fhir_version="R4", n=3
+    )
     if resource_type not in samples_by_type:
         pytest.skip(f"No {resource_type} resources found in {FHIR_DIR}")
     samples = samples_by_type[resource_type]
     assert len(samples) > 0, f"No samples found for {resource_type}"
     for resource in samples:
-        assert getattr(resource, "resource_type", None) == resource_type or getattr(resource, "resourceType", None) == resource_type
+        assert (
+            getattr(resource, "resource_type", None) == resource_type
+            or getattr(resource, "resourceType", None) == resource_type
+        )
         assert hasattr(resource, "id") or "id" in resource
-        # Optionally, add more asserts for key fields per resource type 
\ No newline at end of file
+        # Optionally, add more asserts for key fields per resource type
+
+
+FIXTURE_DIR = str(Path(__file__).parent / "fixtures" / "mimic-fhir")
+
+
+def test_iter_resources_reads_only_requested_files(monkeypatch):
+    opened = []
+    real_iter_file_resources = fhir_parser.iter_file_resources
+
+    def spy(fpath):
+        opened.append(Path(fpath).name)
+        return real_iter_file_resources(fpath)
+
+    monkeypatch.setattr(fhir_parser, "iter_file_resources", spy)
+    resources = list(fhir_parser.iter_resources(FIXTURE_DIR, types=["Condition", "Encounter"], limit=2))
+    assert [r["resourceType"] for r in resources] == ["Condition", "Condition", "Encounter", "Encounter"]
+    assert sorted(opened) == ["Condition.ndjson", "Encounter.ndjson"]
+
+
+def test_iter_resources_stops_early():
+    resources = fhir_parser.iter_resources(FIXTURE_DIR, types=["Observation"], limit=1)
+    assert next(resources)["resourceType"] == "Observation"
+    assert next(resources, None) is None
+
+
+def test_get_sample_resources_by_type_fixture():
+    samples = get_sample_resources_by_type(FIXTURE_DIR, event_config=EVENT_CONFIG, n=2)
+    assert {rtype: len(v) for rtype, v in samples.items()} == {
+        "Condition": 2,
+        "Encounter": 2,
+        "MedicationRequest": 2,
+        "Observation": 2,
+        "Organization": 1,
+        "Patient": 2,
+    }
+
+
+def test_iter_events():
+    events = list(iter_events(FIXTURE_DIR, types=["Observation", "Patient"], limit=3))
+    assert len(events) == 6
+    assert {e["subject_id"] for e in events} <= {10000032, 10001217, 10002428}
+    assert sum(e["code"] == "MEDS_BIRTH" for e in events) == 3
+
+
+def test_large_payloads_are_referenced_not_decoded(tmp_path):
+    payload = base64.b64encode(os.urandom(3000)).decode()
+    document = {
+        "resourceType": "DocumentReference",
+        "id": "doc-1",
+        "subject": {"reference": "Patient/p1"},
+        "content": [{"attachment": {"contentType": "text/plain", "data": payload}}],
+    }
+    binary = {
+        "resourceType": "Binary",
+        "id": "bin-1",
+        "contentType": "application/pdf",
+        "data": payload[:100],
+    }
+    path = tmp_path / "DocumentReference.ndjson"
+    # Escaped slashes are valid JSON and occur in base64 written by some serializers
+    path.write_text(json.dumps(binary) + "\n" + json.dumps(document).replace("/", "\\/") + "\n")
+
+    small, large = list(fhir_parser.iter_file_resources(str(path), payload_min_bytes=1000))
+    assert small == binary
+    attachment = large["content"][0]["attachment"]
+    assert "data" not in attachment and attachment["contentType"] == "text/plain"
+    assert fhir_parser.read_payload(attachment[fhir_parser.PAYLOAD_REF_KEY]) == base64.b64decode(payload)
+    assert fhir_parser.read_payload(attachment[fhir_parser.PAYLOAD_REF_KEY], decode=False) == payload
+
+    resources = list(fhir_parser.iter_file_resources(str(path), payload_min_bytes=None))
+    assert resources[1]["content"][0]["attachment"]["data"] == payload
@@ -0,0 +1,122 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from fhir2meds import meds_writer
+from fhir2meds.manifest import (
+    MANIFEST_PATH,
+    load_manifest,
+    verify_output,
+    write_manifest,
+)
+from fhir2meds.meds_writer import write_meds_sharded_parquet
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def fhir2meds(*args):
+    return subprocess.run([sys.executable, "-m", "fhir2meds", *args], capture_output=True)
+
+
+def convert(output_dir, *args):
+    out = fhir2meds(f"raw_input_dir={FHIR_DIR}", f"root_output_dir={output_dir}", *args)
+    assert out.returncode == 0, out.stderr.decode()
+
+
+def test_manifest_describes_the_output():
+    with TemporaryDirectory() as temp_dir:
+        convert(temp_dir, "shard_size=10")
+        manifest = load_manifest(temp_dir)
+        data = pl.read_parquet(list((Path(temp_dir) / "data").glob("*.parquet")))
+        assert manifest["n_rows"] == data.height
+        assert manifest["n_shards"] == len(manifest["shards"]) == 3
+        assert manifest["min_time"] == data["time"].min().isoformat()
+        for entry in manifest["shards"]:
+            shard = pl.read_parquet(Path(temp_dir) / entry["path"])
+            assert (entry["n_rows"], entry["n_subjects"]) == (shard.height, shard["subject_id"].n_unique())
+        assert set(manifest["metadata"]) >= {"codes.parquet", "dataset.json"}
+        assert len(manifest["schema_fingerprints"]) == 1
+
+        # Rewriting reuses the entries of unchanged shards and keeps the dataset checksum
+        assert write_manifest(temp_dir)["data_sha256"] == manifest["data_sha256"]
+        assert verify_output(temp_dir) == []
+        assert verify_output(temp_dir, full=True) == []
+
+
+def test_verify_detects_changed_outputs():
+    with TemporaryDirectory() as temp_dir:
+        convert(temp_dir, "shard_size=10")
+        data_dir = Path(temp_dir) / "data"
+        shards = sorted(data_dir.glob("*.parquet"))
+
+        # Same rows, but a NaN value: only the full check reads the values
+        table = pq.read_table(shards[0])
+        values = table["numeric_value"].to_pylist()
+        values[0] = float("nan")
+        index = table.schema.get_field_index("numeric_value")
+        table = table.set_column(index, "numeric_value", pa.array(values, table.schema.field(index).type))
+        pq.write_table(table, shards[0])
+        full = verify_output(temp_dir, full=True)
+        assert any("NaN" in problem for problem in full)
+        assert any("checksum" in problem for problem in full)
+
+        # Rows dropped from a shard, a column of the wrong type, a missing and an extra shard
+        pq.write_table(pq.read_table(shards[1]).slice(1), shards[1])
+        table = pq.read_table(shards[2])
+        pq.write_table(table.set_column(0, "subject_id", table["subject_id"].cast(pa.int32())), shards[2])
+        (data_dir / "extra.parquet").write_bytes(shards[0].read_bytes())
+        shards[0].unlink()
+        problems = verify_output(temp_dir)
+        assert any(f"{shards[1].name}: " in p and "rows" in p for p in problems)
+        assert any(f"{shards[2].name}: column subject_id is int32" in p for p in problems)
+        assert f"data/{shards[0].name}: missing" in problems
+        assert "data/extra.parquet: not in the manifest" in problems
+
+
+def test_verify_stage():
+    with TemporaryDirectory() as temp_dir:
+        convert(temp_dir)
+        out = fhir2meds(f"root_output_dir={temp_dir}", "stage=verify", "verify_values=true")
+        assert out.returncode == 0, out.stderr.decode()
+        assert b"OK" in out.stdout
+
+        manifest_path = Path(temp_dir) / MANIFEST_PATH
+        manifest = json.loads(manifest_path.read_text())
+        manifest["shards"][0]["n_rows"] += 1
+        manifest_path.write_text(json.dumps(manifest))
+        out = fhir2meds(f"root_output_dir={temp_dir}", "stage=verify")
+        assert out.returncode != 0
+        assert b"rows, manifest has" in out.stdout
+
+
+def test_lossy_casts_are_counted():
+    event = {"subject_id": 1, "time": "2180-01-01T00:00:00", "code": "Observation//x"}
+    bad = [{"numeric_value": 1e300}, {"subject_id": 2**64 - 1}, {"numeric_value": "high"}]
+    with TemporaryDirectory() as temp_dir:
+        for lossy, kind in zip(bad, ["out of the Float32 range", "out of the Int64 range", "not numbers"]):
+            write_meds_sharded_parquet([event, {**event, **lossy}], temp_dir, shard_size=1)
+            lost = meds_writer.drain_lost_values()
+            assert [n for k, n in lost.items() if kind in k] == [1], lost
+            write_manifest(temp_dir, lost_values=lost)
+            assert load_manifest(temp_dir)["lost_values"] == lost
+        # Unresolved patient references are dropped, not lost values
+        write_meds_sharded_parquet([event, {**event, "subject_id": "uuid"}], temp_dir)
+        assert pl.read_parquet(Path(temp_dir) / "data" / "0.parquet").height == 1
+        assert meds_writer.drain_lost_values() == {}
+        # The counts of the previous manifest are kept when none are given
+        write_manifest(temp_dir)
+        assert load_manifest(temp_dir)["lost_values"] == lost
+
+        meds_writer.set_strict_casts(True)
+        try:
+            with pytest.raises(ValueError, match="not numbers"):
+                write_meds_sharded_parquet([event, {**event, **bad[2]}], temp_dir)
+        finally:
+            meds_writer.set_strict_casts(False)
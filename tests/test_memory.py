@@ -0,0 +1,96 @@
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+
+from fhir2meds import fhir_parser
+from fhir2meds.event_conversion import build_event, build_patient_id_map
+from fhir2meds.fhir_parser import (
+    filter_subject_resources_by_type,
+    load_event_config,
+    load_fhir_resources_by_type,
+)
+from fhir2meds.meds_writer import events_to_dataframe, write_meds_sharded_parquet
+from fhir2meds.memory import MemoryGovernor, SpilledEvents
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def read_data(root):
+    data = pl.read_parquet(list((Path(root) / "data").glob("*.parquet")))
+    return data.sort(data.columns, nulls_last=True)
+
+
+def fixture_events():
+    event_config = load_event_config()
+    resources = filter_subject_resources_by_type(load_fhir_resources_by_type(str(FHIR_DIR), event_config))
+    uuid_to_int = build_patient_id_map(str(FHIR_DIR / "Patient.ndjson"))
+    events = [
+        build_event(
+            res, event_config.get(rtype, event_config["default"]), uuid_to_int, event_config["default"]
+        )
+        for rtype, batch in resources.items()
+        for res in batch
+    ]
+    return events_to_dataframe(events)
+
+
+def test_spilled_events_are_written_like_a_frame():
+    frame = fixture_events()
+    # A budget of one byte is always under pressure, so every appended batch is spilled
+    governor = MemoryGovernor(1)
+    spilled = SpilledEvents(governor)
+    for start in range(0, frame.height, 5):
+        spilled.append(frame[start : start + 5])
+    assert len(spilled) == frame.height
+    assert len(spilled.spill_paths) == len(range(0, frame.height, 5))
+    assert spilled.collect().equals(frame)
+
+    with TemporaryDirectory() as temp_dir:
+        write_meds_sharded_parquet(frame, f"{temp_dir}/frame", shard_size=7)
+        write_meds_sharded_parquet(spilled, f"{temp_dir}/spilled", shard_size=7, governor=governor)
+        assert read_data(f"{temp_dir}/spilled").equals(read_data(f"{temp_dir}/frame"))
+        # Shards are re-chunked across spill files rather than written per spilled batch
+        assert len(list(Path(f"{temp_dir}/spilled/data").glob("*.parquet"))) == -(-frame.height // 7)
+    spill_dir = Path(spilled.spill_paths[0]).parent
+    spilled.close()
+    assert not spill_dir.exists()
+
+
+def test_loading_fails_cleanly_over_budget(monkeypatch):
+    monkeypatch.setattr(fhir_parser, "MEMORY_CHECK_EVERY", 1)
+    with pytest.raises(MemoryError, match="memory_limit"):
+        load_fhir_resources_by_type(str(FHIR_DIR), load_event_config(), governor=MemoryGovernor(1))
+
+
+@pytest.mark.parametrize("mapping_workers", [1, 2])
+def test_cli_memory_limit_matches_unlimited(mapping_workers):
+    with TemporaryDirectory() as temp_dir:
+        outputs = {}
+        for name, args in [
+            ("unlimited", []),
+            ("limited", ["memory_limit=1MiB", f"memory_spill_dir={temp_dir}"]),
+        ]:
+            root = Path(temp_dir) / name
+            command = [
+                sys.executable,
+                "-m",
+                "fhir2meds",
+                f"raw_input_dir={FHIR_DIR}",
+                f"root_output_dir={root}",
+                f"mapping_workers={mapping_workers}",
+                *args,
+            ]
+            out = subprocess.run(command, capture_output=True)
+            assert out.returncode == 0, out.stderr.decode()
+            outputs[name] = root
+        assert read_data(outputs["limited"]).equals(read_data(outputs["unlimited"]))
+        codes = [
+            pl.read_parquet(root / "metadata" / "codes.parquet").sort("code") for root in outputs.values()
+        ]
+        assert codes[0].equals(codes[1])
+        # Spill files are removed once the shards are written
+        assert not list(Path(temp_dir).glob("fhir2meds_spill_*"))
@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+
+from fhir2meds import parallel_mapping
+from fhir2meds.event_conversion import build_event, build_patient_id_map
+from fhir2meds.fhir_parser import (
+    filter_subject_resources_by_type,
+    load_event_config,
+    load_fhir_resources_by_type,
+)
+from fhir2meds.meds_writer import events_to_dataframe
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def load_fixture():
+    event_config = load_event_config(fhir_version="R4")
+    resources = filter_subject_resources_by_type(load_fhir_resources_by_type(str(FHIR_DIR), event_config))
+    return resources, event_config, build_patient_id_map(str(FHIR_DIR / "Patient.ndjson"))
+
+
+def test_patient_map_round_trip():
+    with TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "map.arrow")
+        parallel_mapping.write_patient_map({"b": 2, "a": 1}, path)
+        table = parallel_mapping.open_patient_map(path)
+        assert table.column("uuid").to_pylist() == ["a", "b"]
+        assert table.column("subject_id").to_pylist() == [1, 2]
+
+
+@pytest.mark.parametrize("start_methods", [None, ["spawn"]])
+def test_parallel_mapping_matches_sequential(monkeypatch, start_methods):
+    if start_methods is not None:
+        monkeypatch.setattr(parallel_mapping.multiprocessing, "get_all_start_methods", lambda: start_methods)
+    resources, event_config, uuid_to_int = load_fixture()
+    events = [
+        build_event(
+            res, event_config.get(rtype, event_config["default"]), uuid_to_int, event_config["default"]
+        )
+        for rtype, batch in resources.items()
+        for res in batch
+    ]
+    want = events_to_dataframe(events)
+    got = parallel_mapping.map_resources_parallel(
+        resources, event_config, uuid_to_int, max_workers=2, batch_size=2
+    )
+    assert got.equals(want)
+
+
+def test_cli_mapping_workers():
+    with TemporaryDirectory() as temp_dir:
+        outputs = []
+        for workers in ["1", "2"]:
+            out = Path(temp_dir) / workers
+            cmd = [
+                sys.executable,
+                "-m",
+                "fhir2meds",
+                f"raw_input_dir={FHIR_DIR}",
+                f"root_output_dir={out}",
+                f"mapping_workers={workers}",
+                "mapping_batch_size=2",
+            ]
+            subprocess.run(cmd, check=True, capture_output=True)
+            outputs.append(pl.read_parquet(out / "data" / "0.parquet"))
+            outputs.append(set(pl.read_parquet(out / "metadata" / "codes.parquet")["code"].to_list()))
+        assert outputs[0].equals(outputs[2])
+        assert outputs[1] == outputs[3]
@@ -0,0 +1,74 @@
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from fhir2meds import profiling
+from fhir2meds.event_conversion import build_event
+from fhir2meds.fanout import map_fanout_batch
+from fhir2meds.fhir_parser import load_event_config, load_fhir_resources_by_type
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+VOCAB = "vocab(code[coding][0][system])"
+
+
+def test_build_event_costs_are_attributed_per_expression():
+    config = load_event_config()
+    resources = load_fhir_resources_by_type(str(FHIR_DIR), config)
+    conditions = resources["Condition"]
+    profiler = profiling.enable()
+    try:
+        profiler.stage("map")
+        for res in conditions:
+            build_event(res, config.get("Condition", config["default"]), default_config=config["default"])
+        with profiling.section("fanout"):
+            fanout_code = ["const(resourceType)", "col(code[coding][*][code])"]
+            fanout_config = {**config["default"], "code": fanout_code}
+            map_fanout_batch(conditions, fanout_config)
+    finally:
+        assert profiling.disable() is profiler
+    assert profiling.ACTIVE is None
+
+    stats = profiler.self_stats()
+    assert stats[("map", "Condition", "code", VOCAB)][0] == len(conditions)
+    assert stats[("map", "Condition", "subject_id", "col(subject.reference)")][0] == len(conditions)
+    assert ("map", "fanout", "Condition", "fanout", "explode") in stats
+    # A parent's total covers its children, its self time excludes them
+    calls, total, self_ns, _, _ = stats[("map", "Condition", "code")]
+    children = sum(v[1] for k, v in stats.items() if k[:3] == ("map", "Condition", "code") and len(k) == 4)
+    assert calls == len(conditions) and total >= children and self_ns == max(total - children, 0)
+    assert stats[("map",)][1] >= stats[("map", "Condition")][1]
+
+    report = profiler.report().splitlines()
+    self_times = [float(line.split()[0]) for line in report[1:]]
+    assert self_times == sorted(self_times, reverse=True)
+    for line in profiler.collapsed().splitlines():
+        frames, value = line.rsplit(" ", 1)
+        assert int(value) > 0 and frames.startswith("map")
+
+
+def test_profile_cli():
+    with TemporaryDirectory() as temp_dir:
+        for workers in (1, 2):
+            output_dir = Path(temp_dir) / f"out{workers}"
+            out = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "fhir2meds",
+                    f"raw_input_dir={FHIR_DIR}",
+                    f"root_output_dir={output_dir}",
+                    "profile=true",
+                    "profile_allocations=true",
+                    f"mapping_workers={workers}",
+                ],
+                capture_output=True,
+            )
+            assert out.returncode == 0, out.stderr.decode()
+            profile_dir = output_dir / "profile"
+            stacks = (profile_dir / profiling.STACKS_FILE).read_text()
+            assert "map;Observation;code;" in stacks
+            assert "load;decode;Patient.ndjson" in (profile_dir / profiling.REPORT_FILE).read_text()
+            assert (profile_dir / profiling.ALLOCATIONS_FILE).exists()
+            stages = {line.split(";")[0].split(" ")[0] for line in stacks.splitlines()}
+            assert stages >= {"load", "map", "write"}
@@ -0,0 +1,167 @@
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+
+from fhir2meds.fhir_parser import (
+    PAYLOAD_REF_KEY,
+    load_event_config,
+    load_fhir_resources_by_type,
+)
+from fhir2meds.resource_cache import (
+    JSON_COLUMN,
+    ResourceCache,
+    config_fingerprint,
+    resources_to_table,
+    table_to_resources,
+)
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def run_fhir2meds(*overrides):
+    command = [sys.executable, "-m", "fhir2meds", *overrides]
+    out = subprocess.run(command, capture_output=True)
+    assert out.returncode == 0, f"Command {command} failed:\n{out.stdout.decode()}\n{out.stderr.decode()}"
+
+
+def read_data(root):
+    data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+    return data.sort(data.columns, nulls_last=True)
+
+
+def test_resources_round_trip_through_tables():
+    structs = [
+        {"resourceType": "Observation", "id": "1", "valueQuantity": {"value": 1.5, "unit": "mg"}},
+        {"resourceType": "Observation", "id": "2", "code": {"coding": [{"code": "x"}]}},
+    ]
+    table = resources_to_table(structs)
+    assert JSON_COLUMN not in table.column_names
+    assert table_to_resources(table) == structs
+
+    # Integers next to floats would come back as floats, empty objects cannot be written to Parquet
+    for conflicting in ([{"value": 1}, {"value": 1.5}], [{"meta": {}}], [{"value": 1}, {"value": "x"}]):
+        table = resources_to_table(conflicting)
+        assert table.column_names == [JSON_COLUMN]
+        assert table_to_resources(table) == conflicting
+
+
+def test_cache_parses_only_changed_files():
+    event_config = load_event_config(fhir_version="R4")
+    with TemporaryDirectory() as temp_dir:
+        input_dir = os.path.join(temp_dir, "input")
+        shutil.copytree(FHIR_DIR, input_dir)
+        files = sorted(str(p) for p in Path(input_dir).glob("*.ndjson"))
+
+        cache = ResourceCache(os.path.join(temp_dir, "cache"))
+        cache.update(files)
+        assert cache.n_parsed == len(files)
+        expected = load_fhir_resources_by_type(input_dir, event_config)
+        assert cache.resource_types() == list(expected)
+        for rtype, resources in expected.items():
+            assert cache.load_resources(rtype) == resources
+
+        condition_file = os.path.join(input_dir, "Condition.ndjson")
+        with open(condition_file) as f:
+            first_line = f.readline()
+        with open(condition_file, "a") as f:
+            f.write(first_line)
+        fingerprint = cache.input_fingerprint("Observation"), cache.input_fingerprint("Condition")
+
+        cache = ResourceCache(os.path.join(temp_dir, "cache"))
+        cache.update(files)
+        assert cache.n_parsed == 1
+        assert len(cache.load_resources("Condition")) == len(expected["Condition"]) + 1
+        assert cache.input_fingerprint("Observation") == fingerprint[0]
+        assert cache.input_fingerprint("Condition") != fingerprint[1]
+        # The entry of the old Condition.ndjson was replaced
+        assert len(os.listdir(cache.resources_dir)) == len(files)
+
+
+def test_config_fingerprint_tracks_the_type_section():
+    event_config = load_event_config(fhir_version="R4")
+    before = {rtype: config_fingerprint(event_config, rtype) for rtype in ("Condition", "Observation")}
+    event_config["Condition"] = {
+        **event_config.get("Condition", event_config["default"]),
+        "code": ["const(X)"],
+    }
+    assert config_fingerprint(event_config, "Condition") != before["Condition"]
+    assert config_fingerprint(event_config, "Observation") == before["Observation"]
+    assert config_fingerprint(event_config, "Observation", max_events=1) != before["Observation"]
+
+
+def test_cached_runs_match_uncached_run():
+    with TemporaryDirectory() as temp_dir:
+        plain = Path(temp_dir) / "plain"
+        cached = Path(temp_dir) / "cached"
+        cache_dir = Path(temp_dir) / "cache"
+        run_fhir2meds(f"raw_input_dir={FHIR_DIR}", f"root_output_dir={plain}")
+        overrides = [
+            f"raw_input_dir={FHIR_DIR}",
+            f"root_output_dir={cached}",
+            "use_resource_cache=true",
+            f"resource_cache_dir={cache_dir}",
+            "do_overwrite=true",
+        ]
+        run_fhir2meds(*overrides)
+        events_files = {p.name: p.stat().st_mtime_ns for p in (cache_dir / "events").iterdir()}
+        assert events_files
+        assert read_data(cached).equals(read_data(plain))
+
+        # Nothing changed: every type's events are reused from the cache
+        run_fhir2meds(*overrides)
+        assert {p.name: p.stat().st_mtime_ns for p in (cache_dir / "events").iterdir()} == events_files
+        assert read_data(cached).equals(read_data(plain))
+
+
+def test_cached_events_track_the_normalization_settings():
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        input_dir.mkdir()
+        shutil.copy(FHIR_DIR / "Patient.ndjson", input_dir)
+        shutil.copy(FHIR_DIR / "ObservationChartevents.ndjson", input_dir)
+        overrides = [
+            f"raw_input_dir={input_dir}",
+            f"root_output_dir={Path(temp_dir) / 'out'}",
+            "use_resource_cache=true",
+            f"resource_cache_dir={Path(temp_dir) / 'cache'}",
+            "do_overwrite=true",
+        ]
+        outputs = {}
+        for settings in ([], ["promote_numeric_text=true"], ["normalize_units=true"]):
+            run_fhir2meds(*overrides, *settings)
+            uncached = Path(temp_dir) / f"uncached{len(outputs)}"
+            run_fhir2meds(f"raw_input_dir={input_dir}", f"root_output_dir={uncached}", *settings)
+            outputs[tuple(settings)] = read_data(Path(temp_dir) / "out")
+            assert outputs[tuple(settings)].equals(read_data(uncached)), settings
+        assert not outputs[()].equals(outputs[("promote_numeric_text=true",)])
+
+
+def test_cache_tracks_the_payload_setting():
+    payload = base64.b64encode(os.urandom(3000)).decode()
+    document = {
+        "resourceType": "DocumentReference",
+        "id": "doc-1",
+        "content": [{"attachment": {"contentType": "text/plain", "data": payload}}],
+    }
+    with TemporaryDirectory() as temp_dir:
+        fpath = os.path.join(temp_dir, "DocumentReference.ndjson")
+        with open(fpath, "w") as f:
+            f.write(json.dumps(document) + "\n")
+        cache_dir = os.path.join(temp_dir, "cache")
+        attachments = {}
+        for payload_min_bytes in (1000, None, 1000):
+            cache = ResourceCache(cache_dir, payload_min_bytes=payload_min_bytes)
+            cache.update([fpath])
+            assert cache.n_parsed == 1
+            attachments[payload_min_bytes] = cache.load_resources("DocumentReference")[0]["content"][0][
+                "attachment"
+            ]
+        assert attachments[None]["data"] == payload
+        assert "data" not in attachments[1000] and PAYLOAD_REF_KEY in attachments[1000]
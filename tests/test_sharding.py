@@ -0,0 +1,158 @@
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+
+from fhir2meds.fhir_parser import list_fhir_files
+from fhir2meds.sharding import (
+    assign_split,
+    partition_files,
+    stable_hash,
+    subject_in_partition,
+    validate_split_fractions,
+)
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def run_fhir2meds(*overrides):
+    command = [sys.executable, "-m", "fhir2meds", *overrides]
+    out = subprocess.run(command, capture_output=True)
+    assert out.returncode == 0, f"Command {command} failed:\n{out.stdout.decode()}\n{out.stderr.decode()}"
+
+
+def read_output(root):
+    data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+    codes = set(pl.read_parquet(root / "metadata" / "codes.parquet")["code"].to_list())
+    splits = pl.read_parquet(root / "metadata" / "subject_splits.parquet")
+    assert splits["subject_id"].is_unique().all()
+    subjects = set(zip(splits["subject_id"].to_list(), splits["split"].to_list()))
+    return data.sort(data.columns, nulls_last=True), codes, subjects
+
+
+@pytest.mark.parametrize("num_workers", [1, 2, 3, 7])
+def test_partition_files_is_disjoint_and_complete(num_workers):
+    files = list_fhir_files(str(FHIR_DIR))
+    parts = [partition_files(files, i, num_workers) for i in range(num_workers)]
+    assert sorted(f for part in parts for f in part) == files
+    assert parts == [partition_files(list(reversed(files)), i, num_workers) for i in range(num_workers)]
+
+
+def test_subject_partition_is_exclusive():
+    keys = [f"patient-{i}" for i in range(100)]
+    for key in keys:
+        assert sum(subject_in_partition(key, i, 4) for i in range(4)) == 1
+    assert not subject_in_partition(None, 0, 1)
+    assert stable_hash("a") != stable_hash("b")
+
+
+def test_assign_split_follows_fractions_and_seed():
+    fractions = {"train": 0.7, "tuning": 0.2, "held_out": 0.1}
+    splits = [assign_split(subject_id, fractions) for subject_id in range(10000)]
+    for split, fraction in fractions.items():
+        assert abs(splits.count(split) / len(splits) - fraction) < 0.02
+    assert splits == [assign_split(subject_id, fractions) for subject_id in range(10000)]
+    assert splits != [assign_split(subject_id, fractions, seed=1) for subject_id in range(10000)]
+    with pytest.raises(ValueError):
+        validate_split_fractions({"train": 0.8, "held_out": 0.1})
+
+
+def test_splits_are_assembled_from_shards():
+    with TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir)
+        run_fhir2meds(f"raw_input_dir={FHIR_DIR}", f"root_output_dir={root}", "shard_size=5", "split_seed=3")
+        assert len(list((root / "metadata" / "partials" / "subject_splits").glob("*.parquet"))) > 1
+        _, _, subjects = read_output(root)
+        assert {subject_id for subject_id, _ in subjects} == {10000032, 10001217, 10002428}
+        assert all(split == assign_split(subject_id, seed=3) for subject_id, split in subjects)
+
+
+@pytest.mark.parametrize("partition_by", ["files", "subject"])
+def test_sharded_run_matches_single_process(partition_by):
+    with TemporaryDirectory() as temp_dir:
+        single = Path(temp_dir) / "single"
+        sharded = Path(temp_dir) / "sharded"
+        run_fhir2meds(f"raw_input_dir={FHIR_DIR}", f"root_output_dir={single}")
+
+        workers = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "fhir2meds",
+                    f"raw_input_dir={FHIR_DIR}",
+                    f"root_output_dir={sharded}",
+                    "num_workers=2",
+                    f"worker_index={i}",
+                    f"partition_by={partition_by}",
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            for i in range(2)
+        ]
+        for proc in workers:
+            _, stderr = proc.communicate()
+            assert proc.returncode == 0, stderr.decode()
+        run_fhir2meds(
+            f"raw_input_dir={FHIR_DIR}", f"root_output_dir={sharded}", "num_workers=2", "stage=merge"
+        )
+
+        assert sorted(p.name for p in (sharded / "data").glob("*.parquet"))[0].startswith("0_")
+        want_data, want_codes, want_subjects = read_output(single)
+        got_data, got_codes, got_subjects = read_output(sharded)
+        assert got_data.equals(want_data)
+        assert got_codes == want_codes
+        assert got_subjects == want_subjects
+        assert (sharded / "metadata" / "dataset.json").exists()
+
+
+def test_code_metadata_survives_the_merge():
+    # The CodeSystem and the Conditions using it are partitioned to different workers
+    code_system = {
+        "resourceType": "CodeSystem",
+        "url": "http://mimic.mit.edu/fhir/mimic/CodeSystem/mimic-diagnosis-icd9",
+        "concept": [{"code": "401", "display": "Essential hypertension", "concept": [{"code": "4019"}]}],
+    }
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        shutil.copytree(FHIR_DIR, input_dir)
+        (input_dir / "CodeSystem.ndjson").write_text(json.dumps(code_system) + "\n")
+        files = list_fhir_files(str(input_dir))
+        owners = {Path(f).name: i for i in range(3) for f in partition_files(files, i, 3)}
+        assert owners["CodeSystem.ndjson"] != owners["Condition.ndjson"]
+
+        single, sharded = Path(temp_dir) / "single", Path(temp_dir) / "sharded"
+        run_fhir2meds(f"raw_input_dir={input_dir}", f"root_output_dir={single}")
+        args = [f"raw_input_dir={input_dir}", f"root_output_dir={sharded}", "num_workers=3"]
+        for i in range(3):
+            run_fhir2meds(*args, f"worker_index={i}", "partition_by=files")
+        run_fhir2meds(*args, "stage=merge")
+
+        want = pl.read_parquet(single / "metadata" / "codes.parquet").sort("code")
+        got = pl.read_parquet(sharded / "metadata" / "codes.parquet").sort("code")
+        assert got.equals(want)
+        hypertension = got.filter(pl.col("code") == "Condition//ICD9//4019")
+        assert hypertension["parent_codes"].to_list() == [["Condition//ICD9//401"]]
+
+
+def test_merge_requires_all_workers():
+    with TemporaryDirectory() as temp_dir:
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "fhir2meds",
+                f"root_output_dir={temp_dir}",
+                "num_workers=2",
+                "stage=merge",
+            ],
+            capture_output=True,
+        )
+        assert out.returncode != 0
+        assert b"have not finished" in out.stderr
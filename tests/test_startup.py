@@ -0,0 +1,31 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Leaves room for slow CI runners; regressions from heavy imports are caught by LAZY_MODULES
+STARTUP_BUDGET_S = float(os.environ.get("FHIR2MEDS_STARTUP_BUDGET_S", "2.0"))
+
+# Only imported by the stages using them
+LAZY_MODULES = ["requests", "bs4", "fhir.resources", "meds", "polars", "pyarrow"]
+
+
+def test_cli_import_does_not_load_optional_stages():
+    code = (
+        "import json, sys, fhir2meds.__main__; "
+        f"print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    )
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, check=True)
+    assert json.loads(out.stdout.decode().strip().splitlines()[-1]) == []
+
+
+def test_cli_startup_time_benchmark():
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import fhir2meds.__main__"], check=True)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"fhir2meds CLI import: best {best:.3f}s of {[round(t, 3) for t in timings]}")
+    assert best < STARTUP_BUDGET_S, f"CLI startup took {best:.3f}s, budget is {STARTUP_BUDGET_S}s"
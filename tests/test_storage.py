@@ -0,0 +1,97 @@
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from fhir2meds.fhir_parser import (
+    _iter_local_lines,
+    load_event_config,
+    load_fhir_resources_by_type,
+)
+from fhir2meds.manifest import write_manifest
+from fhir2meds.meds_writer import events_to_dataframe, write_meds_sharded_parquet
+from fhir2meds.storage import iter_range_lines, list_files, upload_directory
+from fhir2meds.subject_index import assemble_subject_index, load_subject_index
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def test_range_lines_match_local_lines():
+    fpath = FHIR_DIR / "ObservationChartevents.ndjson"
+    data = fpath.read_bytes()
+    # Blocks much smaller than a line, so lines are stitched across many ranges
+    lines = list(iter_range_lines(lambda start, end: data[start:end], len(data), block=97, read_ahead=3))
+    assert lines == list(_iter_local_lines(str(fpath)))
+
+
+def test_parses_and_uploads_through_fsspec():
+    fsspec = pytest.importorskip("fsspec")
+    fs = fsspec.filesystem("memory")
+    for fpath in FHIR_DIR.glob("*.ndjson"):
+        fs.pipe(f"/fhir-input/{fpath.name}", fpath.read_bytes())
+
+    event_config = load_event_config()
+    expected = load_fhir_resources_by_type(str(FHIR_DIR), event_config)
+    assert load_fhir_resources_by_type("memory://fhir-input", event_config) == expected
+
+    with TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir) / "output"
+        out = subprocess.run(
+            [sys.executable, "-m", "fhir2meds", f"raw_input_dir={FHIR_DIR}", f"root_output_dir={root}"],
+            capture_output=True,
+        )
+        assert out.returncode == 0, out.stderr.decode()
+        n_files = upload_directory(str(root), "memory://meds-output", part_size=1 << 10)
+        local_files = sorted(str(p.relative_to(root)) for p in root.rglob("*") if p.is_file())
+        assert n_files == len(local_files)
+        uploaded = list_files("memory://meds-output", suffixes=("",))
+        assert [url.split("meds-output/", 1)[1] for url in uploaded] == local_files
+        for rel_path in local_files:
+            assert fs.cat_file(f"/meds-output/{rel_path}") == (root / rel_path).read_bytes()
+
+
+def test_shards_are_written_to_the_output_uri():
+    fsspec = pytest.importorskip("fsspec")
+    fs = fsspec.filesystem("memory")
+    events = events_to_dataframe(
+        [
+            {
+                "subject_id": i % 3,
+                "time": f"2020-01-{i + 1:02d}T00:00:00",
+                "code": f"C{i}",
+                "numeric_value": i,
+            }
+            for i in range(10)
+        ]
+    )
+    with TemporaryDirectory() as temp_dir:
+        local, staged = Path(temp_dir) / "local", Path(temp_dir) / "staged"
+        write_meds_sharded_parquet(events, str(local), shard_size=4, subject_index=True)
+        write_meds_sharded_parquet(
+            events,
+            str(staged),
+            shard_size=4,
+            subject_index=True,
+            output_uri="memory://meds-shards",
+            part_size=1 << 10,
+        )
+        # Nothing but the metadata partials is written locally
+        assert not (staged / "data").exists()
+        local_shards = sorted(p.name for p in (local / "data").iterdir())
+        assert [
+            url.rsplit("/", 1)[1] for url in list_files("memory://meds-shards/data", (".parquet",))
+        ] == local_shards
+        for name in local_shards:
+            assert fs.cat_file(f"/meds-shards/data/{name}") == (local / "data" / name).read_bytes()
+
+        def shards(manifest):
+            return [{k: v for k, v in shard.items() if k != "mtime_ns"} for shard in manifest["shards"]]
+
+        local_manifest, staged_manifest = write_manifest(str(local)), write_manifest(str(staged))
+        assert shards(staged_manifest) == shards(local_manifest)
+        assert staged_manifest["data_sha256"] == local_manifest["data_sha256"]
+        assemble_subject_index(str(local))
+        assemble_subject_index(str(staged))
+        assert load_subject_index(str(staged)).equals(load_subject_index(str(local)))
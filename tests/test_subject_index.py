@@ -0,0 +1,49 @@
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+
+from fhir2meds.subject_index import load_subject_index, read_subject, read_subjects
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def test_read_subjects_matches_full_scan():
+    with TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir) / "output"
+        command = [
+            sys.executable,
+            "-m",
+            "fhir2meds",
+            f"raw_input_dir={FHIR_DIR}",
+            f"root_output_dir={root}",
+            "shard_size=10",
+            "row_group_size=3",
+        ]
+        out = subprocess.run(command, capture_output=True)
+        assert out.returncode == 0, out.stderr.decode()
+
+        data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+        index = load_subject_index(root)
+        assert index["n_events"].sum() == data.height
+        assert sorted(index["subject_id"].unique().to_list()) == sorted(data["subject_id"].unique().to_list())
+
+        for subject_id in data["subject_id"].unique().to_list():
+            expected = data.filter(pl.col("subject_id") == subject_id)
+            timeline = read_subject(root, subject_id, index=index)
+            assert timeline.sort(timeline.columns, nulls_last=True).equals(
+                expected.sort(expected.columns, nulls_last=True)
+            )
+            assert timeline["time"].is_sorted(nulls_last=False)
+            entries = index.filter(pl.col("subject_id") == subject_id)
+            assert entries["min_time"].min() == expected["time"].min()
+            assert entries["max_time"].max() == expected["time"].max()
+
+        subject_ids = data["subject_id"].unique().to_list()[:2]
+        assert (
+            read_subjects(root, subject_ids, index=index).height
+            == data.filter(pl.col("subject_id").is_in(subject_ids)).height
+        )
+        assert read_subject(root, -1, index=index).height == 0
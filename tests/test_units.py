@@ -0,0 +1,150 @@
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+
+from fhir2meds.event_conversion import build_event
+from fhir2meds.fanout import map_fanout_batch
+from fhir2meds.fhir_parser import load_event_config
+from fhir2meds.meds_writer import events_to_dataframe
+from fhir2meds.units import (
+    UNIT_EXPRESSION,
+    ValueNormalizer,
+    make_normalizer,
+    with_unit_expression,
+)
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+PATIENT = "Patient/6aec9dae-b873-5ede-bedb-43127439e809"
+CONFIG = {
+    "code": ["const(resourceType)", "const(//)", "col(code[coding][0][code])"],
+    "time": "col(effectiveDateTime)",
+    "numeric_value": "col(valueQuantity.value)",
+    "unit": ["col(valueQuantity.code)", "col(valueQuantity.unit)"],
+    "text_value": "col(valueString)",
+    "subject_id": "col(subject.reference)",
+}
+
+
+def observation(i, code, quantity=None, text=None):
+    resource = {
+        "resourceType": "Observation",
+        "id": f"o{i}",
+        "subject": {"reference": PATIENT},
+        "effectiveDateTime": "2180-07-20T10:00:00",
+        "code": {"coding": [{"code": code}]},
+    }
+    if quantity is not None:
+        resource["valueQuantity"] = quantity
+    if text is not None:
+        resource["valueString"] = text
+    return resource
+
+
+OBSERVATIONS = [
+    observation(0, "temp", {"value": 98.6, "unit": "°F", "code": "[degF]"}),
+    observation(1, "temp", {"value": 37.0, "code": "Cel"}),
+    observation(2, "weight", {"value": 220.0, "unit": "lb"}),
+    observation(3, "glucose", {"value": 90.0, "code": "mg/dL"}),
+    observation(4, "ph", text=" 7.4"),
+    observation(5, "comment", text="<5"),
+    observation(6, "hr", {"value": 80}),
+]
+GLUCOSE = {"code": "Observation//glucose", "unit": "mg/dL", "to": "mmol/L", "factor": 0.0555}
+
+
+def normalized(frame):
+    values = zip(frame["numeric_value"].to_list(), frame["text_value"].to_list())
+    return dict(zip(frame["code"].to_list(), values))
+
+
+def test_values_are_normalized_per_code_and_unit():
+    normalizer = make_normalizer(normalize_units=True, promote_numeric_text=True)
+    normalizer.table[(GLUCOSE["code"], GLUCOSE["unit"])] = (GLUCOSE["factor"], 0.0)
+    events = [{**build_event(resource, dict(CONFIG)), "subject_id": 1} for resource in OBSERVATIONS]
+    values = normalized(events_to_dataframe(events, normalizer=normalizer))
+    assert values["Observation//temp"][0] == pytest.approx(37.0)
+    assert values["Observation//weight"][0] == pytest.approx(99.79, abs=0.01)
+    assert values["Observation//glucose"][0] == pytest.approx(4.995, abs=1e-3)
+    assert values["Observation//ph"] == (pytest.approx(7.4), None)
+    assert values["Observation//comment"] == (None, "<5")
+    assert values["Observation//hr"][0] == 80
+    # Every distinct (code, unit) pair was resolved once
+    assert set(normalizer.memo) == {
+        ("Observation//temp", "[degF]"),
+        ("Observation//temp", "Cel"),
+        ("Observation//weight", "lb"),
+        ("Observation//glucose", "mg/dL"),
+    }
+
+    # The fan-out path normalizes the same way
+    fanout_config = {**CONFIG, "code": ["const(resourceType)", "const(//)", "col(code[coding][*][code])"]}
+    uuid_to_int = {PATIENT.split("/")[1]: 1}
+    frame, _ = map_fanout_batch(OBSERVATIONS, fanout_config, uuid_to_int, normalizer=normalizer)
+    assert normalized(frame) == values
+    # Without a normalizer, units are not written and values are kept
+    plain = normalized(events_to_dataframe(events))
+    assert plain["Observation//weight"][0] == 220 and plain["Observation//ph"] == (None, " 7.4")
+    assert events_to_dataframe(events).columns == events_to_dataframe(events, normalizer=normalizer).columns
+
+
+def test_normalizer_options():
+    assert make_normalizer() is None
+    assert make_normalizer(promote_numeric_text=True).table == {}
+    assert "[degF]" in {unit for _, unit in make_normalizer(normalize_units=True).table}
+    with TemporaryDirectory() as temp_dir:
+        path = Path(temp_dir) / "units.yaml"
+        path.write_text(json.dumps({"conversions": [GLUCOSE]}))
+        assert ValueNormalizer.from_yaml(str(path)).table == {(GLUCOSE["code"], "mg/dL"): (0.0555, 0.0)}
+
+
+@pytest.mark.parametrize("fhir_version", ["R4", "R5"])
+def test_unit_is_only_resolved_when_converting_units(fhir_version):
+    event_config = load_event_config(fhir_version=fhir_version)
+    assert "unit" not in event_config["default"]
+    assert with_unit_expression(event_config) is event_config
+    assert with_unit_expression(event_config, normalize_units=True)["default"]["unit"] == UNIT_EXPRESSION
+    # A unit set by the config is kept
+    custom = {**event_config, "default": {**event_config["default"], "unit": "col(valueQuantity.unit)"}}
+    assert with_unit_expression(custom, normalize_units=True) is custom
+
+
+def test_cli_normalization_matches_across_mappers():
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        input_dir.mkdir()
+        shutil.copy(FHIR_DIR / "Patient.ndjson", input_dir)
+        shutil.copy(FHIR_DIR / "ObservationChartevents.ndjson", input_dir)
+        with open(input_dir / "ObservationChartevents.ndjson", "a") as f:
+            f.write(json.dumps(OBSERVATIONS[4]) + "\n")
+
+        outputs = {}
+        for workers in (1, 2):
+            output_dir = Path(temp_dir) / f"out{workers}"
+            out = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "fhir2meds",
+                    f"raw_input_dir={input_dir}",
+                    f"root_output_dir={output_dir}",
+                    "normalize_units=true",
+                    "promote_numeric_text=true",
+                    f"mapping_workers={workers}",
+                ],
+                capture_output=True,
+            )
+            assert out.returncode == 0, out.stderr.decode()
+            data = pl.read_parquet(list((output_dir / "data").glob("*.parquet")))
+            outputs[workers] = data.sort(data.columns, nulls_last=True)
+        assert outputs[1].equals(outputs[2])
+        temperatures = outputs[1].filter(pl.col("code").str.ends_with("//223761"))["numeric_value"]
+        assert temperatures.len() > 0 and temperatures.max() < 45
+        assert outputs[1].filter(pl.col("code").str.ends_with("//ph"))["numeric_value"].to_list() == [
+            pytest.approx(7.4)
+        ]
@@ -0,0 +1,62 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from fhir2meds.fhir_parser import (
+    get_fhir_resource_class,
+    load_event_config,
+    load_fhir_resources_by_type,
+)
+from fhir2meds.validation import validate_resources
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+EVENT_CONFIG = load_event_config(fhir_version="R4")
+
+
+def broken_observations(n):
+    return [{"resourceType": "Observation", "id": f"bad-{i}", "status": "final"} for i in range(n)]
+
+
+def test_resource_classes_are_cached():
+    get_fhir_resource_class.cache_clear()
+    for _ in range(3):
+        get_fhir_resource_class("Observation", "R4")
+    assert get_fhir_resource_class.cache_info().misses == 1
+
+
+def test_validation_aggregates_failures_by_kind():
+    resources = load_fhir_resources_by_type(str(FHIR_DIR), EVENT_CONFIG)
+    resources["Observation"] = resources["Observation"] + broken_observations(5)
+    for max_workers in (1, 2):
+        report = validate_resources(resources, max_workers=max_workers, batch_size=4)
+        assert report.checked["Patient"] == len(resources["Patient"])
+        assert report.checked["Observation"] == len(resources["Observation"])
+        assert report.failed["Observation"] == 5
+        assert report.failures[("Observation", "missing at code")] == 5
+        assert not report.ok
+
+
+def test_validation_sampling():
+    resources = {"Observation": broken_observations(10)}
+    assert validate_resources(resources, every_n=3, max_workers=1).checked["Observation"] == 4
+    assert validate_resources(resources, first_k=2, max_workers=1).checked["Observation"] == 2
+
+
+def test_cli_report_survives_overwrite():
+    with TemporaryDirectory() as temp_dir:
+        command = [
+            sys.executable,
+            "-m",
+            "fhir2meds",
+            f"raw_input_dir={FHIR_DIR}",
+            f"root_output_dir={temp_dir}",
+            "validate_with_fhir_resources=true",
+            "validate_workers=1",
+            "overwrite=true",
+        ]
+        out = subprocess.run(command, capture_output=True)
+        assert out.returncode == 0, out.stderr.decode()
+        report = json.loads((Path(temp_dir) / "validation_report.json").read_text())
+        assert report["checked"]["Patient"] == 3
@@ -0,0 +1,130 @@
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+
+from fhir2meds.fhir_parser import load_event_config
+from fhir2meds.subject_index import read_subject
+from fhir2meds.watch import MicroBatchConverter
+
+FHIR_DIR = Path(__file__).parent / "fixtures" / "mimic-fhir"
+
+
+def read_data(root):
+    data = pl.read_parquet(list((root / "data").glob("*.parquet")))
+    return data.sort(data.columns, nulls_last=True)
+
+
+def run(*args):
+    out = subprocess.run([sys.executable, "-m", "fhir2meds", *args], capture_output=True)
+    assert out.returncode == 0, out.stderr.decode()
+
+
+def test_watch_converts_and_compacts_micro_batches():
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        input_dir.mkdir()
+        full, watched = Path(temp_dir) / "full", Path(temp_dir) / "watched"
+        run(f"raw_input_dir={FHIR_DIR}", f"root_output_dir={full}")
+
+        watch_args = [
+            f"raw_input_dir={input_dir}",
+            f"root_output_dir={watched}",
+            "stage=watch",
+            "watch_max_batches=1",
+            "watch_settle_seconds=0",
+            "watch_compact_every=2",
+            "shard_size=5",
+        ]
+        files = sorted(FHIR_DIR.glob("*.ndjson"))
+        for fpath in files[:3]:
+            shutil.copy(fpath, input_dir)
+        run(*watch_args)
+        assert all(p.name.startswith("delta0_") for p in (watched / "data").glob("*.parquet"))
+
+        # A restarted watcher only converts the new files, then compacts both batches
+        for fpath in files[3:]:
+            shutil.copy(fpath, input_dir)
+        run(*watch_args)
+        shards = sorted((watched / "data").glob("*.parquet"))
+        assert shards and all(p.name.startswith("c1_") for p in shards)
+        compacted = pl.read_parquet(shards)
+        assert compacted["subject_id"].is_sorted()
+
+        assert read_data(watched).equals(read_data(full))
+        for name, key in [("subject_splits.parquet", "subject_id"), ("codes.parquet", "code")]:
+            expected = pl.read_parquet(full / "metadata" / name).sort(key)
+            assert pl.read_parquet(watched / "metadata" / name).sort(key).equals(expected)
+        subject_id = compacted["subject_id"][0]
+        assert (
+            read_subject(watched, subject_id).height
+            == compacted.filter(pl.col("subject_id") == subject_id).height
+        )
+
+
+def test_watch_holds_back_resources_of_unknown_patients():
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        input_dir.mkdir()
+        converter = MicroBatchConverter(
+            input_dir, Path(temp_dir) / "output", load_event_config(), settle_seconds=0
+        )
+        shutil.copy(FHIR_DIR / "Condition.ndjson", input_dir)
+        assert converter.convert(converter.new_files()) == 0
+        assert len(converter.pending["Condition"]) > 0
+
+        shutil.copy(FHIR_DIR / "Patient.ndjson", input_dir)
+        assert converter.new_files() == [str(input_dir / "Patient.ndjson")]
+        n_events = converter.convert(converter.new_files())
+        assert not converter.pending
+        assert (
+            read_data(Path(temp_dir) / "output").filter(pl.col("code").str.starts_with("Condition")).height
+            > 0
+        )
+        assert n_events > 0
+
+
+def test_watch_releases_and_expires_pending_resources(caplog):
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        input_dir.mkdir()
+        converter = MicroBatchConverter(
+            input_dir, Path(temp_dir) / "output", load_event_config(), settle_seconds=0, pending_batches=2
+        )
+        # Patients without an integer identifier are known all the same, their resources are not held back
+        patients = [json.loads(line) for line in (FHIR_DIR / "Patient.ndjson").read_text().splitlines()]
+        anonymous = [
+            {key: value for key, value in patient.items() if key != "identifier"} for patient in patients
+        ]
+        (input_dir / "Patient.ndjson").write_text("\n".join(json.dumps(patient) for patient in anonymous[:1]))
+        shutil.copy(FHIR_DIR / "Condition.ndjson", input_dir)
+        converter.convert(converter.new_files())
+        anonymous_id = anonymous[0]["id"]
+        pending = [res for _, res in converter.pending["Condition"]]
+        assert len(pending) == 2 and all(
+            res["subject"]["reference"] != f"Patient/{anonymous_id}" for res in pending
+        )
+
+        # The resources of patients that never arrive are dropped after pending_batches batches
+        for i in range(2):
+            assert converter.pending
+            (input_dir / f"empty{i}.ndjson").write_text("")
+            converter.convert(converter.new_files())
+        assert not converter.pending
+        assert f"Dropped {len(pending)} resources" in caplog.text
+
+
+def test_watch_caps_pending_resources():
+    with TemporaryDirectory() as temp_dir:
+        input_dir = Path(temp_dir) / "input"
+        input_dir.mkdir()
+        converter = MicroBatchConverter(
+            input_dir, Path(temp_dir) / "output", load_event_config(), settle_seconds=0, max_pending=1
+        )
+        shutil.copy(FHIR_DIR / "Condition.ndjson", input_dir)
+        converter.convert(converter.new_files())
+        assert sum(map(len, converter.pending.values())) == 1